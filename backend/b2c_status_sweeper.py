@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+B2C Status Sweeper
+Resolves disbursements left in 'processing' because their B2C result
+callback never arrived: sends Daraja a transaction status query for each
+(see services/b2c_status.py) and lets POST /mpesa/b2c/status-result apply
+the answer the way /mpesa/b2c/result would. Disbursements still unresolved
+after MPESA_B2C_MAX_STATUS_CHECKS queries, and ones stuck in 'submitting',
+are reported for manual review; they are never marked failed on a guess.
+
+Usage (from the backend directory, with the same environment as the API):
+    python b2c_status_sweeper.py                 # run forever
+    python b2c_status_sweeper.py --once          # one sweep and exit
+    python b2c_status_sweeper.py --limit 100     # disbursements queried per sweep
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import auth
+import models
+from database import SessionLocal, engine
+from routers.mpesa import get_mpesa_service
+from services import b2c_status
+from services.mpesa_service import close_async_http_client
+
+SWEEP_INTERVAL_SECONDS = int(os.getenv("MPESA_B2C_SWEEP_INTERVAL_SECONDS", 300))
+
+async def sweep_and_close(service, limit: int) -> dict:
+    # Each sweep runs on a new event loop; close its pooled httpx client with it
+    try:
+        return await b2c_status.sweep(service, f"{auth.BASE_URL}/api/mpesa/b2c/status-result", limit)
+    finally:
+        await close_async_http_client()
+
+def sweep_once(limit: int):
+    db = SessionLocal()
+    try:
+        service = get_mpesa_service(db).as_async()
+        review = b2c_status.needs_review(db)
+    finally:
+        db.close()
+    started = time.time()
+    counts = asyncio.run(sweep_and_close(service, limit))
+    if counts["due"]:
+        print(f"Queried {counts['sent']} of {counts['due']} stuck disbursement(s) in {time.time() - started:.2f}s "
+              f"({counts['failed']} not sent)")
+    if any(review.values()):
+        print(f"Needs manual review: {review['submitting']} submitting, {review['unanswered']} unanswered after "
+              f"{b2c_status.B2C_MAX_STATUS_CHECKS} status queries")
+
+def main(run_once: bool = False, limit: int = b2c_status.B2C_SWEEP_LIMIT):
+    models.Base.metadata.create_all(bind=engine)
+    while True:
+        try:
+            sweep_once(limit)
+        except Exception as e:
+            print(f"B2C status sweeper error: {e}")
+        if run_once:
+            break
+        time.sleep(SWEEP_INTERVAL_SECONDS)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    limit = b2c_status.B2C_SWEEP_LIMIT
+    if "--limit" in args:
+        limit = int(args[args.index("--limit") + 1])
+    main(run_once="--once" in args, limit=limit)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Client MSISDN Backfill
+Adds the clients.phone_msisdn / clients.mpesa_msisdn columns and their
+indexes to an existing database if missing, then fills them with the
+254-format form of phone and mpesa_phone. New and edited clients get them
+automatically (models.Client); run this once per tenant after upgrading,
+and after importing clients with raw SQL.
+
+Usage (from the backend directory, with the tenant's environment):
+    python backfill_msisdn.py
+    python backfill_msisdn.py --batch 5000
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect, text, update, bindparam
+
+import models
+from database import SessionLocal, engine
+
+DEFAULT_BATCH_SIZE = 2000
+COLUMNS = ("phone_msisdn", "mpesa_msisdn")
+
+
+def ensure_columns():
+    inspector = inspect(engine)
+    existing = {c["name"] for c in inspector.get_columns("clients")}
+    indexes = {i["name"] for i in inspector.get_indexes("clients")}
+    with engine.begin() as conn:
+        for column in COLUMNS:
+            if column not in existing:
+                print(f"Adding clients.{column}...")
+                conn.execute(text(f"ALTER TABLE clients ADD COLUMN {column} VARCHAR(12) NULL"))
+            index = f"ix_clients_{column}"
+            if index not in indexes:
+                print(f"Creating index {index}...")
+                conn.execute(text(f"CREATE INDEX {index} ON clients ({column})"))
+
+
+def backfill(batch_size: int) -> tuple:
+    clients = models.Client.__table__
+    stmt = update(clients).where(clients.c.id == bindparam("client_id")).values(
+        phone_msisdn=bindparam("new_phone_msisdn"), mpesa_msisdn=bindparam("new_mpesa_msisdn")
+    )
+    db = SessionLocal()
+    updated = unparseable = 0
+    last_id = 0
+    try:
+        while True:
+            rows = db.query(
+                models.Client.id, models.Client.phone, models.Client.mpesa_phone,
+                models.Client.phone_msisdn, models.Client.mpesa_msisdn
+            ).filter(models.Client.id > last_id).order_by(models.Client.id).limit(batch_size).all()
+            if not rows:
+                return updated, unparseable
+            last_id = rows[-1][0]
+
+            changes = []
+            for client_id, phone, mpesa_phone, phone_msisdn, mpesa_msisdn in rows:
+                new = (models.normalize_msisdn(phone), models.normalize_msisdn(mpesa_phone))
+                if phone and not new[0]:
+                    unparseable += 1
+                if new != (phone_msisdn, mpesa_msisdn):
+                    changes.append({"client_id": client_id, "new_phone_msisdn": new[0], "new_mpesa_msisdn": new[1]})
+            if changes:
+                db.execute(stmt, changes)
+                db.commit()
+                updated += len(changes)
+            print(f"  up to client #{last_id}: {updated} updated")
+    finally:
+        db.close()
+
+
+def main():
+    args = sys.argv[1:]
+    batch_size = int(args[args.index("--batch") + 1]) if "--batch" in args else DEFAULT_BATCH_SIZE
+
+    started = time.time()
+    ensure_columns()
+    updated, unparseable = backfill(batch_size)
+    print(f"Backfilled {updated} client(s) in {time.time() - started:.1f}s")
+    if unparseable:
+        print(f"{unparseable} client phone number(s) are not valid Kenyan numbers and cannot be matched to payments")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Daraja Simulator
+A local stand-in for Safaricom's Daraja API, for development and load tests.
+Implements OAuth, STK push, B2C, C2B URL registration and simulation,
+account balance and transaction status. Requests are answered at once and
+the result is delivered later as an asynchronous callback to the URL given
+in the request, the way Daraja does, with configurable latency, failure
+and duplicate-delivery rates.
+
+Point the API at it with MPESA_BASE_URL (any consumer key/secret works):
+    python daraja_simulator.py --port 8700 --latency-ms 200-1500 --failure-rate 0.1 --duplicate-rate 0.05
+    python daraja_simulator.py --drop-rate 0.2     # lose STK/B2C results, e.g. for b2c_status_sweeper.py
+    MPESA_BASE_URL=http://127.0.0.1:8700 uvicorn main:app
+
+Extra endpoints:
+    POST /simulate/c2b     {"amount", "msisdn", "bill_ref"[, "shortcode"]}  a customer pays the paybill
+    GET  /simulate/stats   callbacks sent, failed, duplicated, latency
+"""
+
+import asyncio
+import base64
+import os
+import random
+import secrets
+import sys
+import time
+from datetime import datetime
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI(title="Daraja Simulator")
+
+config = {
+    "latency_ms": (200, 1500),  # Delay before each callback
+    "failure_rate": 0.0,  # Share of STK/B2C requests whose callback reports a failure
+    "duplicate_rate": 0.0,  # Share of callbacks delivered twice
+    "drop_rate": 0.0,  # Share of STK/B2C result callbacks never delivered
+    "token_ttl": 3599,
+}
+state = {
+    "tokens": set(),
+    "c2b_urls": {},  # shortcode -> {"confirmation": url, "validation": url}
+    "transactions": {},  # receipt -> callback result, for transaction status queries
+    "conversations": {},  # B2C OriginatorConversationID -> (receipt, succeeded)
+    "stats": {"requests": 0, "callbacks_sent": 0, "callbacks_failed": 0, "duplicates_sent": 0, "callbacks_dropped": 0,
+              "callback_ms_total": 0.0, "callback_ms_max": 0.0},
+}
+_client = None
+_pending = set()
+
+
+def _http() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=200))
+    return _client
+
+
+def receipt() -> str:
+    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    return "S" + "".join(random.choice(alphabet) for _ in range(9))
+
+
+def timestamp() -> str:
+    return datetime.now().strftime("%Y%m%d%H%M%S")
+
+
+def _authorized(request: Request) -> bool:
+    header = request.headers.get("Authorization", "")
+    return header.startswith("Bearer ") and header[7:] in state["tokens"]
+
+
+def _unauthorized():
+    return JSONResponse(status_code=401, content={
+        "requestId": secrets.token_hex(8), "errorCode": "404.001.03", "errorMessage": "Invalid Access Token"
+    })
+
+
+async def _deliver(url: str, payload: dict):
+    low, high = config["latency_ms"]
+    await asyncio.sleep(random.uniform(low, high) / 1000)
+    copies = 2 if random.random() < config["duplicate_rate"] else 1
+    stats = state["stats"]
+    for copy in range(copies):
+        started = time.perf_counter()
+        try:
+            response = await _http().post(url, json=payload)
+            response.raise_for_status()
+        except Exception as e:
+            stats["callbacks_failed"] += 1
+            print(f"Callback to {url} failed: {e}")
+        elapsed = (time.perf_counter() - started) * 1000
+        stats["callbacks_sent"] += 1
+        stats["callback_ms_total"] += elapsed
+        stats["callback_ms_max"] = max(stats["callback_ms_max"], elapsed)
+        if copy:
+            stats["duplicates_sent"] += 1
+
+
+def fire(url: str, payload: dict, droppable: bool = False):
+    """Schedules a callback; keeps a reference so the task is not collected mid-flight."""
+    if not url:
+        return
+    if droppable and random.random() < config["drop_rate"]:
+        state["stats"]["callbacks_dropped"] += 1
+        return
+    task = asyncio.create_task(_deliver(url, payload))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+def _accepted(**extra) -> dict:
+    return {"ConversationID": f"AG_{timestamp()}_{secrets.token_hex(6)}",
+            "OriginatorConversationID": f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1",
+            "ResponseCode": "0", "ResponseDescription": "Accept the service request successfully.", **extra}
+
+
+def _result(command: str, accepted: dict, success: bool, parameters: list, trans_id: str) -> dict:
+    return {"Result": {
+        "ResultType": 0,
+        "ResultCode": 0 if success else 2001,
+        "ResultDesc": "The service request is processed successfully." if success else "The initiator information is invalid.",
+        "OriginatorConversationID": accepted["OriginatorConversationID"],
+        "ConversationID": accepted["ConversationID"],
+        "TransactionID": trans_id,
+        "ResultParameters": {"ResultParameter": parameters} if success else None,
+        "ReferenceData": {"ReferenceItem": {"Key": "QueueTimeoutURL", "Value": command}},
+    }}
+
+
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    state["stats"]["requests"] += 1
+    return await call_next(request)
+
+
+@app.get("/oauth/v1/generate")
+async def generate_token(request: Request):
+    if not request.headers.get("Authorization", "").startswith("Basic "):
+        return JSONResponse(status_code=400, content={"errorCode": "400.008.01", "errorMessage": "Invalid Authentication passed"})
+    token = secrets.token_urlsafe(24)
+    state["tokens"].add(token)
+    return {"access_token": token, "expires_in": str(config["token_ttl"])}
+
+
+@app.post("/mpesa/stkpush/v1/processrequest")
+async def stk_push(request: Request):
+    if not _authorized(request):
+        return _unauthorized()
+    body = await request.json()
+    merchant_id = f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1"
+    checkout_id = f"ws_CO_{timestamp()}{random.randint(100000, 999999)}"
+    success = random.random() >= config["failure_rate"]
+    callback = {"MerchantRequestID": merchant_id, "CheckoutRequestID": checkout_id}
+    if success:
+        code = receipt()
+        callback.update(ResultCode=0, ResultDesc="The service request is processed successfully.", CallbackMetadata={"Item": [
+            {"Name": "Amount", "Value": body.get("Amount")},
+            {"Name": "MpesaReceiptNumber", "Value": code},
+            {"Name": "TransactionDate", "Value": int(timestamp())},
+            {"Name": "PhoneNumber", "Value": int(body.get("PhoneNumber") or 0)},
+        ]})
+        state["transactions"][code] = {"amount": body.get("Amount"), "phone": body.get("PhoneNumber")}
+    else:
+        callback.update(ResultCode=1032, ResultDesc="Request cancelled by user")
+    fire(body.get("CallBackURL"), {"Body": {"stkCallback": callback}}, droppable=True)
+    return {"MerchantRequestID": merchant_id, "CheckoutRequestID": checkout_id, "ResponseCode": "0",
+            "ResponseDescription": "Success. Request accepted for processing", "CustomerMessage": "Success. Request accepted for processing"}
+
+
+@app.post("/mpesa/b2c/v1/paymentrequest")
+async def b2c_payment(request: Request):
+    if not _authorized(request):
+        return _unauthorized()
+    body = await request.json()
+    accepted = _accepted()
+    success = random.random() >= config["failure_rate"]
+    code = receipt()
+    state["conversations"][accepted["OriginatorConversationID"]] = (code, success)
+    if success:
+        state["transactions"][code] = {"amount": body.get("Amount"), "phone": body.get("PartyB")}
+    fire(body.get("ResultURL"), _result("b2c", accepted, success, [
+        {"Key": "TransactionAmount", "Value": body.get("Amount")},
+        {"Key": "TransactionReceipt", "Value": code},
+        {"Key": "ReceiverPartyPublicName", "Value": f"{body.get('PartyB')} - Simulated Customer"},
+        {"Key": "TransactionCompletedDateTime", "Value": datetime.now().strftime("%d.%m.%Y %H:%M:%S")},
+        {"Key": "B2CUtilityAccountAvailableFunds", "Value": 1000000.00},
+    ], code), droppable=True)
+    return accepted
+
+
+@app.post("/mpesa/c2b/v1/registerurl")
+async def register_url(request: Request):
+    if not _authorized(request):
+        return _unauthorized()
+    body = await request.json()
+    state["c2b_urls"][str(body.get("ShortCode"))] = {
+        "confirmation": body.get("ConfirmationURL"), "validation": body.get("ValidationURL")
+    }
+    return {"OriginatorCoversationID": secrets.token_hex(8), "ResponseCode": "0", "ResponseDescription": "Success"}
+
+
+def c2b_payload(amount, msisdn: str, bill_ref: str, shortcode: str) -> dict:
+    return {
+        "TransactionType": "Pay Bill", "TransID": receipt(), "TransTime": timestamp(),
+        "TransAmount": f"{float(amount):.2f}", "BusinessShortCode": shortcode, "BillRefNumber": bill_ref,
+        "InvoiceNumber": "", "OrgAccountBalance": "", "ThirdPartyTransID": "",
+        "MSISDN": msisdn, "FirstName": "SIMULATED", "MiddleName": "", "LastName": "CUSTOMER",
+    }
+
+
+@app.post("/mpesa/c2b/v1/simulate")
+async def c2b_simulate(request: Request):
+    """Daraja's sandbox simulate endpoint: a customer pays the registered shortcode."""
+    if not _authorized(request):
+        return _unauthorized()
+    body = await request.json()
+    return _simulate_c2b(body.get("Amount"), str(body.get("Msisdn")), body.get("BillRefNumber", ""), str(body.get("ShortCode")))
+
+
+@app.post("/simulate/c2b")
+async def simulate_c2b(request: Request):
+    body = await request.json()
+    return _simulate_c2b(body.get("amount"), str(body.get("msisdn")), body.get("bill_ref", ""), str(body.get("shortcode", "")))
+
+
+def _simulate_c2b(amount, msisdn: str, bill_ref: str, shortcode: str):
+    urls = state["c2b_urls"].get(shortcode) or next(iter(state["c2b_urls"].values()), None)
+    if not urls:
+        return JSONResponse(status_code=400, content={"errorMessage": "No C2B URLs registered; call registerurl first"})
+    payload = c2b_payload(amount, msisdn, bill_ref, shortcode)
+    state["transactions"][payload["TransID"]] = {"amount": amount, "phone": msisdn}
+    fire(urls["confirmation"], payload)
+    return {"ConversationID": f"AG_{timestamp()}_{secrets.token_hex(6)}", "TransID": payload["TransID"],
+            "ResponseCode": "0", "ResponseDescription": "Accept the service request successfully."}
+
+
+@app.post("/mpesa/accountbalance/v1/query")
+async def account_balance(request: Request):
+    if not _authorized(request):
+        return _unauthorized()
+    body = await request.json()
+    accepted = _accepted()
+    fire(body.get("ResultURL"), _result("balance", accepted, True, [
+        {"Key": "AccountBalance", "Value": "Working Account|KES|1000000.00|1000000.00|0.00|0.00&Utility Account|KES|250000.00|250000.00|0.00|0.00"},
+        {"Key": "BOCompletedTime", "Value": int(timestamp())},
+    ], receipt()))
+    return accepted
+
+
+@app.post("/mpesa/transactionstatus/v1/query")
+async def transaction_status(request: Request):
+    if not _authorized(request):
+        return _unauthorized()
+    body = await request.json()
+    accepted = _accepted()
+    # By receipt, or by the OriginatorConversationID of a B2C request
+    code, succeeded = body.get("TransactionID"), True
+    if body.get("OriginalConversationID") in state["conversations"]:
+        code, succeeded = state["conversations"][body["OriginalConversationID"]]
+    known = state["transactions"].get(code) if succeeded else {}
+    fire(body.get("ResultURL"), _result("status", accepted, known is not None, [
+        {"Key": "ReceiptNo", "Value": code},
+        {"Key": "TransactionStatus", "Value": "Completed" if succeeded else "Failed"},
+        {"Key": "Amount", "Value": (known or {}).get("amount")},
+        {"Key": "DebitPartyName", "Value": f"{(known or {}).get('phone')} - Simulated Customer"},
+        {"Key": "FinalisedTime", "Value": int(timestamp())},
+    ], code))
+    return accepted
+
+
+@app.get("/simulate/stats")
+async def stats():
+    s = state["stats"]
+    sent = s["callbacks_sent"]
+    return {**{k: v for k, v in s.items() if k != "callback_ms_total"},
+            "callback_ms_avg": round(s["callback_ms_total"] / sent, 1) if sent else None,
+            "callbacks_in_flight": len(_pending), "config": config}
+
+
+def main():
+    import uvicorn
+
+    args = sys.argv[1:]
+    port = int(args[args.index("--port") + 1]) if "--port" in args else int(os.getenv("DARAJA_SIMULATOR_PORT", 8700))
+    if "--latency-ms" in args:
+        low, _, high = args[args.index("--latency-ms") + 1].partition("-")
+        config["latency_ms"] = (float(low), float(high or low))
+    if "--failure-rate" in args:
+        config["failure_rate"] = float(args[args.index("--failure-rate") + 1])
+    if "--duplicate-rate" in args:
+        config["duplicate_rate"] = float(args[args.index("--duplicate-rate") + 1])
+    if "--drop-rate" in args:
+        config["drop_rate"] = float(args[args.index("--drop-rate") + 1])
+    if "--seed" in args:
+        random.seed(int(args[args.index("--seed") + 1]))
+    print(f"Daraja simulator on http://127.0.0.1:{port} with {config}")
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,10 @@ load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 engine = create_engine(DATABASE_URL)
+
+# Each tenant runs its own backend against its own database; this key
+# identifies the tenant for in-process caches and local data directories.
+TENANT_KEY = os.getenv("TENANT_KEY") or engine.url.database or "default"
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
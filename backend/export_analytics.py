@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Analytics Store Exporter
+Incrementally copies loans, repayments, clients, expenses, disbursements and
+M-Pesa transactions into a local DuckDB file for heavy historical queries.
+
+Usage (from the backend directory, with the same environment as the API):
+    python export_analytics.py                 # sync all tables once
+    python export_analytics.py loans clients   # sync selected tables
+    python export_analytics.py --every 900     # keep syncing every 15 minutes
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from database import SessionLocal
+from services.analytics_store import export_all, store_path, SYNC_TABLES
+
+def run_export(tables=None):
+    db = SessionLocal()
+    try:
+        started = time.time()
+        copied = export_all(db, tables)
+        for table, count in copied.items():
+            print(f"  {table}: {count} row(s) copied")
+        print(f"Exported to {store_path()} in {time.time() - started:.1f}s")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    interval = None
+    if "--every" in args:
+        i = args.index("--every")
+        interval = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
+
+    unknown = [t for t in args if t not in SYNC_TABLES]
+    if unknown:
+        print(f"Unknown table(s): {', '.join(unknown)}. Choose from: {', '.join(SYNC_TABLES)}")
+        sys.exit(1)
+
+    while True:
+        try:
+            run_export(args or None)
+        except Exception as e:
+            print(f"Analytics export failed: {e}")
+            if interval is None:
+                sys.exit(1)
+        if interval is None:
+            break
+        time.sleep(interval)
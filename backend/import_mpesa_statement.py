@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+M-Pesa Statement Import
+Loads a paybill statement downloaded from the M-Pesa portal (CSV or XLSX)
+and prints the daily reconciliation (see services/mpesa_statement.py).
+Customer payments we never received a callback for are added to the
+unmatched queue, for review at /mpesa/reconciliation/proposals. Safe to
+run again on the same or an overlapping statement.
+
+Usage (from the backend directory, with the tenant's environment):
+    python import_mpesa_statement.py statements/2026-09.csv
+    python import_mpesa_statement.py statements/2026-09.xlsx --batch 5000
+    python import_mpesa_statement.py statement.csv --database-url sqlite:///data/bench.db
+"""
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+if "--database-url" in sys.argv:
+    # Must be set before database.py creates the engine
+    os.environ["DATABASE_URL"] = sys.argv[sys.argv.index("--database-url") + 1]
+
+import models
+from database import SessionLocal, engine
+from services import mpesa_statement
+
+def main():
+    args = sys.argv[1:]
+    paths = [a for i, a in enumerate(args) if not a.startswith("--") and (i == 0 or args[i - 1] not in ("--batch", "--database-url"))]
+    if not paths:
+        sys.exit(__doc__)
+    batch_size = int(args[args.index("--batch") + 1]) if "--batch" in args else mpesa_statement.STATEMENT_BATCH_SIZE
+    models.Base.metadata.create_all(bind=engine)
+
+    db = SessionLocal()
+    try:
+        for path in paths:
+            filename = os.path.basename(path)
+            record = models.MpesaStatementImport(filename=filename, status="running")
+            db.add(record)
+            db.commit()
+
+            started = time.time()
+            with open(path, "rb") as f:
+                mpesa_statement.run_import(db, record, f, filename, batch_size)
+            if record.status == "failed":
+                print(f"{filename}: import failed: {record.error_message}")
+                sys.exit(1)
+            print(f"{filename}: {record.total_lines} line(s) in {time.time() - started:.1f}s, "
+                  f"{record.imported} receipt(s) added, {record.already_recorded} already recorded, {record.skipped} skipped")
+
+            print(f"{'Date':<12}{'Paid in':>14}{'Posted':>14}{'Difference':>14}{'Added':>7}{'Unmatched':>10}"
+                  f"{'B2C out':>14}{'Disbursed':>14}{'Difference':>14}")
+            for day in json.loads(record.reconciliation or "[]"):
+                print(f"{day['date']:<12}{day['statement_paid_in']:>14,.2f}{day['repayments_posted']:>14,.2f}"
+                      f"{day['paid_in_difference']:>14,.2f}{day['imported_count']:>7}{day['unmatched_count']:>10}"
+                      f"{day['statement_b2c']:>14,.2f}{day['disbursements_completed']:>14,.2f}"
+                      f"{day['disbursement_difference']:>14,.2f}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -37,13 +37,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Age", "ETag", "X-Report-Cache", "X-Report-Source"],
 )
 
 # Import routers
 from routers import (
     users, clients, loans, loan_products, dashboard, 
     branches, customer_groups, upload, expenses, 
-    reports, mpesa, settings, disbursements, organization_config, notifications
+    reports, mpesa, settings, disbursements, organization_config, notifications,
+    report_jobs, exports
 )
 
 # Register routers
@@ -53,6 +55,7 @@ app.include_router(loan_products.router, prefix="/api")
 app.include_router(loans.router, prefix="/api")
 app.include_router(expenses.router, prefix="/api")
 app.include_router(reports.router, prefix="/api")
+app.include_router(report_jobs.router, prefix="/api")
 app.include_router(dashboard.router, prefix="/api")
 app.include_router(branches.router, prefix="/api")
 app.include_router(customer_groups.router, prefix="/api")
@@ -62,6 +65,15 @@ app.include_router(settings.router, prefix="/api")
 app.include_router(disbursements.router, prefix="/api")
 app.include_router(organization_config.router, prefix="/api")
 app.include_router(notifications.router, prefix="/api")
+app.include_router(exports.router, prefix="/api")
+
+from services.mpesa_service import close_http_session, close_async_http_client
+
+@app.on_event("shutdown")
+async def close_mpesa_connections():
+    # Pooled keep-alive connections to Daraja
+    close_http_session()
+    await close_async_http_client()
 
 
 
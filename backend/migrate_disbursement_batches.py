@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Disbursement Batches Migration
+Creates the disbursement_batches table (or adds its
+request_fingerprint column) and adds disbursement_transactions.batch_id
+(with its index) to an existing database, for batch B2C disbursement
+(POST /mpesa/b2c/batches).
+
+Usage (from the backend directory, with the tenant's environment):
+    python migrate_disbursement_batches.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect, text
+
+import models
+from database import engine
+
+
+def main():
+    models.Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    columns = {c["name"] for c in inspector.get_columns("disbursement_transactions")}
+    indexes = {i["name"] for i in inspector.get_indexes("disbursement_transactions")}
+    batch_columns = {c["name"] for c in inspector.get_columns("disbursement_batches")}
+    with engine.begin() as conn:
+        if "request_fingerprint" not in batch_columns:
+            print("Adding disbursement_batches.request_fingerprint...")
+            conn.execute(text("ALTER TABLE disbursement_batches ADD COLUMN request_fingerprint VARCHAR(64) NULL"))
+        if "batch_id" not in columns:
+            print("Adding disbursement_transactions.batch_id...")
+            conn.execute(text("ALTER TABLE disbursement_transactions ADD COLUMN batch_id INTEGER NULL"))
+        if "ix_disbursement_transactions_batch_id" not in indexes:
+            print("Creating index ix_disbursement_transactions_batch_id...")
+            conn.execute(text("CREATE INDEX ix_disbursement_transactions_batch_id ON disbursement_transactions (batch_id)"))
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Disbursement Status Checks Migration
+Adds the disbursement_transactions columns used by b2c_status_sweeper.py
+(status_query_conversation_id with its index, status_checks,
+status_checked_at) to an existing database.
+
+Usage (from the backend directory, with the tenant's environment):
+    python migrate_disbursement_status_checks.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect, text
+
+import models
+from database import engine
+
+COLUMNS = [
+    ("status_query_conversation_id", "VARCHAR(100) NULL"),
+    ("status_checks", "INTEGER DEFAULT 0"),
+    ("status_checked_at", "DATETIME NULL"),
+]
+INDEX = "ix_disbursement_transactions_status_query_conversation_id"
+
+
+def main():
+    models.Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    columns = {c["name"] for c in inspector.get_columns("disbursement_transactions")}
+    indexes = {i["name"] for i in inspector.get_indexes("disbursement_transactions")}
+    with engine.begin() as conn:
+        for column, ddl in COLUMNS:
+            if column not in columns:
+                print(f"Adding disbursement_transactions.{column}...")
+                conn.execute(text(f"ALTER TABLE disbursement_transactions ADD COLUMN {column} {ddl}"))
+        if INDEX not in indexes:
+            print(f"Creating index {INDEX}...")
+            conn.execute(text(f"CREATE INDEX {INDEX} ON disbursement_transactions (status_query_conversation_id)"))
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
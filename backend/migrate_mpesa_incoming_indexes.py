@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+M-Pesa Incoming Transaction Indexes Migration
+Creates the mpesa_incoming_transactions indexes behind the paginated,
+filterable unmatched queue (GET /mpesa/transactions/unmatched) on an
+existing database.
+
+Usage (from the backend directory, with the tenant's environment):
+    python migrate_mpesa_incoming_indexes.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect
+
+import models
+from database import engine
+
+
+def main():
+    models.Base.metadata.create_all(bind=engine)
+    existing = {i["name"] for i in inspect(engine).get_indexes("mpesa_incoming_transactions")}
+    for index in models.MpesaIncomingTransaction.__table__.indexes:
+        if index.name and index.name not in existing:
+            print(f"Creating index {index.name}...")
+            index.create(bind=engine)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Repayment M-Pesa Columns Migration
+Adds repayments.mpesa_transaction_id / repayments.payment_method (and
+mpesa_callback_inbox.transaction_id) to an existing database, fills them
+for repayments already linked from mpesa_incoming_transactions, and then
+creates the unique indexes that make callback processing idempotent.
+
+Usage (from the backend directory, with the tenant's environment):
+    python migrate_repayment_mpesa.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect, text
+
+import models
+from database import SessionLocal, engine
+
+# table -> [(column, DDL type, unique index name)]
+COLUMNS = {
+    "repayments": [
+        ("mpesa_transaction_id", "VARCHAR(100) NULL", "ux_repayments_mpesa_transaction_id"),
+        ("payment_method", "VARCHAR(20) DEFAULT 'manual'", None),
+    ],
+    "mpesa_callback_inbox": [
+        ("transaction_id", "VARCHAR(100) NULL", "ux_mpesa_callback_inbox_transaction_id"),
+    ],
+}
+
+
+def add_columns():
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table, columns in COLUMNS.items():
+            if table not in tables:
+                continue  # create_all will build it complete
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            for column, ddl, _ in columns:
+                if column not in existing:
+                    print(f"Adding {table}.{column}...")
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def backfill_repayments() -> int:
+    db = SessionLocal()
+    try:
+        linked = db.query(models.MpesaIncomingTransaction.repayment_id, models.MpesaIncomingTransaction.transaction_id)\
+            .filter(models.MpesaIncomingTransaction.repayment_id.isnot(None)).subquery()
+        updated = db.query(models.Repayment).filter(
+            models.Repayment.id == linked.c.repayment_id,
+            models.Repayment.mpesa_transaction_id.is_(None)
+        ).update({
+            models.Repayment.mpesa_transaction_id: linked.c.transaction_id,
+            models.Repayment.payment_method: "mpesa"
+        }, synchronize_session=False)
+        db.query(models.Repayment).filter(models.Repayment.payment_method.is_(None))\
+            .update({models.Repayment.payment_method: "manual"}, synchronize_session=False)
+        db.commit()
+        return updated
+    finally:
+        db.close()
+
+
+def create_unique_indexes() -> bool:
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    ok = True
+    for table, columns in COLUMNS.items():
+        if table not in tables:
+            continue
+        indexed = {tuple(i["column_names"]) for i in inspector.get_indexes(table) if i.get("unique")}
+        indexed |= {tuple(u["column_names"]) for u in inspector.get_unique_constraints(table)}
+        for column, _, index in columns:
+            if not index or (column,) in indexed:
+                continue
+            with engine.connect() as conn:
+                duplicates = conn.execute(text(
+                    f"SELECT {column}, COUNT(*) FROM {table} WHERE {column} IS NOT NULL "
+                    f"GROUP BY {column} HAVING COUNT(*) > 1"
+                )).fetchall()
+            if duplicates:
+                ok = False
+                print(f"Cannot index {table}.{column}: {len(duplicates)} duplicated value(s), e.g. {duplicates[0][0]}")
+                continue
+            print(f"Creating unique index {index}...")
+            with engine.begin() as conn:
+                conn.execute(text(f"CREATE UNIQUE INDEX {index} ON {table} ({column})"))
+    return ok
+
+
+def main():
+    models.Base.metadata.create_all(bind=engine)
+    add_columns()
+    updated = backfill_repayments()
+    print(f"Linked {updated} repayment(s) to their M-Pesa transaction")
+    if not create_unique_indexes():
+        print("Resolve the duplicates above and run again.")
+        sys.exit(1)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
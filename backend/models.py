@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Boolean, Date, Text
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, Numeric, ForeignKey, DateTime, Boolean, Date, Text, Index
+from sqlalchemy.orm import relationship, validates
 from database import Base
 from datetime import datetime
+import re
 
 class User(Base):
     __tablename__ = "users"
@@ -16,6 +17,17 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     last_login = Column(DateTime, nullable=True)
 
+def normalize_msisdn(phone):
+    """Canonical 2547XXXXXXXX form of a Kenyan number, or None if it is not one."""
+    digits = re.sub(r"\D", "", str(phone or ""))
+    if len(digits) == 12 and digits.startswith("254"):
+        return digits
+    if len(digits) == 10 and digits.startswith("0"):
+        return "254" + digits[1:]
+    if len(digits) == 9:
+        return "254" + digits
+    return None
+
 class Client(Base):
     __tablename__ = "clients"
 
@@ -46,11 +58,15 @@ class Client(Base):
     
     created_at = Column(DateTime, default=datetime.utcnow)
     joined_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     next_of_kin = relationship("NextOfKin", back_populates="client")
     
     # Payment details
     mpesa_phone = Column(String(20), nullable=True)
+    # 254-format copies of phone / mpesa_phone for exact, indexed payment matching
+    phone_msisdn = Column(String(12), nullable=True, index=True)
+    mpesa_msisdn = Column(String(12), nullable=True, index=True)
     bank_name = Column(String(100), nullable=True)
     bank_account_number = Column(String(50), nullable=True)
     bank_account_name = Column(String(255), nullable=True)
@@ -60,6 +76,11 @@ class Client(Base):
     loans = relationship("Loan", back_populates="client")
     kyc_documents = relationship("ClientKYCDocument", back_populates="client")
 
+    @validates("phone", "mpesa_phone")
+    def _set_msisdn(self, key, value):
+        setattr(self, "phone_msisdn" if key == "phone" else "mpesa_msisdn", normalize_msisdn(value))
+        return value
+
 class ClientKYCDocument(Base):
     __tablename__ = "client_kyc_documents"
 
@@ -124,6 +145,7 @@ class Loan(Base):
     approved_at = Column(DateTime, nullable=True)
     rejected_at = Column(DateTime, nullable=True)
     rejection_reason = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     client = relationship("Client", back_populates="loans")
     product = relationship("LoanProduct")
@@ -159,10 +181,9 @@ class Repayment(Base):
     payment_date = Column(Date)
     notes = Column(Text, nullable=True)
     
-    # M-Pesa specific
-    # M-Pesa specific - Temporarily disabled due to schema mismatch
-    # mpesa_transaction_id = Column(String(100), nullable=True, unique=True)
-    # payment_method = Column(String(20), default="manual") # manual, mpesa, cash
+    # M-Pesa specific (existing databases: run migrate_repayment_mpesa.py)
+    mpesa_transaction_id = Column(String(100), nullable=True, unique=True)
+    payment_method = Column(String(20), default="manual") # manual, mpesa, cash
 
     loan = relationship("Loan", back_populates="repayments")
 
@@ -183,6 +204,85 @@ class MpesaIncomingTransaction(Base):
     loan_id = Column(Integer, ForeignKey("loans.id"), nullable=True)
     repayment_id = Column(Integer, ForeignKey("repayments.id"), nullable=True)
 
+    # The unmatched queue pages by id and filters by phone, reference prefix and date
+    __table_args__ = (
+        Index("ix_mpesa_incoming_status_id", "status", "id"),
+        Index("ix_mpesa_incoming_status_phone", "status", "phone"),
+        Index("ix_mpesa_incoming_status_bill_ref", "status", "bill_ref"),
+        Index("ix_mpesa_incoming_status_created_at", "status", "created_at"),
+    )
+
+class MpesaCallbackInbox(Base):
+    __tablename__ = "mpesa_callback_inbox"
+
+    # Callbacks are stored as received and acknowledged; mpesa_inbox_worker.py matches them
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(20), default="c2b") # c2b
+    transaction_id = Column(String(100), nullable=True, unique=True) # TransID; re-deliveries are not stored twice
+    msisdn = Column(String(20), default="") # Payer, for in-order processing per phone
+    payload = Column(Text) # Raw request body
+    status = Column(String(20), default="pending") # pending, processing, done, failed
+    attempts = Column(Integer, default=0)
+    error_message = Column(Text, nullable=True)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    claimed_at = Column(DateTime, nullable=True)
+    processed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_mpesa_callback_inbox_status", "status", "id"),
+        Index("ix_mpesa_callback_inbox_msisdn", "msisdn", "status"),
+    )
+
+
+class WorkerLock(Base):
+    __tablename__ = "worker_locks"
+
+    # Named rows that workers update to serialize a critical section across processes
+    name = Column(String(50), primary_key=True)
+    locked_at = Column(DateTime, nullable=True)
+
+
+
+class StkRequest(Base):
+    __tablename__ = "stk_requests"
+
+    # One row per STK push sent; the callback finds its loan by CheckoutRequestID
+    id = Column(Integer, primary_key=True, index=True)
+    checkout_request_id = Column(String(100), unique=True, index=True)
+    merchant_request_id = Column(String(100), nullable=True)
+    loan_id = Column(Integer, ForeignKey("loans.id"), index=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=True)
+    phone = Column(String(20))
+    amount = Column(Float)
+    status = Column(String(20), default="pending") # pending, completed, failed, cancelled
+    result_code = Column(Integer, nullable=True)
+    result_desc = Column(String(255), nullable=True)
+    mpesa_receipt = Column(String(100), nullable=True)
+    repayment_id = Column(Integer, ForeignKey("repayments.id"), nullable=True)
+    initiated_by = Column(Integer, ForeignKey("users.id"), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+
+
+class MpesaStatementImport(Base):
+    __tablename__ = "mpesa_statement_imports"
+
+    # A paybill statement loaded from the M-Pesa portal (services/mpesa_statement.py)
+    id = Column(Integer, primary_key=True, index=True)
+    filename = Column(String(255))
+    status = Column(String(20), default="running") # running, completed, failed
+    total_lines = Column(Integer, default=0)
+    imported = Column(Integer, default=0) # Receipts whose callback never arrived, added as unmatched
+    already_recorded = Column(Integer, default=0)
+    skipped = Column(Integer, default=0) # Not completed, or not a customer payment
+    period_start = Column(Date, nullable=True)
+    period_end = Column(Date, nullable=True)
+    reconciliation = Column(Text, nullable=True) # JSON: one row per statement day
+    error_message = Column(Text, nullable=True)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+
 
 class ExpenseCategory(Base):
     __tablename__ = "expense_categories"
@@ -269,10 +369,16 @@ class DisbursementTransaction(Base):
     bank_reference = Column(String(100), nullable=True)
     
     # Status tracking
-    status = Column(String(20), default="pending")  # pending, processing, completed, failed
+    status = Column(String(20), default="pending")  # pending, submitting, processing, completed, failed
     initiated_by = Column(Integer, ForeignKey("users.id"))
+    batch_id = Column(Integer, ForeignKey("disbursement_batches.id"), nullable=True, index=True)
     initiated_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
+
+    # Transaction status queries sent for a result callback that never came (b2c_status_sweeper.py)
+    status_query_conversation_id = Column(String(100), nullable=True, index=True)
+    status_checks = Column(Integer, default=0)
+    status_checked_at = Column(DateTime, nullable=True)
     
     # Response data
     error_message = Column(Text, nullable=True)
@@ -282,6 +388,22 @@ class DisbursementTransaction(Base):
     client = relationship("Client")
     user = relationship("User")
 
+class DisbursementBatch(Base):
+    __tablename__ = "disbursement_batches"
+
+    # A set of approved loans paid out together over B2C (services/b2c_batches.py);
+    # per-loan progress is on the batch's DisbursementTransaction rows
+    id = Column(Integer, primary_key=True, index=True)
+    idempotency_key = Column(String(100), nullable=True, unique=True) # Retried requests return the same batch
+    request_fingerprint = Column(String(64), nullable=True) # Of the requested loan ids; a key reused for other loans is refused
+    status = Column(String(20), default="queued") # queued, running, submitted, partial (items left pending; resume)
+    total_count = Column(Integer, default=0)
+    total_amount = Column(Float, default=0.0)
+    created_by = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+
 
 
 # --- NEW TABLES FOR FEATURE REPLICATION ---
@@ -432,6 +554,78 @@ class OrganizationConfig(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class ReportJob(Base):
+    __tablename__ = "report_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    report_type = Column(String(50)) # profit-loss, portfolio-at-risk, portfolio-health, disbursement-history
+    params = Column(Text, nullable=True) # JSON string
+    format = Column(String(10), default="json") # json, xlsx, pdf
+    status = Column(String(20), default="queued", index=True) # queued, running, completed, failed, expired
+    requested_by = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=True)
+
+    # Result file on local disk (JSON is stored gzipped)
+    result_path = Column(String(500), nullable=True)
+    result_size = Column(Integer, nullable=True)
+    error_message = Column(Text, nullable=True)
+
+class DashboardCounter(Base):
+    __tablename__ = "dashboard_counters"
+
+    # One row per tenant, kept in step with loan/client/expense writes
+    tenant_key = Column(String(100), primary_key=True)
+    total_disbursed = Column(Float, default=0.0) # Sum of active + completed loan amounts
+    total_revenue = Column(Float, default=0.0) # Interest on active + completed loans
+    total_expenses = Column(Float, default=0.0)
+    active_clients = Column(Integer, default=0)
+    active_loans = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    reconciled_at = Column(DateTime, nullable=True)
+
+class ReportCacheInvalidation(Base):
+    __tablename__ = "report_cache_invalidations"
+
+    # Written by each process, at most every REPORT_CACHE_SYNC_SECONDS, for the
+    # report tables its commits touched, so every process's in-memory report
+    # cache can drop stale entries (services/report_cache.py)
+    id = Column(Integer, primary_key=True, index=True)
+    table_name = Column(String(50))
+    source = Column(String(50)) # Writing process; it has already invalidated its own cache
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class LoanDueStatus(Base):
+    __tablename__ = "loan_due_status"
+
+    # Next-due position of each active loan as of `as_of`, refreshed on repayment
+    # and loan writes and daily (services/collection_sheet.py). Client fields are
+    # copied in so collection sheets filter and paginate on one index.
+    loan_id = Column(Integer, ForeignKey("loans.id"), primary_key=True)
+    client_id = Column(Integer, ForeignKey("clients.id"))
+    branch_id = Column(Integer, nullable=True)
+    officer_id = Column(Integer, nullable=True) # Client.created_by_id
+    customer_group_id = Column(Integer, nullable=True)
+    next_due_date = Column(Date, nullable=True) # First installment not fully paid
+    installment_amount = Column(Float, default=0.0)
+    # Exact cents, so the arrears cursor compares equal to the stored value
+    amount_due = Column(Numeric(14, 2, asdecimal=False), default=0.0) # Unpaid installments due on or before as_of
+    days_overdue = Column(Integer, default=0)
+    aging_bucket = Column(String(20), default="current") # loan_schedule.PAR_BUCKETS
+    balance = Column(Float, default=0.0)
+    last_payment_date = Column(Date, nullable=True)
+    as_of = Column(Date, index=True)
+
+    __table_args__ = (
+        Index("ix_loan_due_status_due", "next_due_date", "loan_id"),
+        Index("ix_loan_due_status_branch", "branch_id", "next_due_date", "loan_id"),
+        Index("ix_loan_due_status_officer", "officer_id", "next_due_date", "loan_id"),
+        Index("ix_loan_due_status_group", "customer_group_id", "next_due_date", "loan_id"),
+        Index("ix_loan_due_status_aging", "aging_bucket", "amount_due", "loan_id"),
+    )
+
 class Notification(Base):
     __tablename__ = "notifications"
 
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+M-Pesa Callback Inbox Worker
+Drains callbacks stored by /mpesa/c2b/confirmation (see
+services/mpesa_inbox.py): matches each payment to a registration or loan
+and records the repayment, in arrival order per paying phone. Failed
+callbacks are retried a few times, then left as 'failed' for review.
+
+Usage (from the backend directory, with the same environment as the API):
+    python mpesa_inbox_worker.py                 # run forever
+    python mpesa_inbox_worker.py --once          # drain the inbox and exit
+    python mpesa_inbox_worker.py --batch 500     # callbacks claimed per batch
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import models
+from database import SessionLocal, engine
+from services import mpesa_inbox, report_cache
+# Imported for their Session hooks, so repayments recorded here refresh
+# loan_due_status and the dashboard counters as they do in the API, and
+# report_cache logs them for the API processes' caches
+from services import collection_sheet, dashboard_counters  # noqa: F401
+
+POLL_INTERVAL_SECONDS = float(os.getenv("MPESA_INBOX_POLL_SECONDS", 1))
+MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("MPESA_INBOX_MAINTENANCE_SECONDS", 300))
+
+def maintain():
+    db = SessionLocal()
+    try:
+        released = mpesa_inbox.release_stale(db)
+        purged = mpesa_inbox.purge_done(db)
+        if released or purged:
+            print(f"Released {released} stale and purged {purged} processed callback(s)")
+        report_cache.purge_invalidations(db)
+        print(f"Callback inbox: {mpesa_inbox.metrics(db)}")
+    finally:
+        db.close()
+
+def drain(batch_size: int) -> int:
+    """Processes batches until the inbox is empty; returns callbacks handled."""
+    handled = 0
+    db = SessionLocal()
+    try:
+        while True:
+            rows = mpesa_inbox.claim_batch(db, batch_size)
+            if not rows:
+                return handled
+            started = time.time()
+            counts = mpesa_inbox.process_batch(db, rows)
+            handled += len(rows)
+            print(f"Processed {len(rows)} callback(s) in {time.time() - started:.2f}s: {counts}")
+            if counts["done"] == 0 and counts["failed"] == 0:
+                # Only retries left; wait for the next poll instead of spinning
+                return handled
+    finally:
+        db.close()
+
+def main(run_once: bool = False, batch_size: int = mpesa_inbox.INBOX_BATCH_SIZE):
+    models.Base.metadata.create_all(bind=engine)
+    last_maintenance = 0
+
+    while True:
+        try:
+            if time.time() - last_maintenance >= MAINTENANCE_INTERVAL_SECONDS:
+                maintain()
+                last_maintenance = time.time()
+            drain(batch_size)
+        except Exception as e:
+            print(f"Callback inbox worker error: {e}")
+        if run_once:
+            break
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    batch_size = mpesa_inbox.INBOX_BATCH_SIZE
+    if "--batch" in args:
+        batch_size = int(args[args.index("--batch") + 1])
+    main(run_once="--once" in args, batch_size=batch_size)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+M-Pesa Callback Load Test
+Replays C2B confirmations against a running API at a fixed rate, the way
+Daraja delivers them (including re-deliveries of the same TransID), and
+reports how fast they were acknowledged. Once the inbox worker has caught
+up it checks every payment landed where it should: on the loan named in the
+account reference, on the payer's only active loan, or unmatched when
+neither identifies a borrower, with exactly one repayment per TransID.
+
+Point it at a disposable tenant, e.g. one filled by generate_synthetic_data.py;
+it records real repayments. For end-to-end runs of STK push and B2C, start
+the API with MPESA_BASE_URL pointing at daraja_simulator.py instead.
+
+Usage (from the backend directory, with the API and mpesa_inbox_worker.py running
+against the same database):
+    python mpesa_load_test.py --database-url sqlite:///data/bench.db --count 20000 --rate 2000
+    python mpesa_load_test.py --target http://127.0.0.1:8000 --concurrency 200 --duplicate-rate 0.05
+    python mpesa_load_test.py --count 5000 --drain     # process the inbox here instead of in a worker
+
+Exits non-zero if any callback was rejected or any payment was misapplied.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import secrets
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+if "--database-url" in sys.argv:
+    # Must be set before database.py creates the engine
+    os.environ["DATABASE_URL"] = sys.argv[sys.argv.index("--database-url") + 1]
+
+import httpx
+from sqlalchemy import func, or_
+
+import models
+from database import SessionLocal
+from daraja_simulator import c2b_payload
+
+CHUNK_SIZE = 900  # Stays under SQLite's bound-parameter limit
+SCENARIOS = (("loan_ref", 0.6), ("phone", 0.3), ("unknown", 0.1))
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def load_targets(db, sample: int) -> dict:
+    """
+    Active loans to pay, by scenario. 'phone' only uses borrowers whose
+    number belongs to no other client and who have a single active loan,
+    so the expected match is unambiguous.
+    """
+    loans = db.query(models.Loan.id, models.Loan.client_id)\
+        .filter(models.Loan.status == "active").order_by(models.Loan.id.desc()).limit(sample).all()
+    if not loans:
+        sys.exit("No active loans in this database; fill it with generate_synthetic_data.py first")
+
+    client_ids = {client_id for _, client_id in loans}
+    msisdns, active_counts = {}, {}
+    for chunk in _chunks(client_ids):
+        for client_id, phone_msisdn, mpesa_msisdn in db.query(
+                models.Client.id, models.Client.phone_msisdn, models.Client.mpesa_msisdn).filter(models.Client.id.in_(chunk)):
+            if mpesa_msisdn or phone_msisdn:
+                msisdns[client_id] = mpesa_msisdn or phone_msisdn
+        active_counts.update(db.query(models.Loan.client_id, func.count(models.Loan.id))
+                             .filter(models.Loan.client_id.in_(chunk), models.Loan.status == "active")
+                             .group_by(models.Loan.client_id))
+
+    owners = {}
+    for chunk in _chunks(set(msisdns.values())):
+        for client_id, phone_msisdn, mpesa_msisdn in db.query(
+                models.Client.id, models.Client.phone_msisdn, models.Client.mpesa_msisdn).filter(
+                or_(models.Client.phone_msisdn.in_(chunk), models.Client.mpesa_msisdn.in_(chunk))):
+            for msisdn in {phone_msisdn, mpesa_msisdn} - {None}:
+                owners.setdefault(msisdn, set()).add(client_id)
+
+    return {
+        "loan_ref": [(loan_id, msisdns.get(client_id)) for loan_id, client_id in loans],
+        "phone": [(loan_id, msisdns[client_id]) for loan_id, client_id in loans
+                  if client_id in msisdns and active_counts.get(client_id) == 1 and owners.get(msisdns[client_id]) == {client_id}],
+    }
+
+
+def build_payments(targets: dict, count: int, shortcode: str) -> list:
+    """(payload, expected loan id or None) per payment."""
+    scenarios = [s for s, _ in SCENARIOS if s == "unknown" or targets.get(s)]
+    weights = [w for s, w in SCENARIOS if s in scenarios]
+    payments = []
+    for _ in range(count):
+        scenario = random.choices(scenarios, weights)[0]
+        amount = random.choice((500, 1000, 1500, 2000, 2500, 5000))
+        if scenario == "loan_ref":
+            loan_id, msisdn = random.choice(targets["loan_ref"])
+            payload = c2b_payload(amount, msisdn or f"2547{random.randint(10000000, 99999999)}", str(loan_id), shortcode)
+        elif scenario == "phone":
+            loan_id, msisdn = random.choice(targets["phone"])
+            payload = c2b_payload(amount, msisdn, f"PAY{random.randint(1000, 9999)}", shortcode)
+        else:
+            # 2549... numbers are not issued to subscribers, so no client can own them
+            loan_id = None
+            payload = c2b_payload(amount, f"2549{random.randint(10000000, 99999999)}", "UNKNOWNREF", shortcode)
+        payload["TransID"] = "LT" + secrets.token_hex(4).upper()
+        payments.append((payload, loan_id))
+    return payments
+
+
+async def replay(target: str, payloads: list, rate: float, concurrency: int) -> dict:
+    """Posts the payloads `rate` per second, at most `concurrency` at a time."""
+    url = f"{target.rstrip('/')}/api/mpesa/c2b/confirmation"
+    latencies, errors = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+    interval = 1.0 / rate if rate > 0 else 0.0
+
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def post(payload):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(url, json=payload)
+                    body = response.json()
+                    if response.status_code != 200 or body.get("ResultCode") != 0:
+                        errors.append(f"{payload['TransID']}: HTTP {response.status_code} {body}")
+                except Exception as e:
+                    errors.append(f"{payload['TransID']}: {e.__class__.__name__} {e}")
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        tasks = []
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for i, payload in enumerate(payloads):
+            delay = started + i * interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(payload)))
+        await asyncio.gather(*tasks)
+        elapsed = loop.time() - started
+
+    return {"latencies": sorted(latencies), "errors": errors, "elapsed": elapsed}
+
+
+def wait_for_inbox(trans_ids: list, timeout: float, drain: bool) -> int:
+    """Waits until every TransID has been processed; returns how many were."""
+    deadline = time.time() + timeout
+    while True:
+        if drain:
+            import mpesa_inbox_worker
+            mpesa_inbox_worker.drain(mpesa_inbox_worker.mpesa_inbox.INBOX_BATCH_SIZE)
+        db = SessionLocal()
+        try:
+            done = sum(db.query(func.count(models.MpesaIncomingTransaction.id))
+                       .filter(models.MpesaIncomingTransaction.transaction_id.in_(chunk)).scalar()
+                       for chunk in _chunks(trans_ids))
+        finally:
+            db.close()
+        if done >= len(trans_ids) or time.time() >= deadline:
+            return done
+        time.sleep(1)
+
+
+def check_matches(expected: dict) -> list:
+    """Problems found comparing where each payment landed with where it should have."""
+    problems = []
+    db = SessionLocal()
+    try:
+        for chunk in _chunks(expected):
+            landed = {trans_id: (status, loan_id) for trans_id, status, loan_id in db.query(
+                models.MpesaIncomingTransaction.transaction_id, models.MpesaIncomingTransaction.status,
+                models.MpesaIncomingTransaction.loan_id).filter(models.MpesaIncomingTransaction.transaction_id.in_(chunk))}
+            repayments = dict(db.query(models.Repayment.mpesa_transaction_id, func.count(models.Repayment.id))
+                              .filter(models.Repayment.mpesa_transaction_id.in_(chunk))
+                              .group_by(models.Repayment.mpesa_transaction_id))
+            for trans_id in chunk:
+                want = expected[trans_id]
+                if trans_id not in landed:
+                    problems.append(f"{trans_id}: never processed")
+                    continue
+                status, loan_id = landed[trans_id]
+                if want is None and status != "unmatched":
+                    problems.append(f"{trans_id}: expected unmatched, got {status} on loan {loan_id}")
+                elif want is not None and (status != "matched" or loan_id != want):
+                    problems.append(f"{trans_id}: expected loan {want}, got {status} on loan {loan_id}")
+                if repayments.get(trans_id, 0) != (0 if want is None else 1):
+                    problems.append(f"{trans_id}: {repayments.get(trans_id, 0)} repayment(s)")
+    finally:
+        db.close()
+    return problems
+
+
+def percentile(values: list, p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def main():
+    args = sys.argv[1:]
+    target = args[args.index("--target") + 1] if "--target" in args else os.getenv("BASE_URL", "http://localhost:8000")
+    count = int(args[args.index("--count") + 1]) if "--count" in args else 10000
+    rate = float(args[args.index("--rate") + 1]) if "--rate" in args else 1000.0
+    concurrency = int(args[args.index("--concurrency") + 1]) if "--concurrency" in args else 100
+    duplicate_rate = float(args[args.index("--duplicate-rate") + 1]) if "--duplicate-rate" in args else 0.05
+    timeout = float(args[args.index("--timeout") + 1]) if "--timeout" in args else 300.0
+    random.seed(int(args[args.index("--seed") + 1]) if "--seed" in args else None)
+
+    db = SessionLocal()
+    try:
+        targets = load_targets(db, sample=min(count, 20000))
+    finally:
+        db.close()
+    payments = build_payments(targets, count, shortcode=os.getenv("MPESA_SHORTCODE", "174379"))
+    expected = {payload["TransID"]: loan_id for payload, loan_id in payments}
+
+    # Re-deliveries arrive a little later, interleaved with new payments
+    slots = []
+    for i, (payload, _) in enumerate(payments):
+        slots.append((i, payload))
+        if random.random() < duplicate_rate:
+            slots.append((i + random.randint(1, 50) + 0.5, payload))
+    payloads = [payload for _, payload in sorted(slots, key=lambda slot: slot[0])]
+
+    print(f"Replaying {len(payloads)} callback(s) ({len(payloads) - count} re-deliveries) "
+          f"to {target} at {rate:.0f}/s, {concurrency} concurrent...")
+    result = asyncio.run(replay(target, payloads, rate, concurrency))
+    latencies = result["latencies"]
+    print(f"Sent in {result['elapsed']:.1f}s ({len(payloads) / max(result['elapsed'], 1e-9):.0f}/s)")
+    print(f"Ack latency ms: p50 {percentile(latencies, 0.50):.1f}  p95 {percentile(latencies, 0.95):.1f}  "
+          f"p99 {percentile(latencies, 0.99):.1f}  max {max(latencies, default=0):.1f}")
+    for error in result["errors"][:10]:
+        print(f"  rejected {error}")
+
+    print("Waiting for the inbox to be processed...")
+    started = time.time()
+    done = wait_for_inbox(list(expected), timeout, drain="--drain" in args)
+    print(f"Processed {done}/{len(expected)} payment(s) in {time.time() - started:.1f}s")
+
+    problems = check_matches(expected)
+    for problem in problems[:20]:
+        print(f"  {problem}")
+    print(f"Match check: {len(expected) - len({p.split(':')[0] for p in problems})}/{len(expected)} correct, "
+          f"{len(result['errors'])} callback(s) rejected")
+    if problems or result["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Dashboard Counter Reconciliation
+Recomputes the dashboard_counters row from the loans, clients and expenses
+tables and corrects any drift (e.g. from bulk SQL edits made outside the API).
+
+Usage (from the backend directory, with the same environment as the API):
+    python reconcile_counters.py               # reconcile once
+    python reconcile_counters.py --every 3600  # reconcile hourly
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import models
+from database import SessionLocal, engine
+from services import dashboard_counters
+
+def run_reconcile():
+    db = SessionLocal()
+    try:
+        drift = dashboard_counters.reconcile(db)
+        if drift:
+            print(f"Corrected dashboard counter drift: {drift}")
+        else:
+            print("Dashboard counters are in sync")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    models.Base.metadata.create_all(bind=engine)
+    interval = None
+    if "--every" in sys.argv:
+        interval = int(sys.argv[sys.argv.index("--every") + 1])
+
+    while True:
+        try:
+            run_reconcile()
+        except Exception as e:
+            print(f"Dashboard counter reconciliation failed: {e}")
+        if interval is None:
+            break
+        time.sleep(interval)
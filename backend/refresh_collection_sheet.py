@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Collection Sheet Refresh
+Rebuilds loan_due_status (the precomputed next-due data behind
+/reports/collection-sheet) for today's date. Run it early each morning so
+the first officer to open the sheet does not pay for the daily roll-over.
+
+Usage (from the backend directory, with the same environment as the API):
+    python refresh_collection_sheet.py               # refresh once
+    python refresh_collection_sheet.py --every 3600  # refresh hourly
+"""
+
+import os
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import models
+from database import SessionLocal, engine
+from services import collection_sheet
+
+def run_refresh():
+    db = SessionLocal()
+    try:
+        started = time.time()
+        written = collection_sheet.refresh(db, date.today())
+        db.commit()
+        print(f"Refreshed {written} loan due status row(s) in {time.time() - started:.1f}s")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    models.Base.metadata.create_all(bind=engine)
+    interval = None
+    if "--every" in sys.argv:
+        interval = int(sys.argv[sys.argv.index("--every") + 1])
+
+    while True:
+        try:
+            run_refresh()
+        except Exception as e:
+            print(f"Collection sheet refresh failed: {e}")
+        if interval is None:
+            break
+        time.sleep(interval)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Report Job Worker
+Executes queued report jobs (see routers/report_jobs.py) outside the API
+process and expires old results. JSON, XLSX and PDF renders run in a pool of
+worker processes so long renders do not block each other.
+
+Usage (from the backend directory, with the same environment as the API):
+    python report_worker.py                 # run forever
+    python report_worker.py --once          # drain the queue and exit
+    python report_worker.py --workers 4     # render up to 4 jobs at a time
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import models
+from database import SessionLocal, engine
+from services.report_jobs import claim_next_job, run_job, expire_jobs
+
+POLL_INTERVAL_SECONDS = int(os.getenv("REPORT_WORKER_POLL_SECONDS", 5))
+EXPIRE_INTERVAL_SECONDS = int(os.getenv("REPORT_WORKER_EXPIRE_SECONDS", 600))
+WORKER_PROCESSES = int(os.getenv("REPORT_WORKER_PROCESSES", 2))
+
+def init_process():
+    # Connections inherited from the parent must not be shared across processes
+    engine.dispose(close=False)
+
+def execute_job(job_id: int):
+    db = SessionLocal()
+    try:
+        job = db.query(models.ReportJob).filter(models.ReportJob.id == job_id).first()
+        started = time.time()
+        job = run_job(db, job)
+        return job_id, job.status, time.time() - started
+    finally:
+        db.close()
+
+def claim_job_id():
+    db = SessionLocal()
+    try:
+        job = claim_next_job(db)
+        if job:
+            print(f"Running report job #{job.id} ({job.report_type}, {job.format})...")
+            return job.id
+        return None
+    finally:
+        db.close()
+
+def expire_results():
+    db = SessionLocal()
+    try:
+        expired = expire_jobs(db)
+        if expired:
+            print(f"Expired {expired} report job result(s)")
+    finally:
+        db.close()
+
+def main(run_once: bool = False, workers: int = WORKER_PROCESSES):
+    models.Base.metadata.create_all(bind=engine)
+    last_expiry = 0
+    running = set()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_process) as pool:
+        while True:
+            try:
+                # Keep every process busy while the queue has work
+                while len(running) < workers:
+                    job_id = claim_job_id()
+                    if job_id is None:
+                        break
+                    running.add(pool.submit(execute_job, job_id))
+
+                # Expire on schedule even while long jobs keep the pool busy
+                if time.time() - last_expiry >= EXPIRE_INTERVAL_SECONDS or (run_once and not running):
+                    expire_results()
+                    last_expiry = time.time()
+
+                if running:
+                    done, running = wait(running, timeout=POLL_INTERVAL_SECONDS, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            job_id, status, elapsed = future.result()
+                            print(f"Report job #{job_id} {status} in {elapsed:.1f}s")
+                        except Exception as e:
+                            print(f"Report worker process error: {e}")
+                    continue
+            except Exception as e:
+                print(f"Report worker error: {e}")
+            if run_once:
+                break
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    workers = WORKER_PROCESSES
+    if "--workers" in args:
+        workers = int(args[args.index("--workers") + 1])
+    main(run_once="--once" in args, workers=workers)
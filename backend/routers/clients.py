@@ -59,8 +59,11 @@ def list_clients(
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
-    query = db.query(models.Client)
-    
+    query = filter_clients(db.query(models.Client), search, branch_id, customer_group_id)
+    return query.offset(skip).limit(limit).all()
+
+def filter_clients(query, search: Optional[str] = None, branch_id: Optional[int] = None, customer_group_id: Optional[int] = None):
+    """Client list filters, shared by the list endpoint and the CSV export."""
     if branch_id:
         query = query.filter(models.Client.branch_id == branch_id)
         
@@ -75,7 +78,7 @@ def list_clients(
             (models.Client.phone.like(search_pattern)) |
             (models.Client.id_number.like(search_pattern))
         )
-    return query.offset(skip).limit(limit).all()
+    return query
 
 @router.get("/{client_id}", response_model=schemas.Client)
 def get_client(
@@ -1,9 +1,19 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import func
-from datetime import datetime
-import models, auth
+from datetime import date, datetime, timedelta
+import models, schemas, auth
 from database import get_db
+from services import dashboard_counters
+from services.dashboard_events import (
+    dashboard_broadcaster, format_event,
+    DASHBOARD_STREAM_HEARTBEAT_SECONDS, DASHBOARD_STREAM_RETRY_MS
+)
+import asyncio
+import hashlib
+import json
 
 router = APIRouter(prefix="/dashboard", tags=["dashboard"])
 
@@ -12,85 +22,153 @@ def get_dashboard_stats(
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
-    # Total loans disbursed (sum of active and completed loans)
-    total_disbursed = db.query(func.sum(models.Loan.amount)).filter(
-        models.Loan.status.in_(["active", "completed"])
-    ).scalar() or 0
-    
-    # Active clients count
-    active_clients = db.query(func.count(models.Client.id)).scalar() or 0
-    
-    # Total revenue (interest from active and completed loans)
-    total_revenue = db.query(
-        func.sum(models.Loan.amount * models.Loan.interest_rate / 100)
-    ).filter(
-        models.Loan.status.in_(["active", "completed"])
-    ).scalar() or 0
-    
-    # Total expenses
-    total_expenses = db.query(func.sum(models.Expense.amount)).scalar() or 0
-    
-    # Active loans count
-    active_loans = db.query(func.count(models.Loan.id)).filter(
-        models.Loan.status == "active"
-    ).scalar() or 0
-    
+    # Maintained incrementally on loan, client and expense writes (services/dashboard_counters.py)
+    return dashboard_counters.as_stats(dashboard_counters.get_counters(db))
+
+@router.post("/stats/reconcile")
+def reconcile_dashboard_stats(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.require_admin)
+):
+    """Recompute the dashboard counters from the base tables and report any drift."""
+    drift = dashboard_counters.reconcile(db)
+    return {"message": "Dashboard counters reconciled", "drift": drift}
+
+@router.get("/bootstrap", response_model=schemas.DashboardBootstrap)
+def get_dashboard_bootstrap(
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """
+    Everything the first screen needs in one request and one DB session:
+    stats, trends, the user's latest notifications, organization config,
+    loan products and branches. The ETag is built from cheap data versions,
+    so an unchanged dashboard is answered with 304 before trends are computed.
+    """
+    from routers.organization_config import get_organization_config
+    from dateutil.relativedelta import relativedelta
+
+    today = date.today()
+    stats = dashboard_counters.as_stats(dashboard_counters.get_counters(db))
+    last_repayment = db.query(func.max(models.Repayment.id)).scalar()
+    notifications = db.query(models.Notification)\
+        .filter(models.Notification.user_id == current_user.id)\
+        .order_by(models.Notification.created_at.desc())\
+        .limit(10).all()
+    reference = {
+        "notifications": [schemas.Notification.model_validate(n) for n in notifications],
+        "organization_config": schemas.OrganizationConfig.model_validate(get_organization_config(db)),
+        "loan_products": [schemas.LoanProduct.model_validate(p) for p in db.query(models.LoanProduct).all()],
+        "branches": [schemas.Branch.model_validate(b) for b in db.query(models.Branch).all()],
+    }
+
+    # Trends move with the counters, new repayments and the calendar month
+    version = json.dumps(
+        [current_user.id, today.isoformat(), stats, last_repayment, jsonable_encoder(reference)],
+        sort_keys=True, default=str
+    )
+    etag = f'W/"{hashlib.sha1(version.encode()).hexdigest()[:24]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
     return {
-        "total_disbursed": float(total_disbursed),
-        "active_clients": active_clients,
-        "total_revenue": float(total_revenue),
-        "total_expenses": float(total_expenses),
-        "active_loans": active_loans,
+        "stats": stats,
+        "trends": [month_trend(db, today - relativedelta(months=i)) for i in range(11, -1, -1)],
+        **reference,
     }
 
+@router.get("/stream")
+async def stream_dashboard(
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """
+    Server-sent events: a `snapshot` of stats and the current month's trend,
+    then `delta` events with only the changed fields as repayments,
+    disbursements, clients and expenses are committed. Reconnecting clients
+    send Last-Event-ID and skip the snapshot if they are still current.
+    """
+    # The session was only needed for authentication; don't hold a pooled
+    # connection for the lifetime of the stream
+    db.close()
+    last_event_id = request.headers.get("last-event-id")
+
+    async def events():
+        queue = await dashboard_broadcaster.subscribe()
+        try:
+            yield f"retry: {DASHBOARD_STREAM_RETRY_MS}\n\n"
+            if last_event_id != str(dashboard_broadcaster.event_id):
+                yield format_event(dashboard_broadcaster.event_id, "snapshot", dashboard_broadcaster.snapshot)
+            while True:
+                try:
+                    event_id, name, data = await asyncio.wait_for(queue.get(), DASHBOARD_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Keeps nginx and mobile carriers from dropping an idle connection
+                    yield ": heartbeat\n\n"
+                    continue
+                yield format_event(event_id, name, data)
+        finally:
+            dashboard_broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Tells the nginx /api/ proxy not to buffer the stream
+        "X-Accel-Buffering": "no",
+    })
+
 @router.get("/trends")
 def get_dashboard_trends(
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
-    from datetime import date, timedelta
     from dateutil.relativedelta import relativedelta
     
     today = date.today()
-    trends = []
     
     # Last 12 months
-    for i in range(11, -1, -1):
-        target_month = today - relativedelta(months=i)
-        start_date = date(target_month.year, target_month.month, 1)
-        end_date = start_date + relativedelta(months=1) - timedelta(days=1)
-        
-        # Disbursed
-        disbursed = db.query(func.sum(models.Loan.amount)).filter(
-            models.Loan.start_date >= start_date,
-            models.Loan.start_date <= end_date,
-            models.Loan.status.in_(["active", "completed"])
-        ).scalar() or 0
-        
-        # Repayments
-        repayments = db.query(func.sum(models.Repayment.amount)).filter(
-            models.Repayment.payment_date >= start_date,
-            models.Repayment.payment_date <= end_date
-        ).scalar() or 0
-        
-        # Expenses
-        expenses = db.query(func.sum(models.Expense.amount)).filter(
-            models.Expense.date >= start_date,
-            models.Expense.date <= end_date
-        ).scalar() or 0
-        
-        # New Clients
-        new_clients = db.query(func.count(models.Client.id)).filter(
-            models.Client.created_at >= datetime(start_date.year, start_date.month, start_date.day),
-            models.Client.created_at <= datetime(end_date.year, end_date.month, end_date.day, 23, 59, 59)
-        ).scalar() or 0
-        
-        trends.append({
-            "month": start_date.strftime("%b %Y"),
-            "disbursed": float(disbursed),
-            "repayments": float(repayments),
-            "expenses": float(expenses),
-            "clients": new_clients
-        })
-        
-    return trends
+    return [month_trend(db, today - relativedelta(months=i)) for i in range(11, -1, -1)]
+
+def month_trend(db: Session, target_month: date) -> dict:
+    """Disbursed, repaid, spent and new clients for the calendar month containing target_month."""
+    from dateutil.relativedelta import relativedelta
+
+    start_date = date(target_month.year, target_month.month, 1)
+    end_date = start_date + relativedelta(months=1) - timedelta(days=1)
+    
+    # Disbursed
+    disbursed = db.query(func.sum(models.Loan.amount)).filter(
+        models.Loan.start_date >= start_date,
+        models.Loan.start_date <= end_date,
+        models.Loan.status.in_(["active", "completed"])
+    ).scalar() or 0
+    
+    # Repayments
+    repayments = db.query(func.sum(models.Repayment.amount)).filter(
+        models.Repayment.payment_date >= start_date,
+        models.Repayment.payment_date <= end_date
+    ).scalar() or 0
+    
+    # Expenses
+    expenses = db.query(func.sum(models.Expense.amount)).filter(
+        models.Expense.date >= start_date,
+        models.Expense.date <= end_date
+    ).scalar() or 0
+    
+    # New Clients
+    new_clients = db.query(func.count(models.Client.id)).filter(
+        models.Client.created_at >= datetime(start_date.year, start_date.month, start_date.day),
+        models.Client.created_at <= datetime(end_date.year, end_date.month, end_date.day, 23, 59, 59)
+    ).scalar() or 0
+    
+    return {
+        "month": start_date.strftime("%b %Y"),
+        "disbursed": float(disbursed),
+        "repayments": float(repayments),
+        "expenses": float(expenses),
+        "clients": new_clients
+    }
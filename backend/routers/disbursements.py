@@ -34,7 +34,7 @@ def disburse_via_mpesa(
     # Check if already disbursed
     existing = db.query(models.DisbursementTransaction).filter(
         models.DisbursementTransaction.loan_id == loan_id,
-        models.DisbursementTransaction.status.in_(["completed", "processing"])
+        models.DisbursementTransaction.status.in_(["pending", "submitting", "processing", "completed"])
     ).first()
     
     if existing:
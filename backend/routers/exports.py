@@ -0,0 +1,106 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy import select
+from typing import Optional
+from datetime import date
+import models, auth
+from services.csv_export import csv_response
+from routers.clients import filter_clients
+from routers.loans import filter_loans
+
+router = APIRouter(prefix="/exports", tags=["exports"])
+
+# Streaming CSV exports. Rows are read in batches with yield_per and written as
+# they arrive, so memory use stays flat regardless of table size.
+
+@router.get("/clients.csv")
+def export_clients(
+    search: Optional[str] = None,
+    branch_id: Optional[int] = None,
+    customer_group_id: Optional[int] = None,
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    def build():
+        stmt = select(
+            models.Client.id, models.Client.first_name, models.Client.last_name,
+            models.Client.phone, models.Client.email, models.Client.id_number,
+            models.Branch.name, models.CustomerGroup.name, models.Client.mpesa_phone,
+            models.Client.status, models.Client.created_at
+        ).outerjoin(models.Branch, models.Branch.id == models.Client.branch_id)\
+         .outerjoin(models.CustomerGroup, models.CustomerGroup.id == models.Client.customer_group_id)
+        return filter_clients(stmt, search, branch_id, customer_group_id).order_by(models.Client.id)
+
+    headers = ["ID", "First Name", "Last Name", "Phone", "Email", "ID Number",
+               "Branch", "Customer Group", "M-Pesa Phone", "Status", "Created At"]
+    return csv_response(build, headers, "clients")
+
+@router.get("/loans.csv")
+def export_loans(
+    status: Optional[str] = None,
+    client_id: Optional[int] = None,
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    def build():
+        stmt = select(
+            models.Loan.id, models.Loan.client_id, models.Client.first_name, models.Client.last_name,
+            models.Client.phone, models.LoanProduct.name, models.Loan.amount, models.Loan.interest_rate,
+            models.Loan.duration_months, models.Loan.repayment_frequency, models.Loan.start_date,
+            models.Loan.end_date, models.Loan.status, models.Loan.approved_at
+        ).outerjoin(models.Client, models.Client.id == models.Loan.client_id)\
+         .outerjoin(models.LoanProduct, models.LoanProduct.id == models.Loan.product_id)
+        return filter_loans(stmt, status, client_id).order_by(models.Loan.id)
+
+    headers = ["Loan ID", "Client ID", "First Name", "Last Name", "Phone", "Product", "Amount",
+               "Interest Rate", "Duration (Months)", "Frequency", "Start Date", "End Date",
+               "Status", "Approved At"]
+    return csv_response(build, headers, "loans")
+
+@router.get("/repayments.csv")
+def export_repayments(
+    loan_id: Optional[int] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    def build():
+        stmt = select(
+            models.Repayment.id, models.Repayment.loan_id, models.Client.first_name,
+            models.Client.last_name, models.Client.phone, models.Repayment.amount,
+            models.Repayment.payment_date, models.Repayment.notes
+        ).join(models.Loan, models.Loan.id == models.Repayment.loan_id)\
+         .outerjoin(models.Client, models.Client.id == models.Loan.client_id)
+        if loan_id:
+            stmt = stmt.where(models.Repayment.loan_id == loan_id)
+        if start_date:
+            stmt = stmt.where(models.Repayment.payment_date >= start_date)
+        if end_date:
+            stmt = stmt.where(models.Repayment.payment_date <= end_date)
+        return stmt.order_by(models.Repayment.id)
+
+    headers = ["Repayment ID", "Loan ID", "First Name", "Last Name", "Phone", "Amount",
+               "Payment Date", "Notes"]
+    return csv_response(build, headers, "repayments")
+
+@router.get("/mpesa-transactions.csv")
+def export_mpesa_transactions(
+    status: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    def build():
+        t = models.MpesaIncomingTransaction
+        stmt = select(
+            t.id, t.transaction_id, t.amount, t.phone, t.bill_ref, t.status,
+            t.client_id, t.loan_id, t.repayment_id, t.created_at
+        )
+        if status:
+            stmt = stmt.where(t.status == status)
+        if start_date:
+            stmt = stmt.where(t.created_at >= start_date)
+        if end_date:
+            stmt = stmt.where(t.created_at < date.fromordinal(end_date.toordinal() + 1))
+        return stmt.order_by(t.id)
+
+    headers = ["ID", "Transaction ID", "Amount", "Phone", "Bill Ref", "Status",
+               "Client ID", "Loan ID", "Repayment ID", "Received At"]
+    return csv_response(build, headers, "mpesa_transactions")
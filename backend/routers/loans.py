@@ -81,12 +81,15 @@ def list_loans(
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
-    query = db.query(models.Loan)
+    return filter_loans(db.query(models.Loan), status, client_id).all()
+
+def filter_loans(query, status: Optional[str] = None, client_id: Optional[int] = None):
+    """Loan list filters, shared by the list endpoint and the CSV export."""
     if status:
         query = query.filter(models.Loan.status == status)
     if client_id:
         query = query.filter(models.Loan.client_id == client_id)
-    return query.all()
+    return query
 
 @router.get("/{loan_id}", response_model=schemas.Loan)
 def get_loan(
@@ -1,12 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, Query, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from datetime import datetime
+from datetime import date, datetime, time, timedelta
 from typing import Optional, List
 import json
+import os
+import shutil
+import tempfile
 import models, schemas, auth
 from database import get_db
 from utils import log_activity, create_notification
-from services.mpesa_service import MpesaService
+from services.mpesa_service import MpesaService, token_cache, service_cache
+from services import mpesa_inbox, mpesa_reconcile, mpesa_statement, b2c_batches, b2c_status
+from routers.disbursements import can_disburse
+from services.msisdn import client_phone_map
+from models import normalize_msisdn
 
 router = APIRouter(prefix="/mpesa", tags=["mpesa"])
 
@@ -14,6 +24,10 @@ router = APIRouter(prefix="/mpesa", tags=["mpesa"])
 REGISTRATION_FEE = 100
 
 def get_mpesa_service(db: Session):
+    """This tenant's MpesaService, rebuilt only after the payment settings change."""
+    return service_cache.get_or_build(lambda: build_mpesa_service(db))
+
+def build_mpesa_service(db: Session):
     # Fetch from settings
     settings = db.query(models.SystemSettings).filter(models.SystemSettings.category == "payment").all()
     config = {s.setting_key: s.setting_value for s in settings}
@@ -25,16 +39,21 @@ def get_mpesa_service(db: Session):
     env = config.get("mpesa_env", "sandbox")
     initiator_name = config.get("mpesa_initiator_name", "testapi")
     initiator_password = config.get("mpesa_initiator_password", "")
+    certificate = config.get("mpesa_certificate") or None
     
-    return MpesaService(
+    service = MpesaService(
         consumer_key=consumer_key,
         consumer_secret=consumer_secret,
         shortcode=shortcode,
         passkey=passkey,
         env=env,
         initiator_name=initiator_name,
-        initiator_password=initiator_password
+        initiator_password=initiator_password,
+        certificate=certificate
     )
+    # Encrypt the initiator credential now rather than on the first B2C call
+    service.security_credential
+    return service
 
 @router.post("/register")
 def submit_registration(
@@ -94,77 +113,68 @@ def submit_registration(
 
 @router.post("/c2b/confirmation")
 async def c2b_confirmation(request: Request, db: Session = Depends(get_db)):
-    """Handle M-Pesa C2B Confirmation - Auto-matching repayments"""
+    """
+    Handle M-Pesa C2B Confirmation. The callback is stored as received and
+    acknowledged straight away; mpesa_inbox_worker.py matches it to a
+    registration or loan and records the repayment.
+    """
     try:
-        data = await request.json()
-        trans_id = data.get('TransID')
-        amount = float(data.get('TransAmount', 0))
-        phone = data.get('MSISDN', '').replace('+', '')
-        bill_ref = data.get('BillRefNumber', '').strip().upper()
-        
-        # Log the incoming transaction
-        incoming = models.MpesaIncomingTransaction(
-            transaction_id=trans_id,
-            amount=amount,
-            phone=phone,
-            bill_ref=bill_ref,
-            raw_callback_data=json.dumps(data),
-            status="unmatched"
-        )
-        db.add(incoming)
-        db.flush()
-
-        # Try to match based on BillRefNumber (Loan Application REG or Loan Ref)
-        if bill_ref.startswith('REG'):
-            try:
-                app_id = int(bill_ref.replace('REG', ''))
-                application = db.query(models.RegistrationApplication).filter(models.RegistrationApplication.id == app_id).first()
-                if application and application.status == "pending":
-                    application.status = "paid"
-                    application.mpesa_transaction_id = trans_id
-                    application.amount_paid = amount
-                    incoming.status = "matched"
-            except: pass
-        
-        # Match based on BillRef as Loan ID if numeric or match phone to active loan
-        if incoming.status == "unmatched":
-            loan = None
-            if bill_ref.isdigit():
-                loan = db.query(models.Loan).filter(models.Loan.id == int(bill_ref), models.Loan.status == "active").first()
-            
-            if not loan:
-                client = db.query(models.Client).filter(models.Client.phone.like(f"%{phone[-9:]}")).first()
-                if client:
-                    loan = db.query(models.Loan).filter(models.Loan.client_id == client.id, models.Loan.status == "active").first()
-            
-            if loan:
-                repayment = models.Repayment(
-                    loan_id=loan.id,
-                    amount=amount,
-                    payment_date=datetime.now().date(),
-                    notes=f"Auto-matched M-Pesa {trans_id}",
-                    mpesa_transaction_id=trans_id,
-                    payment_method="mpesa"
-                )
-                db.add(repayment)
-                db.flush()
-                incoming.status = "matched"
-                incoming.loan_id = loan.id
-                incoming.client_id = loan.client_id
-                incoming.repayment_id = repayment.id
-
-        db.commit()
+        body = await request.body()
+        await run_in_threadpool(mpesa_inbox.enqueue, db, "c2b", body)
         return {"ResultCode": 0, "ResultDesc": "Accepted"}
     except Exception as e:
         db.rollback()
         return {"ResultCode": 1, "ResultDesc": str(e)}
 
-@router.get("/transactions/unmatched", response_model=List[schemas.MpesaIncomingTransaction])
+@router.get("/transactions/unmatched", response_model=schemas.UnmatchedTransactionsPage)
 def get_unmatched_transactions(
+    after: Optional[int] = Query(None, ge=1, description="Resume after this transaction id (next_after of the previous page)"),
+    limit: int = Query(100, ge=1, le=500),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    phone: Optional[str] = None,
+    bill_ref: Optional[str] = Query(None, description="Reference prefix"),
+    include_raw: bool = False,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
-    return db.query(models.MpesaIncomingTransaction).filter(models.MpesaIncomingTransaction.status == "unmatched").all()
+    """
+    Unmatched M-Pesa payments, newest first, a page at a time. Totals for
+    the filters come with the first page; raw callback payloads only with
+    include_raw=true.
+    """
+    incoming = models.MpesaIncomingTransaction
+    filters = [incoming.status == "unmatched"]
+    if date_from:
+        filters.append(incoming.created_at >= datetime.combine(date_from, time.min))
+    if date_to:
+        filters.append(incoming.created_at < datetime.combine(date_to + timedelta(days=1), time.min))
+    if min_amount is not None:
+        filters.append(incoming.amount >= min_amount)
+    if max_amount is not None:
+        filters.append(incoming.amount <= max_amount)
+    if phone:
+        filters.append(incoming.phone == (normalize_msisdn(phone) or phone.strip().lstrip("+")))
+    if bill_ref:
+        filters.append(incoming.bill_ref.startswith(bill_ref.strip().upper(), autoescape=True))
+
+    columns = [incoming.id, incoming.transaction_id, incoming.amount, incoming.phone, incoming.bill_ref,
+               incoming.status, incoming.created_at, incoming.client_id, incoming.loan_id, incoming.repayment_id]
+    if include_raw:
+        columns.append(incoming.raw_callback_data)
+    query = db.query(*columns).filter(*filters)
+    if after:
+        query = query.filter(incoming.id < after)
+    rows = query.order_by(incoming.id.desc()).limit(limit + 1).all()
+
+    result = {"items": rows[:limit], "next_after": rows[limit - 1].id if len(rows) > limit else None}
+    if not after:
+        count, amount = db.query(func.count(incoming.id), func.sum(incoming.amount)).filter(*filters).one()
+        result["total_count"] = count
+        result["total_amount"] = round(float(amount or 0), 2)
+    return result
 
 @router.post("/transactions/{trans_id}/reconcile")
 def manual_reconcile(
@@ -178,6 +188,8 @@ def manual_reconcile(
     
     if not incoming or not loan:
         raise HTTPException(status_code=404, detail="Transaction or Loan not found")
+    if incoming.status != "unmatched":
+        raise HTTPException(status_code=409, detail=f"Transaction is already {incoming.status}")
         
     repayment = models.Repayment(
         loan_id=loan.id,
@@ -188,12 +200,17 @@ def manual_reconcile(
         payment_method="mpesa"
     )
     db.add(repayment)
-    incoming.status = "matched"
-    incoming.loan_id = loan.id
-    incoming.client_id = loan.client_id
-    incoming.repayment_id = repayment.id
-    
-    db.commit()
+    try:
+        db.flush()
+        incoming.status = "matched"
+        incoming.loan_id = loan.id
+        incoming.client_id = loan.client_id
+        incoming.repayment_id = repayment.id
+        db.commit()
+    except IntegrityError:
+        # The receipt was posted as a repayment meanwhile (worker or another reviewer)
+        db.rollback()
+        raise HTTPException(status_code=409, detail="A repayment for this M-Pesa receipt already exists")
     # Log activity
     log_activity(db, current_user.id, "reconcile", "mpesa_transaction", incoming.id, {"loan_id": loan_id})
     
@@ -206,6 +223,45 @@ def manual_reconcile(
     )
     return {"message": "Transaction reconciled successfully"}
 
+@router.get("/reconciliation/proposals", response_model=schemas.ReconciliationProposals)
+def get_reconciliation_proposals(
+    after: int = Query(0, ge=0, description="Resume after this transaction id (next_after of the previous page)"),
+    limit: int = Query(500, ge=1, le=5000),
+    min_confidence: str = Query("low", pattern="^(low|medium|high)$"),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """Proposed loan matches for unmatched M-Pesa payments, for review before bulk acceptance."""
+    return mpesa_reconcile.propose_matches(db, after=after, limit=limit, min_confidence=min_confidence)
+
+@router.post("/reconciliation/accept")
+def accept_reconciliation(
+    payload: schemas.ReconciliationAccept,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """Applies reviewed matches in one transaction: all of them or, if any is invalid, none."""
+    if not payload.matches:
+        raise HTTPException(status_code=400, detail="No matches to accept")
+    try:
+        repayments = mpesa_reconcile.accept_matches(db, [(m.transaction_id, m.loan_id) for m in payload.matches])
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=e.args[0])
+    db.commit()
+
+    total = sum(r.amount or 0 for r in repayments)
+    log_activity(db, current_user.id, "bulk_reconcile", "mpesa_transaction", None,
+                 {"count": len(repayments), "loan_ids": sorted({r.loan_id for r in repayments})})
+    create_notification(
+        db,
+        current_user.id,
+        "M-Pesa Payments Reconciled",
+        f"{len(repayments)} payment(s) totalling KES {total:,.2f} reconciled to loans.",
+        "success"
+    )
+    return {"message": "Transactions reconciled successfully", "reconciled": len(repayments), "total_amount": total}
+
 @router.post("/b2c/disburse/{loan_id}")
 def initiate_disbursement(
     loan_id: int,
@@ -219,6 +275,9 @@ def initiate_disbursement(
     if not loan.client.mpesa_phone:
         raise HTTPException(status_code=400, detail="Client has no M-Pesa phone number")
 
+    if b2c_batches.active_disbursement_loan_ids(db, [loan.id]):
+        raise HTTPException(status_code=400, detail="Loan already disbursed or in progress")
+
     # Create disbursement transaction
     trans = models.DisbursementTransaction(
         loan_id=loan.id,
@@ -266,6 +325,86 @@ def initiate_disbursement(
         db.commit()
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/b2c/batches")
+def create_disbursement_batch(
+    payload: schemas.DisbursementBatchCreate,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """
+    Disburses a set of approved loans over B2C. Disbursements are created at
+    once and submitted in the background under the configured concurrency and
+    rate limits; poll GET /mpesa/b2c/batches/{id} for per-loan progress.
+    """
+    can_disburse(current_user)
+    if not payload.loan_ids:
+        raise HTTPException(status_code=400, detail="No loans selected")
+    if len(payload.loan_ids) > b2c_batches.B2C_BATCH_MAX_LOANS:
+        raise HTTPException(status_code=400, detail=f"At most {b2c_batches.B2C_BATCH_MAX_LOANS} loans per batch")
+
+    key = payload.idempotency_key
+
+    def replay(existing: models.DisbursementBatch):
+        fingerprint = existing.request_fingerprint
+        if fingerprint and fingerprint != b2c_batches.request_fingerprint(payload.loan_ids):
+            raise HTTPException(status_code=409, detail=f"Idempotency key already used for batch #{existing.id} "
+                                                        "with a different set of loans")
+        return {**b2c_batches.batch_progress(db, existing), "skipped": [], "replayed": True}
+
+    if key:
+        existing = db.query(models.DisbursementBatch).filter(models.DisbursementBatch.idempotency_key == key).first()
+        if existing:
+            return replay(existing)
+
+    try:
+        batch, skipped = b2c_batches.create_batch(db, payload.loan_ids, current_user.id, key)
+        db.commit()
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail={"message": "No loan in the batch can be disbursed", "skipped": e.args[0]})
+    except IntegrityError:
+        # A concurrent retry with the same key created the batch first
+        db.rollback()
+        existing = db.query(models.DisbursementBatch).filter(models.DisbursementBatch.idempotency_key == key).first()
+        if not existing:
+            raise
+        return replay(existing)
+
+    concurrency = min(payload.concurrency or b2c_batches.B2C_MAX_CONCURRENCY, b2c_batches.B2C_MAX_CONCURRENCY)
+    background_tasks.add_task(b2c_batches.run_batch, batch.id, get_mpesa_service(db).as_async(),
+                              f"{auth.BASE_URL}/api/mpesa/b2c/result", concurrency)
+    log_activity(db, current_user.id, "disburse_batch", "disbursement_batch", batch.id,
+                 {"method": "mpesa", "loans": batch.total_count, "amount": batch.total_amount})
+    return {**b2c_batches.batch_progress(db, batch), "skipped": skipped, "replayed": False}
+
+@router.get("/b2c/batches/{batch_id}")
+def get_disbursement_batch(
+    batch_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    batch = db.get(models.DisbursementBatch, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return b2c_batches.batch_progress(db, batch)
+
+@router.post("/b2c/batches/{batch_id}/resume")
+def resume_disbursement_batch(
+    batch_id: int,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """Submits items still pending, e.g. after a restart interrupted the batch. Sent items are never re-sent."""
+    can_disburse(current_user)
+    batch = db.get(models.DisbursementBatch, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    background_tasks.add_task(b2c_batches.run_batch, batch.id, get_mpesa_service(db).as_async(),
+                              f"{auth.BASE_URL}/api/mpesa/b2c/result")
+    return b2c_batches.batch_progress(db, batch)
+
 @router.post("/b2c/result")
 async def b2c_result(request: Request, db: Session = Depends(get_db)):
     """Callback for B2C Disbursement"""
@@ -288,24 +427,34 @@ async def b2c_result(request: Request, db: Session = Depends(get_db)):
         print(f"B2C Callback: Transaction not found for CID {originator_cid}")
         return {"status": "ignored"}
 
-    trans.mpesa_result_code = str(result_code)
-    trans.mpesa_result_desc = result_desc
-    trans.mpesa_transaction_id = mpesa_trans_id
-    trans.completed_at = datetime.utcnow()
-
-    if int(result_code) == 0:
-        trans.status = "completed"
-        # Update loan status to active if it was approved
-        loan = db.query(models.Loan).filter(models.Loan.id == trans.loan_id).first()
-        if loan and loan.status == "approved":
-            loan.status = "active"
-    else:
-        trans.status = "failed"
-        trans.error_message = result_desc
-
+    b2c_batches.apply_b2c_result(db, trans, result_code, result_desc, mpesa_trans_id)
     db.commit()
     return {"ResultCode": 0, "ResultDesc": "Success"}
 
+@router.post("/b2c/status-result")
+async def b2c_status_result(request: Request, db: Session = Depends(get_db)):
+    """Callback for transaction status queries sent by b2c_status_sweeper.py"""
+    data = await request.json()
+    result = data.get("Result", {})
+    if not result:
+        return {"ResultCode": 1, "ResultDesc": "Invalid payload"}
+
+    trans = db.query(models.DisbursementTransaction).filter(
+        models.DisbursementTransaction.status_query_conversation_id == result.get("OriginatorConversationID")
+    ).first()
+    if not trans:
+        print(f"B2C status result: no query with CID {result.get('OriginatorConversationID')}")
+        return {"status": "ignored"}
+
+    if trans.status == "processing":
+        outcome = b2c_status.parse_status_result(result)
+        if outcome:
+            b2c_batches.apply_b2c_result(db, trans, *outcome)
+        else:
+            trans.error_message = f"Status query: {result.get('ResultDesc')}"
+        db.commit()
+    return {"ResultCode": 0, "ResultDesc": "Success"}
+
 @router.post("/stk/push/{loan_id}")
 def initiate_stk_push(
     loan_id: int,
@@ -330,10 +479,49 @@ def initiate_stk_push(
         description=f"Repayment for Loan #{loan.id}"
     )
     
+    checkout_id = response.get("CheckoutRequestID")
+    if response.get("ResponseCode") == "0" and checkout_id:
+        # The callback resolves its loan from this row, not from the payer's phone
+        stk_request = models.StkRequest(
+            checkout_request_id=checkout_id,
+            merchant_request_id=response.get("MerchantRequestID"),
+            loan_id=loan.id,
+            client_id=loan.client_id,
+            phone=loan.client.phone,
+            amount=int(payment_amount),
+            status="pending",
+            initiated_by=current_user.id
+        )
+        db.add(stk_request)
+        db.commit()
+        response = {**response, "stk_request_id": stk_request.id}
+
     # Log activity
-    log_activity(db, current_user.id, "stk_push", "loan", loan.id, {"amount": payment_amount})
+    log_activity(db, current_user.id, "stk_push", "loan", loan.id, {"amount": payment_amount, "checkout_request_id": checkout_id})
     return response
 
+@router.get("/stk/requests/{checkout_request_id}", response_model=schemas.StkRequest)
+def get_stk_request(
+    checkout_request_id: str,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """Outcome of one STK push, for the UI to poll until it leaves 'pending'."""
+    stk_request = db.query(models.StkRequest)\
+        .filter(models.StkRequest.checkout_request_id == checkout_request_id).first()
+    if not stk_request:
+        raise HTTPException(status_code=404, detail="STK request not found")
+    return stk_request
+
+def _complete_stk_request(stk_request: models.StkRequest, stk_callback: dict, receipt: str, repayment_id: Optional[int]):
+    """Marks a push paid from its success callback."""
+    stk_request.status = "completed"
+    stk_request.result_code = stk_callback.get("ResultCode")
+    stk_request.result_desc = stk_callback.get("ResultDesc")
+    stk_request.mpesa_receipt = receipt
+    stk_request.repayment_id = repayment_id
+    stk_request.completed_at = datetime.utcnow()
+
 @router.post("/stk/callback")
 async def stk_callback(request: Request, db: Session = Depends(get_db)):
     """Handle M-Pesa STK Push Callback"""
@@ -341,6 +529,8 @@ async def stk_callback(request: Request, db: Session = Depends(get_db)):
     stk_callback = data.get("Body", {}).get("stkCallback", {})
     result_code = stk_callback.get("ResultCode")
     checkout_id = stk_callback.get("CheckoutRequestID")
+    stk_request = db.query(models.StkRequest)\
+        .filter(models.StkRequest.checkout_request_id == checkout_id).first() if checkout_id else None
     
     if result_code == 0:
         # Success
@@ -352,23 +542,33 @@ async def stk_callback(request: Request, db: Session = Depends(get_db)):
             if item["Name"] == "Amount": amount = item["Value"]
             if item["Name"] == "MpesaReceiptNumber": receipt = item["Value"]
             if item["Name"] == "PhoneNumber": phone = str(item["Value"])
+
+        # Re-delivered callback: already recorded, answer with the same ack
+        if mpesa_inbox.is_duplicate(db, receipt):
+            return {"ResultCode": 0, "ResultDesc": "Accepted"}
         
-        # Log incoming transaction
-        incoming = models.MpesaIncomingTransaction(
-            transaction_id=receipt,
-            amount=amount,
-            phone=phone,
-            bill_ref=f"STK-{checkout_id}",
-            raw_callback_data=json.dumps(data),
-            status="unmatched"
-        )
-        db.add(incoming)
-        db.flush()
-        
-        # Match by phone to the latest active loan
-        client = db.query(models.Client).filter(models.Client.phone.like(f"%{phone[-9:]}")).first()
-        if client:
-            loan = db.query(models.Loan).filter(models.Loan.client_id == client.id, models.Loan.status == "active").order_by(models.Loan.id.desc()).first()
+        try:
+            # Log incoming transaction
+            incoming = models.MpesaIncomingTransaction(
+                transaction_id=receipt,
+                amount=amount,
+                phone=phone,
+                bill_ref=f"STK-{checkout_id}",
+                raw_callback_data=json.dumps(data),
+                status="unmatched"
+            )
+            db.add(incoming)
+            db.flush()
+
+            loan = None
+            if stk_request:
+                # The loan the push was sent for
+                loan = db.query(models.Loan).filter(models.Loan.id == stk_request.loan_id, models.Loan.status == "active").first()
+            else:
+                # Pushed before stk_requests existed: match by phone to the latest active loan
+                client_id = client_phone_map.find_client_id(db, phone)
+                if client_id:
+                    loan = db.query(models.Loan).filter(models.Loan.client_id == client_id, models.Loan.status == "active").order_by(models.Loan.id.desc()).first()
             if loan:
                 repayment = models.Repayment(
                     loan_id=loan.id,
@@ -379,15 +579,75 @@ async def stk_callback(request: Request, db: Session = Depends(get_db)):
                     payment_method="mpesa"
                 )
                 db.add(repayment)
+                db.flush()
                 incoming.status = "matched"
                 incoming.loan_id = loan.id
                 incoming.client_id = loan.client_id
                 incoming.repayment_id = repayment.id
 
+            if stk_request:
+                _complete_stk_request(stk_request, stk_callback, receipt, incoming.repayment_id)
+            db.commit()
+        except IntegrityError:
+            # A concurrent delivery of the same receipt was recorded first:
+            # settle the push from the row that won
+            db.rollback()
+            stk_request = db.query(models.StkRequest)\
+                .filter(models.StkRequest.checkout_request_id == checkout_id).first() if checkout_id else None
+            if stk_request and stk_request.status != "completed":
+                winner = db.query(models.MpesaIncomingTransaction)\
+                    .filter(models.MpesaIncomingTransaction.transaction_id == receipt).first()
+                _complete_stk_request(stk_request, stk_callback, receipt, winner.repayment_id if winner else None)
+                db.commit()
+        mpesa_inbox.recent_transaction_ids.add(receipt)
+
+    elif stk_request and stk_request.status == "pending":
+        # 1032: the customer dismissed the prompt
+        stk_request.status = "cancelled" if result_code == 1032 else "failed"
+        stk_request.result_code = result_code
+        stk_request.result_desc = stk_callback.get("ResultDesc")
+        stk_request.completed_at = datetime.utcnow()
         db.commit()
         
     return {"ResultCode": 0, "ResultDesc": "Accepted"}
 
+@router.post("/statements")
+def upload_statement(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.require_admin)
+):
+    """
+    Loads a paybill statement (CSV or XLSX from the M-Pesa portal) in the
+    background. Receipts we never got a callback for are added to the
+    unmatched queue; poll GET /mpesa/statements/{id} for the daily
+    reconciliation.
+    """
+    filename = file.filename or "statement.csv"
+    if not filename.lower().endswith((".csv", ".xlsx", ".xlsm")):
+        raise HTTPException(status_code=400, detail="Statement must be a .csv or .xlsx file")
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as tmp:
+        shutil.copyfileobj(file.file, tmp)
+
+    record = models.MpesaStatementImport(filename=filename, status="running", created_by=current_user.id)
+    db.add(record)
+    db.commit()
+    background_tasks.add_task(mpesa_statement.import_file, record.id, tmp.name, filename)
+    log_activity(db, current_user.id, "import_statement", "mpesa_statement", record.id, {"filename": filename})
+    return mpesa_statement.statement_summary(record)
+
+@router.get("/statements/{import_id}")
+def get_statement_import(
+    import_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.require_admin)
+):
+    record = db.get(models.MpesaStatementImport, import_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="Statement import not found")
+    return mpesa_statement.statement_summary(record)
+
 @router.get("/balance")
 def check_balance(
     db: Session = Depends(get_db),
@@ -405,6 +665,14 @@ def check_balance(
         "account": "Business Payment (Working)"
     }
 
+@router.get("/metrics")
+def get_mpesa_metrics(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.require_admin)
+):
+    """Daraja OAuth token cache counters for this process and callback inbox depth."""
+    return {"access_token": token_cache.metrics(), "callback_inbox": mpesa_inbox.metrics(db)}
+
 @router.post("/settings")
 def update_mpesa_settings(
     settings: dict,
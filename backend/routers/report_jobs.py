@@ -0,0 +1,87 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+from typing import List, Optional
+import json
+import os
+import models, schemas, auth
+from database import get_db
+from utils import log_activity
+from services.report_jobs import RESULT_EXTENSIONS, validate_job_params
+
+router = APIRouter(prefix="/reports/jobs", tags=["reports"])
+
+MEDIA_TYPES = {
+    "json": "application/gzip", # Stored and served gzipped as .json.gz
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "pdf": "application/pdf",
+}
+
+def get_own_job(job_id: int, db: Session, current_user: models.User):
+    job = db.query(models.ReportJob).filter(models.ReportJob.id == job_id).first()
+    if not job or (job.requested_by != current_user.id and current_user.role != "admin"):
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return job
+
+@router.post("/", response_model=schemas.ReportJob, status_code=202)
+def submit_report_job(
+    job_in: schemas.ReportJobCreate,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """Queue a report for the background worker (report_worker.py)."""
+    try:
+        params = validate_job_params(job_in.report_type, job_in.params, job_in.format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    job = models.ReportJob(
+        report_type=job_in.report_type,
+        params=json.dumps(params),
+        format=job_in.format,
+        status="queued",
+        requested_by=current_user.id
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+
+    log_activity(db, current_user.id, "submit", "report_job", job.id, {"report_type": job.report_type, "format": job.format})
+    return job
+
+@router.get("/", response_model=List[schemas.ReportJob])
+def list_report_jobs(
+    status: Optional[str] = None,
+    limit: int = 50,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    query = db.query(models.ReportJob).filter(models.ReportJob.requested_by == current_user.id)
+    if status:
+        query = query.filter(models.ReportJob.status == status)
+    return query.order_by(models.ReportJob.id.desc()).limit(limit).all()
+
+@router.get("/{job_id}", response_model=schemas.ReportJob)
+def get_report_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    return get_own_job(job_id, db, current_user)
+
+@router.get("/{job_id}/download")
+def download_report_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    job = get_own_job(job_id, db, current_user)
+    if job.status == "expired":
+        raise HTTPException(status_code=410, detail="Report result has expired")
+    if job.status != "completed" or not job.result_path or not os.path.exists(job.result_path):
+        raise HTTPException(status_code=409, detail=f"Report job is {job.status}")
+
+    format = job.format or "json"
+    filename = f"{job.report_type}_{job.id}.{RESULT_EXTENSIONS[format]}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    return FileResponse(job.result_path, media_type=MEDIA_TYPES[format], headers=headers)
@@ -1,98 +1,118 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import func, select, and_, or_
 from typing import List, Optional
 from datetime import date, datetime, timedelta
+from decimal import Decimal
 import models, schemas, auth
 from database import get_db
+from services.report_cache import report_cache, set_cache_headers
+from services import analytics_store, loan_schedule, collection_sheet
+from services.csv_export import csv_response
+from services.report_renderers import stream_rows
 
 router = APIRouter(prefix="/reports", tags=["reports"])
 
+# Tables each cached report reads; a committed write to any of them drops the entry
+PROFIT_LOSS_TABLES = ("loans", "repayments", "expenses")
+PAR_TABLES = ("loans", "repayments")
+PORTFOLIO_HEALTH_TABLES = ("loans", "repayments", "loan_products")
+# Cached until the next committed repayment (or loan status change)
+CASH_FLOW_TABLES = ("loans", "repayments")
+
+# Loans whose repayment history feeds the product/branch collection rates
+COLLECTION_HISTORY_STATUSES = ("active", "completed", "defaulted")
+
 @router.get("/profit-loss")
 def get_profit_loss(
+    response: Response,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
+    source: str = "live",
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
+    # Default range: last 30 days if not provided
+    if not end_date:
+        end_date = date.today()
+    if not start_date:
+        start_date = end_date - timedelta(days=30)
+
+    # Historical ranges can be served from the local analytics store (export_analytics.py)
+    if source == "analytics":
+        try:
+            result = analytics_store.profit_loss(start_date, end_date)
+            response.headers["X-Report-Source"] = "analytics"
+            return result
+        except analytics_store.AnalyticsStoreUnavailable as e:
+            print(f"Analytics store unavailable, using live data: {e}")
+    response.headers["X-Report-Source"] = "live"
+
+    result, age, hit = report_cache.get_or_compute(
+        "profit-loss",
+        {"start_date": start_date, "end_date": end_date},
+        lambda: compute_profit_loss(db, start_date, end_date),
+        PROFIT_LOSS_TABLES
+    )
+    set_cache_headers(response, age, hit)
+    return result
+
+def profit_loss_totals(db: Session, start_date: date, end_date: date) -> dict:
+    """
+    Income and expense totals for the period, summed in the database so a long
+    range costs three aggregate queries rather than loading every row.
+    """
+    # Fees on loans started in the period
+    loan = models.Loan
+    fee_income = db.query(func.coalesce(func.sum(
+        func.coalesce(loan.processing_fee, 0) + func.coalesce(loan.insurance_fee, 0)
+        + func.coalesce(loan.valuation_fee, 0)
+    ), 0)).filter(
+        loan.start_date >= start_date,
+        loan.start_date <= end_date + timedelta(days=1)
+    ).scalar()
+
+    # Interest share of each repayment: interest / total cost of its loan
+    rate = func.coalesce(loan.interest_rate, 0)
+    interest_income = db.query(func.coalesce(func.sum(
+        func.coalesce(models.Repayment.amount, 0) * (loan.amount * rate / 100) / (loan.amount * (1 + rate / 100))
+    ), 0)).select_from(models.Repayment).join(loan, loan.id == models.Repayment.loan_id).filter(
+        models.Repayment.payment_date >= start_date,
+        models.Repayment.payment_date <= end_date,
+        loan.amount > 0
+    ).scalar()
+
+    total_expenses = db.query(func.coalesce(func.sum(models.Expense.amount), 0)).filter(
+        models.Expense.date >= start_date,
+        models.Expense.date <= end_date
+    ).scalar()
+
+    fee_income, interest_income, total_expenses = float(fee_income), float(interest_income), float(total_expenses)
+    total_income = fee_income + interest_income
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "fee_income": round(fee_income, 2),
+        "interest_income": round(interest_income, 2),
+        "total_income": round(total_income, 2),
+        "total_expenses": round(total_expenses, 2),
+        "net_profit": round(total_income - total_expenses, 2),
+    }
+
+
+def compute_profit_loss(db: Session, start_date: date, end_date: date):
     try:
-        # Default range: last 30 days if not provided
-        if not end_date:
-            end_date = date.today()
-        if not start_date:
-            start_date = end_date - timedelta(days=30)
-
-        # 1. Revenue: Interest from repayments in this period
-        # Note: Simplistic approach - interest is a portion of each repayment.
-        # In a real system, interest is recognized when earned.
-        # Here we'll sum interest portions calculated in the schedule if we had it stored, 
-        # but for now, let's estimate or use a simplified logic: 
-        # Total Revenue = sum(repayments) * (avg_interest_rate / (100 + avg_interest_rate)) ? No.
-        
-        # Better: Revenue = sum(interest_earned_on_active_loans) + processing_fees + insurance_fees...
-        
-        # Let's sum processing fees and other fees from loans created in this period
-        loans_in_period = db.query(models.Loan).filter(
-            models.Loan.start_date >= start_date,
-            models.Loan.start_date <= end_date + timedelta(days=1)
-        ).all()
-        
-        fee_income = sum([
-            (l.processing_fee or 0) + (l.insurance_fee or 0) + (l.valuation_fee or 0)
-            for l in loans_in_period
-        ])
-        
-        # Let's sum interest from repayments made in this period
-        # Simplified: Assume fixed interest split for now
-        repayments = db.query(models.Repayment).filter(
-            models.Repayment.payment_date >= start_date,
-            models.Repayment.payment_date <= end_date
-        ).all()
-        
-        interest_income = 0
-        for r in repayments:
-            loan = r.loan
-            if loan:
-                # Interest % of total loan cost
-                # Handle potential None values safely
-                l_amount = loan.amount or 0
-                l_rate = loan.interest_rate or 0
-                
-                if l_amount > 0:
-                    total_cost = l_amount * (1 + (l_rate / 100))
-                    # Prevent division by zero just in case
-                    if total_cost > 0:
-                        interest_ratio = (l_amount * l_rate / 100) / total_cost
-                        interest_income += (r.amount or 0) * interest_ratio
-                    else:
-                        # Should technically not happen if amount > 0
-                        pass
-
-        total_income = fee_income + interest_income
-
-        # 2. Expenses: All expenses in this period
-        expenses = db.query(models.Expense).filter(
+        result = profit_loss_totals(db, start_date, end_date)
+
+        expenses = db.query(models.Expense.category, models.Expense.amount, models.Expense.description).filter(
             models.Expense.date >= start_date,
             models.Expense.date <= end_date
-        ).all()
-        
-        total_expenses = sum([(e.amount or 0) for e in expenses])
-        
-        net_profit = total_income - total_expenses
-
-        return {
-            "start_date": start_date,
-            "end_date": end_date,
-            "fee_income": round(fee_income, 2),
-            "interest_income": round(interest_income, 2),
-            "total_income": round(total_income, 2),
-            "total_expenses": round(total_expenses, 2),
-            "net_profit": round(net_profit, 2),
-            "expense_breakdown": [
-                {"category": e.category or "Other", "amount": e.amount, "description": e.description}
-                for e in expenses
-            ]
-        }
+        ).order_by(models.Expense.id).all()
+        result["expense_breakdown"] = [
+            {"category": category or "Other", "amount": amount, "description": description}
+            for category, amount, description in expenses
+        ]
+        return result
     except Exception as e:
         print(f"Error in profit-loss report: {str(e)}")
         import traceback
@@ -101,14 +121,57 @@ def get_profit_loss(
 
 @router.get("/portfolio-at-risk")
 def get_portfolio_at_risk(
+    response: Response,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
+    result, age, hit = report_cache.get_or_compute(
+        "portfolio-at-risk",
+        {"as_of_date": date.today()},
+        lambda: compute_portfolio_at_risk(db),
+        PAR_TABLES
+    )
+    set_cache_headers(response, age, hit)
+    return result
+
+def iter_active_loan_arrears(db: Session, as_of: date, batch_size: int = 2000):
+    """
+    Streams active loans with their arrears position. Repayments are summed
+    in one grouped subquery instead of loading each loan's repayments.
+    """
+    paid = select(
+        models.Repayment.loan_id.label("loan_id"),
+        func.sum(models.Repayment.amount).label("total_paid")
+    ).group_by(models.Repayment.loan_id).subquery()
+
+    stmt = select(
+        models.Loan.id, models.Loan.client_id, models.Client.first_name, models.Client.last_name,
+        models.Client.phone, models.Loan.amount, models.Loan.interest_rate, models.Loan.duration_months,
+        models.Loan.repayment_frequency, models.Loan.start_date, func.coalesce(paid.c.total_paid, 0)
+    ).outerjoin(paid, paid.c.loan_id == models.Loan.id)\
+     .outerjoin(models.Client, models.Client.id == models.Loan.client_id)\
+     .where(models.Loan.status == "active")\
+     .order_by(models.Loan.id)
+
+    for (loan_id, client_id, first_name, last_name, phone, amount, rate, duration,
+         frequency, start_date, total_paid) in stream_rows(db, stmt, batch_size):
+        amount_overdue, days_overdue = loan_schedule.arrears(
+            amount, rate, duration, frequency, start_date, total_paid, as_of
+        )
+        yield {
+            "loan_id": loan_id,
+            "client_id": client_id,
+            "client_name": f"{first_name or ''} {last_name or ''}".strip(),
+            "phone": phone,
+            "amount": amount or 0,
+            "total_paid": float(total_paid or 0),
+            "amount_overdue": round(amount_overdue, 2),
+            "days_overdue": days_overdue,
+            "bucket": loan_schedule.par_bucket(amount_overdue, days_overdue),
+        }
+
+def compute_portfolio_at_risk(db: Session):
     # PAR logic: Analyze active loans
-    # 1. Total Active Portfolio
-    active_loans = db.query(models.Loan).filter(models.Loan.status == "active").all()
-    total_portfolio_value = sum([l.amount for l in active_loans])
-    
     par_stats = {
         "current": 0,    # Paid on time or <= 1 day late
         "par_30": 0,     # 1-30 days late
@@ -118,56 +181,11 @@ def get_portfolio_at_risk(
     }
     
     today = date.today()
+    total_portfolio_value = 0
     
-    for loan in active_loans:
-        # Calculate amount due vs amount paid
-        total_paid = sum([r.amount for r in loan.repayments])
-        
-        # Determine schedule 
-        # (This is duplicated logic from loans router, maybe should be a utility)
-        num_installments = 0
-        interval = 0
-        if loan.repayment_frequency == "daily":
-            num_installments = loan.duration_months * 30
-            interval = 1
-        elif loan.repayment_frequency == "weekly":
-            num_installments = loan.duration_months * 4
-            interval = 7
-        else:
-            num_installments = loan.duration_months
-            interval = 30
-            
-        total_due = loan.amount * (1 + (loan.interest_rate / 100))
-        installment_amount = total_due / num_installments
-        
-        # Find expected balance today
-        installments_passed = 0
-        current_date_in_loop = loan.start_date
-        while current_date_in_loop <= today and installments_passed < num_installments:
-            current_date_in_loop += timedelta(days=interval)
-            if current_date_in_loop <= today:
-                installments_passed += 1
-        
-        expected_paid = installments_passed * installment_amount
-        
-        if total_paid >= expected_paid:
-            par_stats["current"] += loan.amount
-        else:
-            # Overdue! Calculate days since first missed payment
-            # A bit complex to find the EXACT day without stored schedule, 
-            # let's estimate based on amount gap
-            amount_overdue = expected_paid - total_paid
-            installments_overdue = amount_overdue / installment_amount
-            days_overdue = int(installments_overdue * interval)
-            
-            if days_overdue <= 30:
-                par_stats["par_30"] += loan.amount
-            elif days_overdue <= 60:
-                par_stats["par_60"] += loan.amount
-            elif days_overdue <= 90:
-                par_stats["par_90"] += loan.amount
-            else:
-                par_stats["par_90plus"] += loan.amount
+    for loan in iter_active_loan_arrears(db, today):
+        total_portfolio_value += loan["amount"]
+        par_stats[loan["bucket"]] += loan["amount"]
                 
     return {
         "as_of_date": today,
@@ -181,10 +199,21 @@ def get_portfolio_at_risk(
 
 @router.get("/portfolio-health")
 def get_portfolio_health(
+    response: Response,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
     """Detailed portfolio health analytics including product performance distribution."""
+    result, age, hit = report_cache.get_or_compute(
+        "portfolio-health",
+        {"as_of_date": date.today()},
+        lambda: compute_portfolio_health(db),
+        PORTFOLIO_HEALTH_TABLES
+    )
+    set_cache_headers(response, age, hit)
+    return result
+
+def compute_portfolio_health(db: Session):
     # 1. Product Performance
     products = db.query(models.LoanProduct).all()
     product_stats = []
@@ -203,16 +232,350 @@ def get_portfolio_health(
         })
 
     # 2. Re-use PAR logic but return more detailed for charts
-    par_data = get_portfolio_at_risk(db, current_user)
+    par_data, _, _ = report_cache.get_or_compute(
+        "portfolio-at-risk",
+        {"as_of_date": date.today()},
+        lambda: compute_portfolio_at_risk(db),
+        PAR_TABLES
+    )
     
     return {
         "product_performance": product_stats,
         "par_summary": par_data
     }
 
+@router.get("/cash-flow-forecast")
+def get_cash_flow_forecast(
+    response: Response,
+    weeks: int = 8,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """
+    Expected collections per day and week from active loan schedules,
+    adjusted by each product/branch's historical collection rate.
+    """
+    if weeks < 1 or weeks > 12:
+        raise HTTPException(status_code=400, detail="weeks must be between 1 and 12")
+
+    result, age, hit = report_cache.get_or_compute(
+        "cash-flow-forecast",
+        {"as_of_date": date.today(), "weeks": weeks},
+        lambda: compute_cash_flow_forecast(db, date.today(), weeks),
+        CASH_FLOW_TABLES
+    )
+    set_cache_headers(response, age, hit)
+    return result
+
+def compute_cash_flow_forecast(db: Session, as_of: date, weeks: int):
+    horizon_days = weeks * 7
+    paid = select(
+        models.Repayment.loan_id.label("loan_id"),
+        func.sum(models.Repayment.amount).label("total_paid")
+    ).group_by(models.Repayment.loan_id).subquery()
+
+    stmt = select(
+        models.Loan.product_id, models.Client.branch_id, models.Loan.status, models.Loan.amount,
+        models.Loan.interest_rate, models.Loan.duration_months, models.Loan.repayment_frequency,
+        models.Loan.start_date, func.coalesce(paid.c.total_paid, 0)
+    ).outerjoin(paid, paid.c.loan_id == models.Loan.id)\
+     .outerjoin(models.Client, models.Client.id == models.Loan.client_id)\
+     .where(models.Loan.status.in_(COLLECTION_HISTORY_STATUSES))
+
+    # One pass over the portfolio: collection history per (product, branch)
+    # and each active loan's remaining installments on that group's calendar.
+    # Per loan this is O(1) arithmetic (InstallmentCalendar never expands a
+    # schedule), so fetching the rows, not this loop, dominates the cost.
+    history = {}    # group -> [collected, expected to date, loans]
+    calendars = {}  # group -> InstallmentCalendar
+    overdue_outstanding = 0.0
+
+    for (product_id, branch_id, status, amount, rate, duration, frequency,
+         start_date, total_paid) in stream_rows(db, stmt):
+        num_installments, interval = loan_schedule.schedule_params(frequency, duration)
+        if num_installments <= 0:
+            continue
+        installment_amount = loan_schedule.total_due(amount, rate) / num_installments
+        total_paid = float(total_paid or 0)
+        expected = loan_schedule.installments_due(start_date, interval, num_installments, as_of) * installment_amount
+
+        group = (product_id, branch_id)
+        stats = history.setdefault(group, [0.0, 0.0, 0])
+        stats[0] += min(total_paid, expected)
+        stats[1] += expected
+        stats[2] += 1
+
+        if status != "active":
+            continue
+        overdue_outstanding += max(expected - total_paid, 0)
+        first, last = loan_schedule.upcoming_installments(
+            start_date, interval, num_installments, installment_amount, total_paid, as_of
+        )
+        calendar = calendars.get(group)
+        if calendar is None:
+            calendar = calendars[group] = loan_schedule.InstallmentCalendar(as_of, horizon_days)
+        calendar.add(start_date, interval, first, last, installment_amount)
+
+    # Groups without any installments due yet fall back to the portfolio-wide rate
+    total_collected = sum(h[0] for h in history.values())
+    total_expected = sum(h[1] for h in history.values())
+    portfolio_rate = total_collected / total_expected if total_expected else 1.0
+    rates = {g: (h[0] / h[1] if h[1] else portfolio_rate) for g, h in history.items()}
+
+    scheduled = [0.0] * horizon_days
+    adjusted = [0.0] * horizon_days
+    for group, calendar in calendars.items():
+        for i, amount in enumerate(calendar.totals()):
+            scheduled[i] += amount
+            adjusted[i] += amount * rates[group]
+
+    daily = [
+        {
+            "date": as_of + timedelta(days=i + 1),
+            "scheduled": round(scheduled[i], 2),
+            "expected": round(adjusted[i], 2),
+        }
+        for i in range(horizon_days)
+    ]
+    weekly = [
+        {
+            "week_start": as_of + timedelta(days=w * 7 + 1),
+            "week_end": as_of + timedelta(days=w * 7 + 7),
+            "scheduled": round(sum(scheduled[w * 7:w * 7 + 7]), 2),
+            "expected": round(sum(adjusted[w * 7:w * 7 + 7]), 2),
+        }
+        for w in range(weeks)
+    ]
+
+    products = dict(db.query(models.LoanProduct.id, models.LoanProduct.name).all())
+    branches = dict(db.query(models.Branch.id, models.Branch.name).all())
+    collection_rates = [
+        {
+            "product_id": product_id,
+            "product_name": products.get(product_id),
+            "branch_id": branch_id,
+            "branch_name": branches.get(branch_id),
+            "loans": history[(product_id, branch_id)][2],
+            "collection_rate": round(rates[(product_id, branch_id)] * 100, 2),
+        }
+        for product_id, branch_id in sorted(history, key=lambda g: (g[0] or 0, g[1] or 0))
+    ]
+
+    return {
+        "as_of_date": as_of,
+        "weeks": weeks,
+        "total_scheduled": round(sum(scheduled), 2),
+        "total_expected": round(sum(adjusted), 2),
+        "overdue_outstanding": round(overdue_outstanding, 2),
+        "portfolio_collection_rate": round(portfolio_rate * 100, 2),
+        "daily": daily,
+        "weekly": weekly,
+        "collection_rates": collection_rates,
+    }
+
+@router.get("/collection-sheet")
+def get_collection_sheet(
+    background_tasks: BackgroundTasks,
+    branch_id: Optional[int] = None,
+    officer_id: Optional[int] = None,
+    customer_group_id: Optional[int] = None,
+    after: Optional[str] = None,
+    limit: int = 100,
+    format: str = "json",
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """
+    Loans with an installment due today or overdue, read from the precomputed
+    loan_due_status table. Pages are keyed on (next_due_date, loan_id): pass the
+    returned next_cursor as `after`. format=csv streams the whole sheet.
+    data_as_of is the date the oldest row was computed for; when it is before
+    today the rows are served as they are while a rebuild runs in the background.
+    """
+    if format not in ("json", "csv"):
+        raise HTTPException(status_code=400, detail="format must be json or csv")
+    if limit < 1 or limit > 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+
+    today = date.today()
+    refreshing = collection_sheet.needs_rebuild(db, today)
+    if refreshing:
+        background_tasks.add_task(collection_sheet.rebuild, today)
+    status = models.LoanDueStatus
+    officer = aliased(models.User)
+
+    filters = [status.next_due_date <= today]
+    if branch_id:
+        filters.append(status.branch_id == branch_id)
+    if officer_id:
+        filters.append(status.officer_id == officer_id)
+    if customer_group_id:
+        filters.append(status.customer_group_id == customer_group_id)
+
+    def build(*extra):
+        return select(
+            status.loan_id, status.client_id, models.Client.first_name, models.Client.last_name,
+            models.Client.phone, models.Branch.name, officer.full_name, models.CustomerGroup.name,
+            status.next_due_date, status.installment_amount, status.amount_due, status.days_overdue,
+            status.balance
+        ).join(models.Client, models.Client.id == status.client_id)\
+         .outerjoin(models.Branch, models.Branch.id == status.branch_id)\
+         .outerjoin(officer, officer.id == status.officer_id)\
+         .outerjoin(models.CustomerGroup, models.CustomerGroup.id == status.customer_group_id)\
+         .where(*filters, *extra)\
+         .order_by(status.next_due_date, status.loan_id)
+
+    if format == "csv":
+        headers = ["Loan ID", "Client ID", "First Name", "Last Name", "Phone", "Branch", "Officer",
+                   "Customer Group", "Next Due Date", "Installment", "Amount Due", "Days Overdue", "Balance"]
+        return csv_response(build, headers, "collection_sheet")
+
+    extra = []
+    if after:
+        try:
+            after_date, after_id = after.split(":")
+            after_date, after_id = date.fromisoformat(after_date), int(after_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        # Spelled out rather than a row comparison so MariaDB uses the index range
+        extra.append(or_(
+            status.next_due_date > after_date,
+            and_(status.next_due_date == after_date, status.loan_id > after_id)
+        ))
+
+    rows = db.execute(build(*extra).limit(limit + 1)).all()
+    items = [
+        {
+            "loan_id": r[0],
+            "client_id": r[1],
+            "client_name": f"{r[2] or ''} {r[3] or ''}".strip(),
+            "phone": r[4],
+            "branch": r[5],
+            "officer": r[6],
+            "customer_group": r[7],
+            "next_due_date": r[8],
+            "installment_amount": r[9],
+            "amount_due": r[10],
+            "days_overdue": r[11],
+            "balance": r[12],
+            "status": "overdue" if r[11] else "due_today",
+        }
+        for r in rows[:limit]
+    ]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = f"{last['next_due_date'].isoformat()}:{last['loan_id']}"
+
+    result = {"as_of_date": today, "data_as_of": collection_sheet.data_as_of(db), "refreshing": refreshing,
+              "items": items, "next_cursor": next_cursor}
+    if not after:
+        # Sheet totals on the first page only
+        count, amount_due = db.query(func.count(status.loan_id), func.sum(status.amount_due)).filter(*filters).one()
+        result["total_loans"] = count
+        result["total_amount_due"] = round(float(amount_due or 0), 2)
+    return result
+
+@router.get("/arrears-aging")
+def get_arrears_aging(
+    background_tasks: BackgroundTasks,
+    bucket: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = 50,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """
+    Aging buckets of the active portfolio from loan_due_status. With `bucket`
+    (one of current, par_30, par_60, par_90, par_90plus) also returns that
+    bucket's loans, largest amount overdue first, keyed on (amount_due, loan_id);
+    the cursor carries the amount in integer cents. Stale rows are served
+    with data_as_of while a rebuild runs, as for /collection-sheet.
+    """
+    if bucket and bucket not in loan_schedule.PAR_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of {', '.join(loan_schedule.PAR_BUCKETS)}")
+    if limit < 1 or limit > 500:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 500")
+
+    today = date.today()
+    refreshing = collection_sheet.needs_rebuild(db, today)
+    if refreshing:
+        background_tasks.add_task(collection_sheet.rebuild, today)
+    status = models.LoanDueStatus
+
+    totals = {
+        b: (count, float(amount_due or 0), float(balance or 0))
+        for b, count, amount_due, balance in db.query(
+            status.aging_bucket, func.count(status.loan_id), func.sum(status.amount_due), func.sum(status.balance)
+        ).group_by(status.aging_bucket).all()
+    }
+    result = {
+        "as_of_date": today,
+        "data_as_of": collection_sheet.data_as_of(db),
+        "refreshing": refreshing,
+        "buckets": [
+            {
+                "bucket": b,
+                "loans": totals.get(b, (0, 0, 0))[0],
+                "amount_overdue": round(totals.get(b, (0, 0, 0))[1], 2),
+                "balance": round(totals.get(b, (0, 0, 0))[2], 2),
+            }
+            for b in loan_schedule.PAR_BUCKETS
+        ],
+    }
+    if not bucket:
+        return result
+
+    filters = [status.aging_bucket == bucket]
+    if after:
+        try:
+            after_cents, after_id = after.split(":")
+            after_cents, after_id = int(after_cents), int(after_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        # amount_due is DECIMAL(14, 2); compare as a decimal so loans tied on the
+        # boundary amount are neither skipped nor repeated
+        after_amount = Decimal(after_cents) / 100
+        filters.append(or_(
+            status.amount_due < after_amount,
+            and_(status.amount_due == after_amount, status.loan_id < after_id)
+        ))
+
+    # Both sort keys descending so the (aging_bucket, amount_due, loan_id) index is read backwards
+    rows = db.query(
+        status.loan_id, status.client_id, models.Client.first_name, models.Client.last_name,
+        models.Client.phone, status.amount_due, status.days_overdue, status.balance,
+        status.next_due_date, status.last_payment_date
+    ).join(models.Client, models.Client.id == status.client_id)\
+     .filter(*filters)\
+     .order_by(status.amount_due.desc(), status.loan_id.desc())\
+     .limit(limit + 1).all()
+
+    result["bucket"] = bucket
+    result["items"] = [
+        {
+            "loan_id": r[0],
+            "client_id": r[1],
+            "client_name": f"{r[2] or ''} {r[3] or ''}".strip(),
+            "phone": r[4],
+            "amount_overdue": r[5],
+            "days_overdue": r[6],
+            "balance": r[7],
+            "next_due_date": r[8],
+            "last_payment_date": r[9],
+        }
+        for r in rows[:limit]
+    ]
+    result["next_cursor"] = None
+    if len(rows) > limit:
+        last = result["items"][-1]
+        result["next_cursor"] = f"{round(last['amount_overdue'] * 100)}:{last['loan_id']}"
+    return result
+
 @router.get("/client-trends")
 def get_client_trends(
     months: int = 12,
+    source: str = "live",
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
@@ -220,6 +583,21 @@ def get_client_trends(
     from dateutil.relativedelta import relativedelta
     today = date.today()
     trends = []
+
+    if source == "analytics":
+        first_month = today - relativedelta(months=months - 1)
+        range_start = datetime(first_month.year, first_month.month, 1)
+        try:
+            counts = analytics_store.client_counts_by_month(range_start, datetime.combine(today, datetime.max.time()))
+            for i in range(months - 1, -1, -1):
+                target_month = today - relativedelta(months=i)
+                trends.append({
+                    "month": date(target_month.year, target_month.month, 1).strftime("%b %Y"),
+                    "count": counts.get(f"{target_month.year:04d}-{target_month.month:02d}", 0)
+                })
+            return trends
+        except analytics_store.AnalyticsStoreUnavailable as e:
+            print(f"Analytics store unavailable, using live data: {e}")
     
     for i in range(months - 1, -1, -1):
         target_month = today - relativedelta(months=i)
@@ -237,3 +615,13 @@ def get_client_trends(
         })
         
     return trends
+
+@router.get("/analytics-store/status")
+def get_analytics_store_status(
+    current_user: models.User = Depends(auth.require_admin)
+):
+    """High-water marks and row counts of the local analytics store."""
+    try:
+        return analytics_store.sync_status()
+    except analytics_store.AnalyticsStoreUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
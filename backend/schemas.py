@@ -86,6 +86,63 @@ class MpesaIncomingTransaction(MpesaIncomingTransactionBase):
     class Config:
         from_attributes = True
 
+class UnmatchedTransaction(MpesaIncomingTransaction):
+    raw_callback_data: Optional[str] = None # Only with include_raw=true
+
+class UnmatchedTransactionsPage(BaseModel):
+    items: List[UnmatchedTransaction]
+    next_after: Optional[int] = None
+    total_count: Optional[int] = None # Totals for the filters, on the first page only
+    total_amount: Optional[float] = None
+
+class StkRequest(BaseModel):
+    id: int
+    checkout_request_id: str
+    loan_id: int
+    client_id: Optional[int] = None
+    phone: Optional[str] = None
+    amount: float
+    status: str
+    result_code: Optional[int] = None
+    result_desc: Optional[str] = None
+    mpesa_receipt: Optional[str] = None
+    repayment_id: Optional[int] = None
+    created_at: datetime
+    completed_at: Optional[datetime] = None
+    class Config:
+        from_attributes = True
+
+class ReconciliationProposal(BaseModel):
+    id: int
+    transaction_id: str
+    amount: float
+    phone: Optional[str] = None
+    bill_ref: Optional[str] = None
+    created_at: Optional[datetime] = None
+    loan_id: int
+    client_id: int
+    client_name: Optional[str] = None
+    rule: str # bill_ref_loan_id, account_ref, bill_ref_client, phone (+amount)
+    confidence: str # high, medium, low
+    reasons: List[str]
+
+class ReconciliationProposals(BaseModel):
+    items: List[ReconciliationProposal]
+    scanned: int
+    next_after: Optional[int] = None
+
+class ReconciliationMatch(BaseModel):
+    transaction_id: int # MpesaIncomingTransaction.id
+    loan_id: int
+
+class ReconciliationAccept(BaseModel):
+    matches: List[ReconciliationMatch]
+
+class DisbursementBatchCreate(BaseModel):
+    loan_ids: List[int]
+    idempotency_key: Optional[str] = None # Reuse on retries; the same batch is returned
+    concurrency: Optional[int] = None # Capped at MPESA_B2C_MAX_CONCURRENCY
+
 # Branch Schemas
 class BranchBase(BaseModel):
     name: str
@@ -482,3 +539,35 @@ class Notification(NotificationBase):
     
     class Config:
         from_attributes = True
+
+# Report Job Schemas
+class ReportJobCreate(BaseModel):
+    report_type: str
+    params: dict = {}
+    format: str = "json" # json, xlsx, pdf
+
+class ReportJob(BaseModel):
+    id: int
+    report_type: str
+    params: Optional[str] = None
+    format: Optional[str] = "json"
+    status: str
+    requested_by: int
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
+    result_size: Optional[int] = None
+    error_message: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+# Dashboard Bootstrap Schema
+class DashboardBootstrap(BaseModel):
+    stats: dict
+    trends: List[dict]
+    notifications: List[Notification]
+    organization_config: OrganizationConfig
+    loan_products: List[LoanProduct]
+    branches: List[Branch]
@@ -0,0 +1,289 @@
+import os
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, func, select
+from sqlalchemy.orm import Session
+
+import models
+from utils import tenant_data_dir
+
+SYNC_BATCH_SIZE = int(os.getenv("ANALYTICS_SYNC_BATCH_SIZE", 5000))
+# Rows edited this close before the previous sync started are re-read, to
+# cover transactions that were still open (and clock drift between processes)
+SYNC_OVERLAP_SECONDS = int(os.getenv("ANALYTICS_SYNC_OVERLAP_SECONDS", 300))
+
+# table -> (model, columns left out of the store, statuses that can still change)
+# Rows are copied incrementally by id high-water mark. Tables with an updated_at
+# column (clients, loans) also re-read rows edited since the previous sync; rows
+# that were still in a non-final status at the previous sync are re-read so
+# status changes propagate in the others.
+SYNC_TABLES = {
+    "clients": (models.Client, {"address", "document_url"}, None),
+    "loans": (models.Loan, {"rejection_reason"}, ("pending", "approved", "active")),
+    "repayments": (models.Repayment, set(), None),
+    "expenses": (models.Expense, set(), None),
+    "disbursement_transactions": (models.DisbursementTransaction, {"mpesa_result_desc"}, ("pending", "submitting", "processing")),
+    "mpesa_incoming_transactions": (models.MpesaIncomingTransaction, {"raw_callback_data"}, ("unmatched",)),
+}
+
+# Small tables whose rows can be deleted through the API are reloaded in full
+FULL_REFRESH_TABLES = {"expenses"}
+# Larger tables with a delete endpoint (DELETE /clients/{id}) keep their
+# incremental copy; ids no longer in the database are dropped from the store
+PRUNED_TABLES = {"clients"}
+
+
+class AnalyticsStoreUnavailable(Exception):
+    pass
+
+
+def store_path() -> str:
+    return os.getenv("ANALYTICS_STORE_PATH") or os.path.join(tenant_data_dir("analytics"), "analytics.duckdb")
+
+
+def open_store(read_only: bool = True):
+    """
+    Opens the DuckDB file. DuckDB allows one writing process at a time, so
+    readers get AnalyticsStoreUnavailable while an export is running.
+    """
+    try:
+        import duckdb
+    except ImportError:
+        raise AnalyticsStoreUnavailable("duckdb is not installed")
+
+    path = store_path()
+    if read_only and not os.path.exists(path):
+        raise AnalyticsStoreUnavailable("Analytics store has not been exported yet")
+    try:
+        return duckdb.connect(path, read_only=read_only)
+    except duckdb.IOException as e:
+        raise AnalyticsStoreUnavailable(f"Analytics store is busy: {e}")
+
+
+def _duck_type(column) -> str:
+    if isinstance(column.type, Integer):
+        return "BIGINT"
+    if isinstance(column.type, Float):
+        return "DOUBLE"
+    if isinstance(column.type, Boolean):
+        return "BOOLEAN"
+    if isinstance(column.type, DateTime):
+        return "TIMESTAMP"
+    if isinstance(column.type, Date):
+        return "DATE"
+    return "VARCHAR"
+
+
+def _store_columns(table: str):
+    model, excluded, _ = SYNC_TABLES[table]
+    return [c for c in model.__table__.columns if c.name not in excluded]
+
+
+def _add_missing_columns(con, table: str, columns: dict) -> list:
+    """ALTERs in columns the store's copy of `table` lacks; returns their names."""
+    existing = {r[0] for r in con.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = ?", [table]
+    ).fetchall()}
+    added = [name for name in columns if name not in existing]
+    for name in added:
+        con.execute(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {columns[name]}')
+    return added
+
+
+def _ensure_schema(con):
+    """
+    Creates the store's tables, and adds columns the models gained since the
+    store was created. A table that gained columns is copied again in full
+    on this sync, so its existing rows get the new values.
+    """
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS _sync_state ("
+        "table_name VARCHAR PRIMARY KEY, last_id BIGINT, rows_total BIGINT, synced_at TIMESTAMP, "
+        "last_updated_at TIMESTAMP)"
+    )
+    _add_missing_columns(con, "_sync_state", {"last_updated_at": "TIMESTAMP"})
+    for table in SYNC_TABLES:
+        cols = ", ".join(
+            f'"{c.name}" {_duck_type(c)}' + (" PRIMARY KEY" if c.primary_key else "")
+            for c in _store_columns(table)
+        )
+        con.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({cols})')
+        added = _add_missing_columns(con, table, {c.name: _duck_type(c) for c in _store_columns(table)})
+        if added:
+            print(f"Analytics store: added {', '.join(added)} to {table}; copying it again")
+            con.execute("DELETE FROM _sync_state WHERE table_name = ?", [table])
+
+
+def _upsert(con, table: str, columns, rows):
+    if not rows:
+        return
+    names = ", ".join(f'"{c.name}"' for c in columns)
+    placeholders = ", ".join("?" for _ in columns)
+    con.executemany(f'INSERT OR REPLACE INTO "{table}" ({names}) VALUES ({placeholders})', rows)
+
+
+def _copy(db: Session, con, table: str, columns, condition) -> int:
+    model = SYNC_TABLES[table][0]
+    stmt = select(*[getattr(model, c.name) for c in columns]).where(condition).order_by(model.id)
+    result = db.execute(stmt.execution_options(yield_per=SYNC_BATCH_SIZE))
+    copied = 0
+    for batch in result.partitions():
+        rows = [tuple(r) for r in batch]
+        _upsert(con, table, columns, rows)
+        copied += len(rows)
+    return copied
+
+
+def _prune_deleted(db: Session, con, table: str, last_id: int) -> int:
+    """
+    Deletes the store's rows whose ids have gone from the database. The id
+    lists are only compared when the row counts up to last_id differ.
+    """
+    model = SYNC_TABLES[table][0]
+    live_count = db.query(func.count(model.id)).filter(model.id <= last_id).scalar()
+    stored_count = con.execute(f'SELECT count(*) FROM "{table}" WHERE id <= ?', [last_id]).fetchone()[0]
+    if live_count == stored_count:
+        return 0
+
+    live = set()
+    result = db.execute(select(model.id).where(model.id <= last_id).execution_options(yield_per=SYNC_BATCH_SIZE))
+    for batch in result.partitions():
+        live.update(r[0] for r in batch)
+    stored = con.execute(f'SELECT id FROM "{table}" WHERE id <= ?', [last_id]).fetchall()
+    gone = [r[0] for r in stored if r[0] not in live]
+    for i in range(0, len(gone), SYNC_BATCH_SIZE):
+        chunk = gone[i:i + SYNC_BATCH_SIZE]
+        con.execute(f'DELETE FROM "{table}" WHERE id IN ({", ".join("?" for _ in chunk)})', chunk)
+    return len(gone)
+
+
+def sync_table(db: Session, con, table: str) -> int:
+    model, _, open_statuses = SYNC_TABLES[table]
+    columns = _store_columns(table)
+
+    state = con.execute("SELECT last_id, last_updated_at FROM _sync_state WHERE table_name = ?", [table]).fetchone()
+    last_id = state[0] if state and state[0] is not None else 0
+    last_updated_at = state[1] if state else None
+    started = datetime.utcnow()
+    copied = 0
+
+    if table in FULL_REFRESH_TABLES:
+        con.execute(f'DELETE FROM "{table}"')
+        last_id = 0
+    elif table in PRUNED_TABLES and last_id:
+        _prune_deleted(db, con, table, last_id)
+
+    # Refresh rows that could have changed since the previous sync
+    if open_statuses and last_id:
+        placeholders = ", ".join("?" for _ in open_statuses)
+        open_ids = [r[0] for r in con.execute(
+            f'SELECT id FROM "{table}" WHERE status IN ({placeholders})', list(open_statuses)
+        ).fetchall()]
+        for i in range(0, len(open_ids), SYNC_BATCH_SIZE):
+            chunk = open_ids[i:i + SYNC_BATCH_SIZE]
+            copied += _copy(db, con, table, columns, model.id.in_(chunk))
+
+    # Refresh rows edited since the previous sync
+    if "updated_at" in model.__table__.columns and last_id and last_updated_at:
+        since = last_updated_at - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+        copied += _copy(db, con, table, columns, (model.updated_at >= since) & (model.id <= last_id))
+
+    copied += _copy(db, con, table, columns, model.id > last_id)
+
+    new_last_id = con.execute(f'SELECT max(id) FROM "{table}"').fetchone()[0] or 0
+    rows_total = con.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0]
+    con.execute(
+        "INSERT OR REPLACE INTO _sync_state (table_name, last_id, rows_total, synced_at, last_updated_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [table, new_last_id, rows_total, datetime.utcnow(), started]
+    )
+    return copied
+
+
+def export_all(db: Session, tables=None) -> dict:
+    con = open_store(read_only=False)
+    try:
+        _ensure_schema(con)
+        copied = {}
+        for table in tables or SYNC_TABLES:
+            con.execute("BEGIN TRANSACTION")
+            try:
+                copied[table] = sync_table(db, con, table)
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+        return copied
+    finally:
+        con.close()
+
+
+def sync_status() -> list:
+    con = open_store(read_only=True)
+    try:
+        rows = con.execute("SELECT table_name, last_id, rows_total, synced_at FROM _sync_state ORDER BY table_name").fetchall()
+        return [
+            {"table": r[0], "last_id": r[1], "rows": r[2], "synced_at": r[3]}
+            for r in rows
+        ]
+    finally:
+        con.close()
+
+
+# --- Report queries against the store ---
+
+def profit_loss(start_date: date, end_date: date) -> dict:
+    """Same figures as reports.compute_profit_loss, computed from the columnar copy."""
+    con = open_store(read_only=True)
+    try:
+        fee_income = con.execute(
+            "SELECT COALESCE(SUM(COALESCE(processing_fee, 0) + COALESCE(insurance_fee, 0) + COALESCE(valuation_fee, 0)), 0) "
+            "FROM loans WHERE start_date >= ? AND start_date <= ?",
+            [start_date, end_date + timedelta(days=1)]
+        ).fetchone()[0]
+
+        interest_income = con.execute(
+            "SELECT COALESCE(SUM(COALESCE(r.amount, 0) * (l.amount * COALESCE(l.interest_rate, 0) / 100) "
+            "/ (l.amount * (1 + COALESCE(l.interest_rate, 0) / 100))), 0) "
+            "FROM repayments r JOIN loans l ON l.id = r.loan_id "
+            "WHERE r.payment_date >= ? AND r.payment_date <= ? AND l.amount > 0",
+            [start_date, end_date]
+        ).fetchone()[0]
+
+        expenses = con.execute(
+            "SELECT category, amount, description FROM expenses WHERE date >= ? AND date <= ? ORDER BY id",
+            [start_date, end_date]
+        ).fetchall()
+    finally:
+        con.close()
+
+    total_income = fee_income + interest_income
+    total_expenses = sum([(e[1] or 0) for e in expenses])
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "fee_income": round(fee_income, 2),
+        "interest_income": round(interest_income, 2),
+        "total_income": round(total_income, 2),
+        "total_expenses": round(total_expenses, 2),
+        "net_profit": round(total_income - total_expenses, 2),
+        "expense_breakdown": [
+            {"category": e[0] or "Other", "amount": e[1], "description": e[2]}
+            for e in expenses
+        ],
+        "source": "analytics",
+    }
+
+
+def client_counts_by_month(start: datetime, end: datetime) -> dict:
+    """New clients per month between start and end, keyed by 'YYYY-MM'."""
+    con = open_store(read_only=True)
+    try:
+        rows = con.execute(
+            "SELECT strftime(created_at, '%Y-%m') AS month, count(*) FROM clients "
+            "WHERE created_at >= ? AND created_at <= ? GROUP BY month",
+            [start, end]
+        ).fetchall()
+        return {r[0]: r[1] for r in rows}
+    finally:
+        con.close()
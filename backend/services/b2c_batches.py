@@ -0,0 +1,270 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+
+B2C_MAX_CONCURRENCY = int(os.getenv("MPESA_B2C_MAX_CONCURRENCY", 5))
+B2C_RATE_PER_SECOND = float(os.getenv("MPESA_B2C_RATE_PER_SECOND", 5))
+B2C_BATCH_MAX_LOANS = int(os.getenv("MPESA_B2C_BATCH_MAX_LOANS", 500))
+
+# A loan with a disbursement in one of these states must not be paid again
+ACTIVE_DISBURSEMENT_STATUSES = ("pending", "submitting", "processing", "completed")
+
+Disbursement = models.DisbursementTransaction
+
+
+def active_disbursement_loan_ids(db: Session, loan_ids) -> set:
+    return {loan_id for (loan_id,) in db.query(Disbursement.loan_id).filter(
+        Disbursement.loan_id.in_(loan_ids), Disbursement.status.in_(ACTIVE_DISBURSEMENT_STATUSES)
+    ).with_for_update()}
+
+
+def request_fingerprint(loan_ids) -> str:
+    """Identifies the set of loans a batch was requested for, whatever their order."""
+    return hashlib.sha256(",".join(str(i) for i in sorted(set(loan_ids))).encode()).hexdigest()
+
+
+def create_batch(db: Session, loan_ids: list, user_id: int, idempotency_key: Optional[str] = None):
+    """
+    Creates a batch and one pending DisbursementTransaction per eligible loan
+    (a single multi-row INSERT), in the caller's transaction. The loans are
+    locked first, so two batches racing for the same loan cannot both take it.
+    Returns (batch, skipped); raises ValueError(skipped) if no loan is eligible.
+    """
+    loan_ids = list(dict.fromkeys(loan_ids))
+    rows = db.query(models.Loan.id, models.Loan.status, models.Loan.amount, models.Loan.client_id,
+                    models.Client.mpesa_phone)\
+        .outerjoin(models.Client, models.Client.id == models.Loan.client_id)\
+        .filter(models.Loan.id.in_(loan_ids)).with_for_update(of=models.Loan).all()
+    found = {row[0]: row for row in rows}
+    taken = active_disbursement_loan_ids(db, loan_ids)
+
+    eligible, skipped = [], []
+    for loan_id in loan_ids:
+        row = found.get(loan_id)
+        if row is None:
+            skipped.append({"loan_id": loan_id, "reason": "Loan not found"})
+        elif row[1] != "approved":
+            skipped.append({"loan_id": loan_id, "reason": f"Loan is {row[1]}, not approved"})
+        elif loan_id in taken:
+            skipped.append({"loan_id": loan_id, "reason": "Loan already disbursed or in progress"})
+        elif not row[4]:
+            skipped.append({"loan_id": loan_id, "reason": "Client has no M-Pesa phone number"})
+        else:
+            eligible.append(row)
+    if not eligible:
+        raise ValueError(skipped)
+
+    batch = models.DisbursementBatch(
+        idempotency_key=idempotency_key,
+        request_fingerprint=request_fingerprint(loan_ids),
+        status="queued",
+        total_count=len(eligible),
+        total_amount=sum(row[2] or 0 for row in eligible),
+        created_by=user_id
+    )
+    db.add(batch)
+    db.flush()
+
+    now = datetime.utcnow()
+    db.execute(insert(Disbursement), [{
+        "loan_id": loan_id, "client_id": client_id, "amount": amount, "method": "mpesa",
+        "mpesa_phone": mpesa_phone, "status": "pending", "initiated_by": user_id,
+        "initiated_at": now, "batch_id": batch.id
+    } for loan_id, _, amount, client_id, mpesa_phone in eligible])
+    return batch, skipped
+
+
+def batch_progress(db: Session, batch: models.DisbursementBatch) -> dict:
+    counts = dict(db.query(Disbursement.status, func.count(Disbursement.id))
+                  .filter(Disbursement.batch_id == batch.id).group_by(Disbursement.status).all())
+    items = db.query(Disbursement).filter(Disbursement.batch_id == batch.id).order_by(Disbursement.id).all()
+    return {
+        "id": batch.id,
+        "status": batch.status,
+        "total_count": batch.total_count,
+        "total_amount": batch.total_amount,
+        "created_at": batch.created_at,
+        "started_at": batch.started_at,
+        "completed_at": batch.completed_at,
+        "counts": counts,
+        "items": [{
+            "disbursement_id": d.id,
+            "loan_id": d.loan_id,
+            "client_id": d.client_id,
+            "amount": d.amount,
+            "mpesa_phone": d.mpesa_phone,
+            "status": d.status,
+            "originator_conversation_id": d.originator_conversation_id,
+            "mpesa_transaction_id": d.mpesa_transaction_id,
+            "error_message": d.error_message,
+        } for d in items],
+    }
+
+
+def apply_b2c_result(db: Session, trans: models.DisbursementTransaction, result_code, result_desc: str,
+                     mpesa_trans_id: Optional[str]):
+    """
+    Records Safaricom's final word on a disbursement, from the B2C result
+    callback or a transaction status query, in the caller's transaction.
+    A successful payment activates an approved loan.
+    """
+    trans.mpesa_result_code = str(result_code)
+    trans.mpesa_result_desc = result_desc
+    trans.mpesa_transaction_id = mpesa_trans_id
+    trans.completed_at = datetime.utcnow()
+
+    if int(result_code) == 0:
+        trans.status = "completed"
+        # Update loan status to active if it was approved
+        loan = db.query(models.Loan).filter(models.Loan.id == trans.loan_id).first()
+        if loan and loan.status == "approved":
+            loan.status = "active"
+    else:
+        trans.status = "failed"
+        trans.error_message = result_desc
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across all tasks of one batch."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# --- Short database steps, run in the threadpool with their own session
+
+def _start(batch_id: int) -> list:
+    db = SessionLocal()
+    try:
+        batch = db.get(models.DisbursementBatch, batch_id)
+        batch.status = "running"
+        batch.started_at = batch.started_at or datetime.utcnow()
+        db.commit()
+        return db.query(Disbursement.id, Disbursement.loan_id, Disbursement.mpesa_phone, Disbursement.amount)\
+            .filter(Disbursement.batch_id == batch_id, Disbursement.status == "pending")\
+            .order_by(Disbursement.id).all()
+    finally:
+        db.close()
+
+
+def _claim(disbursement_id: int) -> bool:
+    """pending -> submitting; only the runner that wins this may call Daraja for the item."""
+    db = SessionLocal()
+    try:
+        claimed = db.query(Disbursement).filter(Disbursement.id == disbursement_id, Disbursement.status == "pending")\
+            .update({"status": "submitting"}, synchronize_session=False)
+        db.commit()
+        return bool(claimed)
+    finally:
+        db.close()
+
+
+def _record(disbursement_id: int, response: Optional[dict], error: Optional[str], sent: bool):
+    db = SessionLocal()
+    try:
+        trans = db.get(Disbursement, disbursement_id)
+        if response is not None and response.get("ResponseCode") == "0":
+            trans.status = "processing"
+            trans.originator_conversation_id = response.get("OriginatorConversationID")
+        elif response is not None:
+            trans.status = "failed"
+            trans.error_message = response.get("ResponseDescription") or response.get("errorMessage")
+        elif not sent:
+            trans.status = "failed"
+            trans.error_message = error
+        else:
+            # Daraja may have accepted it; stays 'submitting' until its status is confirmed
+            trans.error_message = f"Outcome unknown: {error}"
+        db.commit()
+    finally:
+        db.close()
+
+
+def _finish(batch_id: int):
+    db = SessionLocal()
+    try:
+        batch = db.get(models.DisbursementBatch, batch_id)
+        remaining = db.query(func.count(Disbursement.id))\
+            .filter(Disbursement.batch_id == batch_id, Disbursement.status == "pending").scalar()
+        if remaining:
+            # Token or submission problems left items unsent; POST .../resume sends them
+            batch.status = "partial"
+            print(f"Disbursement batch #{batch_id}: {remaining} item(s) left pending")
+        else:
+            batch.status = "submitted"
+        batch.completed_at = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+
+
+async def run_batch(batch_id: int, service, callback_url: str,
+                    concurrency: int = B2C_MAX_CONCURRENCY, rate: float = B2C_RATE_PER_SECOND):
+    """
+    Submits the batch's pending disbursements to Daraja, at most `concurrency`
+    in flight and `rate` started per second. Safe to run again (e.g. after a
+    restart): each item is claimed before it is sent, and an item whose
+    request may have reached Safaricom is never sent a second time.
+    """
+    import httpx
+
+    try:
+        items = await run_in_threadpool(_start, batch_id)
+    except Exception:
+        await run_in_threadpool(_finish, batch_id)
+        raise
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    limiter = RateLimiter(rate)
+
+    async def submit(disbursement_id, loan_id, phone, amount):
+        async with semaphore:
+            await limiter.wait()
+            try:
+                # Token problems are found before the item is claimed, so it stays pending
+                await service.get_access_token()
+                if not await run_in_threadpool(_claim, disbursement_id):
+                    return
+            except Exception as e:
+                print(f"Disbursement #{disbursement_id} left pending: {e}")
+                return
+            response, error, sent = None, None, True
+            try:
+                response = await service.initiate_b2c(
+                    phone=phone,
+                    amount=amount,
+                    command_id="BusinessPayment",
+                    remarks=f"Loan Disbursement #{loan_id}",
+                    occasion="Loan",
+                    callback_url=callback_url
+                )
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                error, sent = str(e) or e.__class__.__name__, False
+            except Exception as e:
+                error = str(e) or e.__class__.__name__
+            await run_in_threadpool(_record, disbursement_id, response, error, sent)
+
+    try:
+        await asyncio.gather(*(submit(*item) for item in items))
+    finally:
+        await run_in_threadpool(_finish, batch_id)
+    print(f"Disbursement batch #{batch_id}: worked through {len(items)} item(s)")
@@ -0,0 +1,155 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from services.b2c_batches import RateLimiter, B2C_MAX_CONCURRENCY, B2C_RATE_PER_SECOND
+
+# A disbursement still 'processing' after this long has probably lost its result callback
+B2C_STUCK_AFTER_SECONDS = int(os.getenv("MPESA_B2C_STUCK_AFTER_SECONDS", 900))
+# Wait between status queries for the same disbursement
+B2C_RECHECK_SECONDS = int(os.getenv("MPESA_B2C_RECHECK_SECONDS", 600))
+# After this many unanswered queries the disbursement is left for manual review
+B2C_MAX_STATUS_CHECKS = int(os.getenv("MPESA_B2C_MAX_STATUS_CHECKS", 6))
+B2C_SWEEP_LIMIT = int(os.getenv("MPESA_B2C_SWEEP_LIMIT", 500))
+
+# TransactionStatus values that mean the money did not (or no longer) reach the customer
+FAILED_STATUSES = {"failed", "declined", "cancelled", "expired", "reversed"}
+
+Disbursement = models.DisbursementTransaction
+
+
+def parse_status_result(result: dict) -> Optional[tuple]:
+    """
+    (result code, description, receipt) for apply_b2c_result from a
+    transaction status query result, or None while the outcome is unknown
+    (the query itself failed, or the payment is still in flight).
+    """
+    if str(result.get("ResultCode")) != "0":
+        return None
+    parameters = (result.get("ResultParameters") or {}).get("ResultParameter") or []
+    if isinstance(parameters, dict):
+        parameters = [parameters]
+    values = {p.get("Key"): p.get("Value") for p in parameters}
+    status = str(values.get("TransactionStatus") or "").lower()
+    receipt = values.get("ReceiptNo") or result.get("TransactionID")
+    if status == "completed":
+        return 0, result.get("ResultDesc"), receipt
+    if status in FAILED_STATUSES:
+        return 1, f"Transaction {values.get('TransactionStatus')} (status query)", receipt
+    return None
+
+
+def _due_filter(now: datetime, stuck_after: int, recheck_after: int):
+    return (
+        Disbursement.status == "processing",
+        Disbursement.originator_conversation_id.isnot(None),
+        Disbursement.initiated_at < now - timedelta(seconds=stuck_after),
+        or_(Disbursement.status_checked_at.is_(None),
+            Disbursement.status_checked_at < now - timedelta(seconds=recheck_after)),
+        func.coalesce(Disbursement.status_checks, 0) < B2C_MAX_STATUS_CHECKS,
+    )
+
+
+def stuck_disbursements(db: Session, limit: int = B2C_SWEEP_LIMIT, stuck_after: int = B2C_STUCK_AFTER_SECONDS,
+                        recheck_after: int = B2C_RECHECK_SECONDS) -> list:
+    """(id, OriginatorConversationID, receipt) of processing disbursements due a status query, oldest first."""
+    return db.query(Disbursement.id, Disbursement.originator_conversation_id, Disbursement.mpesa_transaction_id)\
+        .filter(*_due_filter(datetime.utcnow(), stuck_after, recheck_after))\
+        .order_by(Disbursement.id).limit(limit).all()
+
+
+def needs_review(db: Session, stuck_after: int = B2C_STUCK_AFTER_SECONDS) -> dict:
+    """Stuck disbursements the sweeper cannot resolve on its own."""
+    cutoff = datetime.utcnow() - timedelta(seconds=stuck_after)
+    return {
+        # Sent without an answer, so there is no conversation ID to query by
+        "submitting": db.query(func.count(Disbursement.id))
+            .filter(Disbursement.status == "submitting", Disbursement.initiated_at < cutoff).scalar(),
+        "unanswered": db.query(func.count(Disbursement.id))
+            .filter(Disbursement.status == "processing",
+                    func.coalesce(Disbursement.status_checks, 0) >= B2C_MAX_STATUS_CHECKS).scalar(),
+    }
+
+
+# --- Short database steps, run in the threadpool with their own session
+
+def _claim(disbursement_id: int, recheck_after: int) -> bool:
+    """Stamps the query time first, so concurrent sweepers do not query the same disbursement."""
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        claimed = db.query(Disbursement).filter(
+            Disbursement.id == disbursement_id,
+            Disbursement.status == "processing",
+            or_(Disbursement.status_checked_at.is_(None),
+                Disbursement.status_checked_at < now - timedelta(seconds=recheck_after))
+        ).update({
+            Disbursement.status_checked_at: now,
+            Disbursement.status_checks: func.coalesce(Disbursement.status_checks, 0) + 1
+        }, synchronize_session=False)
+        db.commit()
+        return bool(claimed)
+    finally:
+        db.close()
+
+
+def _record(disbursement_id: int, response: Optional[dict], error: Optional[str]):
+    db = SessionLocal()
+    try:
+        trans = db.get(Disbursement, disbursement_id)
+        if response is not None and response.get("ResponseCode") == "0":
+            # The result callback names the query, not the original payment
+            trans.status_query_conversation_id = response.get("OriginatorConversationID")
+        else:
+            reason = error or (response or {}).get("errorMessage") or (response or {}).get("ResponseDescription")
+            trans.error_message = f"Status query not sent: {reason}"
+        db.commit()
+    finally:
+        db.close()
+
+
+async def sweep(service, callback_url: str, limit: int = B2C_SWEEP_LIMIT,
+                concurrency: int = B2C_MAX_CONCURRENCY, rate: float = B2C_RATE_PER_SECOND,
+                stuck_after: int = B2C_STUCK_AFTER_SECONDS, recheck_after: int = B2C_RECHECK_SECONDS) -> dict:
+    """
+    Sends a transaction status query for each stuck disbursement, at most
+    `concurrency` in flight and `rate` started per second. Results arrive
+    at `callback_url` (POST /mpesa/b2c/status-result) and are applied there
+    exactly as a late B2C result would be.
+    """
+    db = SessionLocal()
+    try:
+        items = stuck_disbursements(db, limit, stuck_after, recheck_after)
+    finally:
+        db.close()
+
+    counts = {"due": len(items), "sent": 0, "failed": 0}
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    limiter = RateLimiter(rate)
+
+    async def query(disbursement_id, conversation_id, receipt):
+        async with semaphore:
+            if not await run_in_threadpool(_claim, disbursement_id, recheck_after):
+                return
+            await limiter.wait()
+            response, error = None, None
+            try:
+                response = await service.check_transaction_status(
+                    transaction_id=receipt,
+                    callback_url=callback_url,
+                    original_conversation_id=conversation_id
+                )
+            except Exception as e:
+                error = str(e) or e.__class__.__name__
+            await run_in_threadpool(_record, disbursement_id, response, error)
+            counts["sent" if response is not None and response.get("ResponseCode") == "0" else "failed"] += 1
+
+    await asyncio.gather(*(query(*item) for item in items))
+    return counts
@@ -0,0 +1,194 @@
+import os
+from datetime import date, datetime, timedelta
+from itertools import chain
+from typing import Optional
+
+from sqlalchemy import delete, event, func, insert, inspect, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from services import loan_schedule
+
+REFRESH_BATCH_SIZE = int(os.getenv("COLLECTION_REFRESH_BATCH_SIZE", 1000))
+# A rebuild still holding the lock after this long belongs to a process that died
+REBUILD_LOCK_SECONDS = int(os.getenv("COLLECTION_REBUILD_LOCK_SECONDS", 900))
+REBUILD_LOCK = "collection_sheet_rebuild"
+
+# Client fields copied into loan_due_status; changing one re-files the client's loans
+CLIENT_FIELDS = ("branch_id", "created_by_id", "customer_group_id")
+
+
+def _status_rows(db: Session, as_of: date, loan_ids=None, client_ids=None):
+    paid = select(
+        models.Repayment.loan_id.label("loan_id"),
+        func.sum(models.Repayment.amount).label("total_paid"),
+        func.max(models.Repayment.payment_date).label("last_payment_date")
+    ).group_by(models.Repayment.loan_id)
+    if loan_ids is not None:
+        paid = paid.where(models.Repayment.loan_id.in_(loan_ids))
+    if client_ids is not None:
+        paid = paid.where(models.Repayment.loan_id.in_(
+            select(models.Loan.id).where(models.Loan.client_id.in_(client_ids))
+        ))
+    paid = paid.subquery()
+
+    stmt = select(
+        models.Loan.id, models.Loan.client_id, models.Client.branch_id, models.Client.created_by_id,
+        models.Client.customer_group_id, models.Loan.amount, models.Loan.interest_rate,
+        models.Loan.duration_months, models.Loan.repayment_frequency, models.Loan.start_date,
+        func.coalesce(paid.c.total_paid, 0), paid.c.last_payment_date
+    ).outerjoin(paid, paid.c.loan_id == models.Loan.id)\
+     .outerjoin(models.Client, models.Client.id == models.Loan.client_id)\
+     .where(models.Loan.status == "active")
+    if loan_ids is not None:
+        stmt = stmt.where(models.Loan.id.in_(loan_ids))
+    if client_ids is not None:
+        stmt = stmt.where(models.Loan.client_id.in_(client_ids))
+
+    result = db.execute(stmt.execution_options(yield_per=REFRESH_BATCH_SIZE))
+    try:
+        for (loan_id, client_id, branch_id, officer_id, group_id, amount, rate, duration,
+             frequency, start_date, total_paid, last_payment_date) in result:
+            num_installments, interval = loan_schedule.schedule_params(frequency, duration)
+            total = loan_schedule.total_due(amount, rate)
+            installment_amount = total / num_installments if num_installments > 0 else 0
+            total_paid = float(total_paid or 0)
+            due_date = loan_schedule.next_due_date(start_date, interval, num_installments, installment_amount, total_paid)
+            expected = loan_schedule.installments_due(start_date, interval, num_installments, as_of) * installment_amount
+            amount_due = round(max(expected - total_paid, 0), 2)
+            days_overdue = (as_of - due_date).days if due_date and due_date < as_of else 0
+            yield {
+                "loan_id": loan_id,
+                "client_id": client_id,
+                "branch_id": branch_id,
+                "officer_id": officer_id,
+                "customer_group_id": group_id,
+                "next_due_date": due_date,
+                "installment_amount": round(installment_amount, 2),
+                "amount_due": amount_due,
+                "days_overdue": days_overdue,
+                # An installment falling due today is not yet in arrears
+                "aging_bucket": loan_schedule.par_bucket(amount_due if days_overdue else 0, days_overdue),
+                "balance": round(max(total - total_paid, 0), 2),
+                "last_payment_date": last_payment_date,
+                "as_of": as_of,
+            }
+    finally:
+        result.close()
+
+
+def refresh(db: Session, as_of: date = None, loan_ids=None, client_ids=None) -> int:
+    """
+    Rewrites loan_due_status for the given loans/clients (all active loans when
+    neither is given) in the caller's transaction. Loans that are no longer
+    active simply lose their row. Returns the number of rows written.
+    """
+    as_of = as_of or date.today()
+    status = models.LoanDueStatus
+    stmt = delete(status)
+    if loan_ids is not None:
+        stmt = stmt.where(status.loan_id.in_(loan_ids))
+    if client_ids is not None:
+        stmt = stmt.where(status.client_id.in_(client_ids))
+    db.execute(stmt.execution_options(synchronize_session=False))
+
+    written, batch = 0, []
+    for row in _status_rows(db, as_of, loan_ids, client_ids):
+        batch.append(row)
+        if len(batch) >= REFRESH_BATCH_SIZE:
+            db.execute(insert(status), batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        db.execute(insert(status), batch)
+        written += len(batch)
+    return written
+
+
+def data_as_of(db: Session) -> Optional[date]:
+    """Date of the oldest row in loan_due_status; None while it is empty."""
+    return db.query(func.min(models.LoanDueStatus.as_of)).scalar()
+
+
+def needs_rebuild(db: Session, as_of: date = None) -> bool:
+    """True when loan_due_status has rows from before as_of, or active loans but no rows."""
+    oldest = data_as_of(db)
+    if oldest is None:
+        return db.query(models.Loan.id).filter(models.Loan.status == "active").first() is not None
+    return oldest < (as_of or date.today())
+
+
+def _claim_rebuild(db: Session) -> bool:
+    """Takes the rebuild lock row with a conditional update, so one process rebuilds at a time."""
+    lock = models.WorkerLock
+    if not db.query(lock.name).filter(lock.name == REBUILD_LOCK).first():
+        try:
+            db.add(lock(name=REBUILD_LOCK))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+    now = datetime.utcnow()
+    claimed = db.query(lock).filter(
+        lock.name == REBUILD_LOCK,
+        or_(lock.locked_at.is_(None), lock.locked_at < now - timedelta(seconds=REBUILD_LOCK_SECONDS))
+    ).update({"locked_at": now}, synchronize_session=False)
+    db.commit()
+    return bool(claimed)
+
+
+def rebuild(as_of: date = None):
+    """
+    The daily roll-over when refresh_collection_sheet.py has not run yet.
+    Request handlers schedule it as a background task and serve the rows
+    they have meanwhile, marked with data_as_of.
+    """
+    as_of = as_of or date.today()
+    db = SessionLocal()
+    try:
+        if not needs_rebuild(db, as_of) or not _claim_rebuild(db):
+            return
+        try:
+            written = refresh(db, as_of)
+            db.commit()
+            print(f"Rebuilt {written} loan due status row(s) for {as_of}")
+        except Exception as e:
+            db.rollback()
+            print(f"Collection sheet rebuild failed: {e}")
+        db.query(models.WorkerLock).filter(models.WorkerLock.name == REBUILD_LOCK)\
+            .update({"locked_at": None}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _changed(obj, attrs) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[a].history.has_changes() for a in attrs)
+
+
+def _refresh_touched(session: Session, flush_context):
+    loan_ids, client_ids = set(), set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, models.Repayment):
+            loan_ids.add(obj.loan_id)
+            if obj not in session.new and _changed(obj, ("loan_id",)):
+                loan_ids.update(inspect(obj).attrs.loan_id.history.deleted)
+        elif isinstance(obj, models.Loan):
+            if obj in session.new or _changed(obj, ("status", "amount", "interest_rate", "duration_months",
+                                                    "repayment_frequency", "start_date", "client_id")):
+                loan_ids.add(obj.id)
+        elif isinstance(obj, models.Client) and obj not in session.new:
+            if _changed(obj, CLIENT_FIELDS):
+                client_ids.add(obj.id)
+
+    loan_ids.discard(None)
+    if loan_ids:
+        refresh(session, loan_ids=sorted(loan_ids))
+    if client_ids:
+        refresh(session, client_ids=sorted(client_ids))
+
+
+# Same transaction as the write, like services/dashboard_counters.py
+event.listen(Session, "after_flush", _refresh_touched)
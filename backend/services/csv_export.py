@@ -0,0 +1,52 @@
+import csv
+import io
+import os
+from datetime import date, datetime
+
+from fastapi.responses import StreamingResponse
+
+from database import SessionLocal
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 2000))
+
+
+def _format(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def iter_csv(build_statement, headers):
+    """
+    Yields CSV text one batch at a time. The statement is built and executed
+    on a session owned by the generator, because the request's session may
+    already be closed by the time the response body is streamed.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    yield buffer.getvalue()
+
+    db = SessionLocal()
+    try:
+        stmt = build_statement().execution_options(yield_per=EXPORT_BATCH_SIZE)
+        for batch in db.execute(stmt).partitions():
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows([[_format(v) for v in row] for row in batch])
+            yield buffer.getvalue()
+    finally:
+        db.close()
+
+
+def csv_response(build_statement, headers, filename: str) -> StreamingResponse:
+    stamp = date.today().isoformat()
+    return StreamingResponse(
+        iter_csv(build_statement, headers),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}_{stamp}.csv"'}
+    )
@@ -0,0 +1,152 @@
+from datetime import datetime
+from itertools import chain
+
+from sqlalchemy import event, func, inspect, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from database import TENANT_KEY
+
+# Loan statuses that count towards disbursed amount and revenue
+BOOKED_STATUSES = ("active", "completed")
+
+COUNTER_FIELDS = ("total_disbursed", "total_revenue", "total_expenses", "active_clients", "active_loans")
+
+
+def _before(obj, attr):
+    """Value of an attribute before the pending flush."""
+    history = inspect(obj).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(obj, attr)
+
+
+def _loan_contribution(status, amount, rate):
+    amount = amount or 0
+    booked = status in BOOKED_STATUSES
+    return {
+        "total_disbursed": amount if booked else 0,
+        "total_revenue": amount * (rate or 0) / 100 if booked else 0,
+        "active_loans": 1 if status == "active" else 0,
+    }
+
+
+def _collect_deltas(session: Session) -> dict:
+    deltas = dict.fromkeys(COUNTER_FIELDS, 0)
+    new, dirty, deleted = session.new, session.dirty, session.deleted
+
+    for obj in chain(new, dirty, deleted):
+        if isinstance(obj, models.Loan):
+            before = {} if obj in new else _loan_contribution(
+                _before(obj, "status"), _before(obj, "amount"), _before(obj, "interest_rate")
+            )
+            after = {} if obj in deleted else _loan_contribution(obj.status, obj.amount, obj.interest_rate)
+            for key in ("total_disbursed", "total_revenue", "active_loans"):
+                deltas[key] += after.get(key, 0) - before.get(key, 0)
+
+        elif isinstance(obj, models.Client):
+            if obj in new:
+                deltas["active_clients"] += 1
+            elif obj in deleted:
+                deltas["active_clients"] -= 1
+
+        elif isinstance(obj, models.Expense):
+            before = 0 if obj in new else (_before(obj, "amount") or 0)
+            after = 0 if obj in deleted else (obj.amount or 0)
+            deltas["total_expenses"] += after - before
+
+    return {k: v for k, v in deltas.items() if v}
+
+
+def _apply_deltas(session: Session, flush_context):
+    deltas = _collect_deltas(session)
+    if not deltas:
+        return
+    counter = models.DashboardCounter
+    # Relative UPDATE in the writer's own transaction: commits or rolls back with the data
+    session.execute(
+        update(counter)
+        .where(counter.tenant_key == TENANT_KEY)
+        .values({getattr(counter, k): getattr(counter, k) + v for k, v in deltas.items()})
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    return value
+
+
+# Attributes are expired after commit, so a plain assignment would record no
+# previous value; active_history loads it first so _before() can see it.
+for _attr in (models.Loan.status, models.Loan.amount, models.Loan.interest_rate, models.Expense.amount):
+    event.listen(_attr, "set", _keep_old_value, active_history=True, retval=True)
+
+# Registered on the Session class, so it applies in any process that imports this
+# module (the API does via routers/dashboard.py). Scripts that write loans,
+# clients or expenses without it (e.g. bulk_import_clients.py) should be
+# followed by reconcile_counters.py.
+event.listen(Session, "after_flush", _apply_deltas)
+
+
+def compute_totals(db: Session) -> dict:
+    """Full-table aggregates; used to seed and reconcile the counters."""
+    total_disbursed, total_revenue = db.query(
+        func.sum(models.Loan.amount),
+        func.sum(models.Loan.amount * models.Loan.interest_rate / 100)
+    ).filter(models.Loan.status.in_(BOOKED_STATUSES)).one()
+
+    return {
+        "total_disbursed": float(total_disbursed or 0),
+        "total_revenue": float(total_revenue or 0),
+        "total_expenses": float(db.query(func.sum(models.Expense.amount)).scalar() or 0),
+        "active_clients": db.query(func.count(models.Client.id)).scalar() or 0,
+        "active_loans": db.query(func.count(models.Loan.id)).filter(models.Loan.status == "active").scalar() or 0,
+    }
+
+
+def reconcile(db: Session) -> dict:
+    """
+    Recomputes the counters from the base tables and corrects any drift.
+    The counter row is locked first, so writers that already applied a delta
+    have committed and later writers wait until the new totals are stored.
+    """
+    counter = db.query(models.DashboardCounter).filter(
+        models.DashboardCounter.tenant_key == TENANT_KEY
+    ).with_for_update().first()
+    if not counter:
+        counter = models.DashboardCounter(tenant_key=TENANT_KEY)
+        db.add(counter)
+
+    totals = compute_totals(db)
+    drift = {k: totals[k] - (getattr(counter, k) or 0) for k in COUNTER_FIELDS}
+    for key, value in totals.items():
+        setattr(counter, key, value)
+    counter.reconciled_at = datetime.utcnow()
+    db.commit()
+    return {k: round(v, 2) for k, v in drift.items() if abs(v) > 0.005}
+
+
+def get_counters(db: Session) -> models.DashboardCounter:
+    counter = db.get(models.DashboardCounter, TENANT_KEY)
+    if counter is None:
+        # First read seeds the row; a concurrent seeder may win the insert
+        try:
+            reconcile(db)
+        except IntegrityError:
+            db.rollback()
+        counter = db.get(models.DashboardCounter, TENANT_KEY)
+    return counter
+
+
+def as_stats(counter: models.DashboardCounter) -> dict:
+    """The /dashboard/stats payload for a counter row."""
+    return {
+        "total_disbursed": float(counter.total_disbursed or 0),
+        "active_clients": counter.active_clients or 0,
+        "total_revenue": float(counter.total_revenue or 0),
+        "total_expenses": float(counter.total_expenses or 0),
+        "active_loans": counter.active_loans or 0,
+    }
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+from datetime import date
+from itertools import chain
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from services import dashboard_counters
+
+# Without a local write to react to, connected dashboards are refreshed at most
+# this often (picks up writes made by other processes, e.g. workers).
+DASHBOARD_STREAM_POLL_SECONDS = int(os.getenv("DASHBOARD_STREAM_POLL_SECONDS", 10))
+DASHBOARD_STREAM_HEARTBEAT_SECONDS = int(os.getenv("DASHBOARD_STREAM_HEARTBEAT_SECONDS", 15))
+DASHBOARD_STREAM_RETRY_MS = int(os.getenv("DASHBOARD_STREAM_RETRY_MS", 5000))
+
+STREAM_TABLES = {"repayments", "loans", "clients", "expenses", "disbursement_transactions"}
+
+
+def _data_version(db: Session):
+    """Cheap fingerprint that changes whenever the dashboard figures can have changed."""
+    counter = dashboard_counters.get_counters(db)
+    last_repayment = db.query(func.max(models.Repayment.id)).scalar()
+    return (counter.updated_at, counter.active_clients, last_repayment)
+
+
+def _read(known_version):
+    from routers.dashboard import month_trend
+
+    db = SessionLocal()
+    try:
+        version = _data_version(db)
+        if version == known_version:
+            return version, None
+        snapshot = {
+            "stats": dashboard_counters.as_stats(dashboard_counters.get_counters(db)),
+            "current_month": month_trend(db, date.today()),
+        }
+        return version, jsonable_encoder(snapshot)
+    finally:
+        db.close()
+
+
+def _diff(old: dict, new: dict) -> dict:
+    delta = {}
+    for section, values in new.items():
+        changed = {k: v for k, v in values.items() if (old or {}).get(section, {}).get(k) != v}
+        if changed:
+            delta[section] = changed
+    return delta
+
+
+def format_event(event_id: int, name: str, data) -> str:
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class DashboardBroadcaster:
+    """
+    Fans one dashboard computation out to every connected stream of this
+    process (one process serves one tenant). A refresh runs when a local
+    commit touches a dashboard table, or every poll interval otherwise; it
+    is skipped when the data version has not moved, and subscribers only
+    receive the fields that changed.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.event_id = 0
+        self._version = None
+        self._subscribers = set()
+        self._loop = None
+        self._wake = None
+        self._lock = None
+        self._task = None
+
+    async def subscribe(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._wake, self._lock = loop, asyncio.Event(), asyncio.Lock()
+            self._task = None
+        if self.snapshot is None:
+            # First listener: compute before joining so it only gets the snapshot
+            await self._refresh()
+        queue = asyncio.Queue(maxsize=50)
+        self._subscribers.add(queue)
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def notify(self):
+        """Thread-safe: called from request threads after a relevant commit."""
+        loop, wake = self._loop, self._wake
+        if loop is not None and wake is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wake.set)
+
+    async def _run(self):
+        while self._subscribers:
+            try:
+                await asyncio.wait_for(self._wake.wait(), DASHBOARD_STREAM_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self._refresh()
+            except Exception as e:
+                print(f"Dashboard stream refresh failed: {e}")
+        # Idle with nobody listening; the next subscriber restarts it
+        self._task = None
+        self.snapshot = None
+        self._version = None
+
+    async def _refresh(self):
+        async with self._lock:
+            version, snapshot = await run_in_threadpool(_read, self._version)
+            if snapshot is None:
+                return
+            delta = _diff(self.snapshot, snapshot)
+            self._version, self.snapshot = version, snapshot
+            if not delta:
+                return
+            self.event_id += 1
+            message = (self.event_id, "delta", delta)
+            for queue in list(self._subscribers):
+                try:
+                    queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    # A stalled client gets a full snapshot once it catches up
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait((self.event_id, "snapshot", self.snapshot))
+
+
+dashboard_broadcaster = DashboardBroadcaster()
+
+
+def _record_writes(session: Session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if getattr(obj, "__tablename__", None) in STREAM_TABLES:
+            session.info["dashboard_stream_dirty"] = True
+            return
+
+
+def _notify_on_commit(session: Session):
+    if session.info.pop("dashboard_stream_dirty", False):
+        dashboard_broadcaster.notify()
+
+
+def _discard_on_rollback(session: Session):
+    session.info.pop("dashboard_stream_dirty", None)
+
+
+event.listen(Session, "after_flush", _record_writes)
+event.listen(Session, "after_commit", _notify_on_commit)
+event.listen(Session, "after_rollback", _discard_on_rollback)
@@ -0,0 +1,126 @@
+from datetime import date, timedelta
+
+# Shared flat-rate schedule arithmetic (mirrors loans.get_loan_schedule) so
+# reports can work out what is due without building each schedule row by row.
+
+PAR_BUCKETS = ("current", "par_30", "par_60", "par_90", "par_90plus")
+
+
+def schedule_params(frequency: str, duration_months: int):
+    """Returns (num_installments, interval_days) for a repayment frequency."""
+    duration_months = duration_months or 0
+    if frequency == "daily":
+        return duration_months * 30, 1
+    if frequency == "weekly":
+        return duration_months * 4, 7
+    return duration_months, 30
+
+
+def total_due(amount: float, interest_rate: float) -> float:
+    return (amount or 0) * (1 + ((interest_rate or 0) / 100))
+
+
+def installments_due(start_date: date, interval_days: int, num_installments: int, as_of: date) -> int:
+    """Number of installments whose due date (start + k * interval) is on or before as_of."""
+    if not start_date or as_of < start_date or not interval_days:
+        return 0
+    return min(num_installments, (as_of - start_date).days // interval_days)
+
+
+def next_due_date(start_date: date, interval_days: int, num_installments: int,
+                  installment_amount: float, total_paid: float):
+    """Due date of the first installment not yet fully paid, or None once all are covered."""
+    if not start_date or not interval_days or num_installments <= 0 or not installment_amount:
+        return None
+    paid_installments = int(((total_paid or 0) + 0.005) // installment_amount)
+    if paid_installments >= num_installments:
+        return None
+    return start_date + timedelta(days=(paid_installments + 1) * interval_days)
+
+
+def arrears(amount, interest_rate, duration_months, frequency, start_date, total_paid, as_of: date):
+    """
+    Returns (amount_overdue, days_overdue) for a loan, estimating days overdue
+    from the number of unpaid installments as the PAR report always has.
+    """
+    num_installments, interval = schedule_params(frequency, duration_months)
+    if num_installments <= 0:
+        return 0.0, 0
+    installment_amount = total_due(amount, interest_rate) / num_installments
+    expected_paid = installments_due(start_date, interval, num_installments, as_of) * installment_amount
+
+    if (total_paid or 0) >= expected_paid:
+        return 0.0, 0
+    amount_overdue = expected_paid - (total_paid or 0)
+    days_overdue = int((amount_overdue / installment_amount) * interval) if installment_amount else 0
+    return amount_overdue, days_overdue
+
+
+def par_bucket(amount_overdue: float, days_overdue: int) -> str:
+    if amount_overdue <= 0:
+        return "current"
+    if days_overdue <= 30:
+        return "par_30"
+    if days_overdue <= 60:
+        return "par_60"
+    if days_overdue <= 90:
+        return "par_90"
+    return "par_90plus"
+
+
+def upcoming_installments(start_date: date, interval_days: int, num_installments: int,
+                          installment_amount: float, total_paid: float, as_of: date):
+    """
+    Returns (first, last) installment numbers still to fall due after as_of.
+    Installments already covered by prepayments are skipped; first > last
+    when nothing is left to collect.
+    """
+    if not start_date or not interval_days or num_installments <= 0:
+        return 1, 0
+    due = installments_due(start_date, interval_days, num_installments, as_of)
+    prepaid = int((total_paid or 0) // installment_amount) if installment_amount else num_installments
+    return max(due, prepaid) + 1, num_installments
+
+
+class InstallmentCalendar:
+    """
+    Sums installments per day over a horizon without expanding each schedule.
+
+    Installment k of a loan falls (start - as_of).days + k * interval days out,
+    so every loan's future installments form an arithmetic run of days. Runs
+    sharing an interval and a phase (day offset modulo interval) are added to
+    one difference array in O(1) per loan; totals() expands each array once.
+    """
+
+    def __init__(self, as_of: date, horizon_days: int):
+        self.as_of = as_of
+        self.horizon_days = horizon_days
+        self._runs = {}  # (interval, phase) -> difference array over occurrences
+
+    def add(self, start_date: date, interval_days: int, first: int, last: int, amount: float):
+        if first > last or not amount:
+            return
+        base = (start_date - self.as_of).days
+        # Clip the run to installments due on days 1..horizon_days
+        lo = max(first, -(-(1 - base) // interval_days))
+        hi = min(last, (self.horizon_days - base) // interval_days)
+        if lo > hi:
+            return
+        first_offset = base + lo * interval_days
+        phase = (first_offset - 1) % interval_days + 1
+        runs = self._runs.get((interval_days, phase))
+        if runs is None:
+            runs = self._runs[(interval_days, phase)] = [0.0] * ((self.horizon_days - phase) // interval_days + 2)
+        j = (first_offset - phase) // interval_days
+        runs[j] += amount
+        runs[j + (hi - lo) + 1] -= amount
+
+    def totals(self):
+        """List of amounts due on days 1..horizon_days after as_of."""
+        days = [0.0] * (self.horizon_days + 1)
+        for (interval, phase), runs in self._runs.items():
+            running = 0.0
+            for j, delta in enumerate(runs[:-1]):
+                running += delta
+                days[phase + j * interval] += running
+        return days[1:]
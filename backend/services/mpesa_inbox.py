@@ -0,0 +1,308 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from services.msisdn import client_phone_map
+
+INBOX_BATCH_SIZE = int(os.getenv("MPESA_INBOX_BATCH_SIZE", 200))
+INBOX_MAX_ATTEMPTS = int(os.getenv("MPESA_INBOX_MAX_ATTEMPTS", 5))
+# A row still 'processing' after this long belongs to a worker that died
+INBOX_STALE_SECONDS = int(os.getenv("MPESA_INBOX_STALE_SECONDS", 300))
+INBOX_RETENTION_DAYS = int(os.getenv("MPESA_INBOX_RETENTION_DAYS", 7))
+RECENT_IDS_MAX = int(os.getenv("MPESA_RECENT_IDS_MAX", 50000))
+
+Inbox = models.MpesaCallbackInbox
+
+
+class RecentTransactionIds:
+    """
+    Bounded set of M-Pesa transaction IDs this process has already accepted.
+    Daraja re-delivers a callback when our ack is slow or lost; those repeats
+    are answered from here without touching the database.
+    """
+
+    def __init__(self, maxsize: int = RECENT_IDS_MAX):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._ids = OrderedDict()
+
+    def __contains__(self, trans_id) -> bool:
+        with self._lock:
+            return trans_id in self._ids
+
+    def add(self, trans_id):
+        if not trans_id:
+            return
+        with self._lock:
+            self._ids[trans_id] = None
+            self._ids.move_to_end(trans_id)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+
+recent_transaction_ids = RecentTransactionIds()
+
+
+def is_duplicate(db: Session, trans_id: str) -> bool:
+    """Seen before, per the recent-ID set or else the unique transaction ID indexes (read-only)."""
+    if not trans_id:
+        return False
+    if trans_id in recent_transaction_ids:
+        return True
+    seen = db.query(models.MpesaIncomingTransaction.id)\
+        .filter(models.MpesaIncomingTransaction.transaction_id == trans_id).first() \
+        or db.query(Inbox.id).filter(Inbox.transaction_id == trans_id).first()
+    db.rollback()  # End the read so no transaction is held open
+    if seen:
+        recent_transaction_ids.add(trans_id)
+    return bool(seen)
+
+
+def enqueue(db: Session, kind: str, body: bytes) -> Optional[int]:
+    """
+    Stores a callback exactly as received. This is all the callback endpoint
+    does before acknowledging, so Safaricom gets its answer in one insert.
+    A re-delivered transaction is not stored again; returns None for it.
+    """
+    payload = body.decode("utf-8", errors="replace")
+    try:
+        data = json.loads(payload)
+        msisdn = str(data.get("MSISDN", "")).replace("+", "")
+        trans_id = str(data.get("TransID") or "")[:100] or None
+    except (ValueError, AttributeError):
+        msisdn, trans_id = "", None  # Still kept; the worker marks it failed with the parse error
+
+    if is_duplicate(db, trans_id):
+        return None
+    try:
+        result = db.execute(insert(Inbox).values(
+            kind=kind, transaction_id=trans_id, msisdn=msisdn[:20], payload=payload,
+            status="pending", attempts=0, received_at=datetime.utcnow()
+        ))
+        db.commit()
+    except IntegrityError:
+        # The same callback arrived concurrently and the other copy won
+        db.rollback()
+        recent_transaction_ids.add(trans_id)
+        return None
+    recent_transaction_ids.add(trans_id)
+    return result.inserted_primary_key[0]
+
+
+def _statement_import(incoming: models.MpesaIncomingTransaction) -> bool:
+    """True for an unmatched row added by services/mpesa_statement.py."""
+    if incoming.status != "unmatched" or incoming.repayment_id:
+        return False
+    try:
+        return json.loads(incoming.raw_callback_data or "{}").get("source") == "statement"
+    except ValueError:
+        return False
+
+
+def process_c2b(db: Session, data: dict) -> models.MpesaIncomingTransaction:
+    """Records a C2B confirmation and matches it to a registration or loan."""
+    trans_id = data.get('TransID')
+    amount = float(data.get('TransAmount', 0))
+    phone = data.get('MSISDN', '').replace('+', '')
+    bill_ref = data.get('BillRefNumber', '').strip().upper()
+
+    existing = db.query(models.MpesaIncomingTransaction)\
+        .filter(models.MpesaIncomingTransaction.transaction_id == trans_id).first()
+    if existing and not _statement_import(existing):
+        # Already applied (e.g. a duplicate that reached the inbox before the index saw it)
+        return existing
+
+    if existing:
+        # A statement import recorded this payment before its callback was
+        # processed; match it now like any other callback
+        incoming = existing
+        incoming.raw_callback_data = json.dumps(data)
+    else:
+        # Log the incoming transaction
+        incoming = models.MpesaIncomingTransaction(
+            transaction_id=trans_id,
+            amount=amount,
+            phone=phone,
+            bill_ref=bill_ref,
+            raw_callback_data=json.dumps(data),
+            status="unmatched"
+        )
+        db.add(incoming)
+    db.flush()
+
+    # Try to match based on BillRefNumber (Loan Application REG or Loan Ref)
+    if bill_ref.startswith('REG'):
+        try:
+            app_id = int(bill_ref.replace('REG', ''))
+            application = db.query(models.RegistrationApplication).filter(models.RegistrationApplication.id == app_id).first()
+            if application and application.status == "pending":
+                application.status = "paid"
+                application.mpesa_transaction_id = trans_id
+                application.amount_paid = amount
+                incoming.status = "matched"
+        except: pass
+
+    # Match based on BillRef as Loan ID if numeric or match phone to active loan
+    if incoming.status == "unmatched":
+        loan = None
+        if bill_ref.isdigit():
+            loan = db.query(models.Loan).filter(models.Loan.id == int(bill_ref), models.Loan.status == "active").first()
+
+        if not loan:
+            client_id = client_phone_map.find_client_id(db, phone)
+            if client_id:
+                loan = db.query(models.Loan).filter(models.Loan.client_id == client_id, models.Loan.status == "active").first()
+
+        if loan:
+            repayment = models.Repayment(
+                loan_id=loan.id,
+                amount=amount,
+                payment_date=datetime.now().date(),
+                notes=f"Auto-matched M-Pesa {trans_id}",
+                mpesa_transaction_id=trans_id,
+                payment_method="mpesa"
+            )
+            db.add(repayment)
+            db.flush()
+            incoming.status = "matched"
+            incoming.loan_id = loan.id
+            incoming.client_id = loan.client_id
+            incoming.repayment_id = repayment.id
+
+    return incoming
+
+
+HANDLERS = {"c2b": process_c2b}
+
+
+def release_stale(db: Session) -> int:
+    """Returns rows claimed by a worker that stopped mid-batch to the queue."""
+    cutoff = datetime.utcnow() - timedelta(seconds=INBOX_STALE_SECONDS)
+    released = db.query(Inbox).filter(Inbox.status == "processing", Inbox.claimed_at < cutoff)\
+        .update({"status": "pending", "claimed_at": None}, synchronize_session=False)
+    db.commit()
+    return released
+
+
+CLAIM_LOCK = "mpesa_inbox_claim"
+
+
+def _lock_claims(db: Session):
+    """
+    Takes the claim lock row for the rest of the transaction (a row lock on
+    MySQL/PostgreSQL, the write lock on SQLite), so workers claim one at a time
+    and never see each other's half-finished claims.
+    """
+    locked = db.query(models.WorkerLock).filter(models.WorkerLock.name == CLAIM_LOCK)\
+        .update({"locked_at": datetime.utcnow()}, synchronize_session=False)
+    if locked:
+        return
+    try:
+        with db.begin_nested():
+            db.add(models.WorkerLock(name=CLAIM_LOCK, locked_at=datetime.utcnow()))
+    except IntegrityError:
+        # Another worker created it first; wait for its lock
+        db.query(models.WorkerLock).filter(models.WorkerLock.name == CLAIM_LOCK)\
+            .update({"locked_at": datetime.utcnow()}, synchronize_session=False)
+
+
+def claim_batch(db: Session, limit: int = INBOX_BATCH_SIZE) -> list:
+    """
+    Moves the oldest pending callbacks to 'processing' and returns them in
+    arrival order. Phones with a callback already being processed by another
+    worker are skipped, so each payer's callbacks are applied in order. Claims
+    run under a lock row, so two workers can neither take the same row nor
+    take different rows for the same phone.
+    """
+    _lock_claims(db)
+    busy = select(Inbox.msisdn).where(Inbox.status == "processing")
+    ids = [row_id for (row_id,) in db.query(Inbox.id).filter(
+        Inbox.status == "pending", Inbox.msisdn.notin_(busy)
+    ).order_by(Inbox.id).limit(limit)]
+    if not ids:
+        db.commit()
+        return []
+
+    claimed = db.query(Inbox).filter(Inbox.id.in_(ids), Inbox.status == "pending")\
+        .update({"status": "processing", "claimed_at": datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    if claimed != len(ids):
+        # Cannot happen while every claimer takes the lock; say so if one does not
+        print(f"Callback inbox: claimed {claimed} of {len(ids)} selected row(s)")
+    return db.query(Inbox).filter(Inbox.id.in_(ids), Inbox.status == "processing")\
+        .order_by(Inbox.id).all()
+
+
+def process_batch(db: Session, rows: list) -> dict:
+    """
+    Applies each claimed callback in its own transaction. When one fails and
+    will be retried, the same payer's later callbacks in the batch are put
+    back untouched rather than overtaking it.
+    """
+    counts = {"done": 0, "retry": 0, "failed": 0, "deferred": 0}
+    blocked = set()
+
+    for row_id, kind, msisdn, payload in [(r.id, r.kind, r.msisdn, r.payload) for r in rows]:
+        if msisdn and msisdn in blocked:
+            db.query(Inbox).filter(Inbox.id == row_id)\
+                .update({"status": "pending", "claimed_at": None}, synchronize_session=False)
+            db.commit()
+            counts["deferred"] += 1
+            continue
+
+        try:
+            HANDLERS[kind](db, json.loads(payload))
+            db.query(Inbox).filter(Inbox.id == row_id)\
+                .update({"status": "done", "processed_at": datetime.utcnow(), "error_message": None},
+                        synchronize_session=False)
+            db.commit()
+            counts["done"] += 1
+        except Exception as e:
+            db.rollback()
+            row = db.get(Inbox, row_id)
+            row.attempts = (row.attempts or 0) + 1
+            row.error_message = str(e)[:1000]
+            row.claimed_at = None
+            # Payloads that do not parse will never succeed
+            if row.attempts >= INBOX_MAX_ATTEMPTS or isinstance(e, (ValueError, KeyError)):
+                row.status = "failed"
+                counts["failed"] += 1
+            else:
+                row.status = "pending"
+                blocked.add(msisdn)
+                counts["retry"] += 1
+            db.commit()
+            print(f"M-Pesa callback #{row_id} {row.status}: {e}")
+
+    return counts
+
+
+def purge_done(db: Session) -> int:
+    """Processed callbacks are also kept on mpesa_incoming_transactions; drop old inbox copies."""
+    cutoff = datetime.utcnow() - timedelta(days=INBOX_RETENTION_DAYS)
+    result = db.execute(delete(Inbox).where(Inbox.status == "done", Inbox.processed_at < cutoff))
+    db.commit()
+    return result.rowcount
+
+
+def metrics(db: Session) -> dict:
+    """Queue depth and lag, for /mpesa/metrics and the worker log."""
+    by_status = dict(db.query(Inbox.status, func.count(Inbox.id)).group_by(Inbox.status).all())
+    oldest = db.query(func.min(Inbox.received_at)).filter(Inbox.status.in_(("pending", "processing"))).scalar()
+    hour_ago = datetime.utcnow() - timedelta(hours=1)
+    return {
+        "pending": by_status.get("pending", 0),
+        "processing": by_status.get("processing", 0),
+        "failed": by_status.get("failed", 0),
+        "done_last_hour": db.query(func.count(Inbox.id))
+            .filter(Inbox.status == "done", Inbox.processed_at >= hour_ago).scalar(),
+        "oldest_pending_seconds": round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else 0,
+    }
@@ -0,0 +1,250 @@
+import re
+from datetime import datetime
+from collections import defaultdict
+from typing import Optional
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+import models
+from models import normalize_msisdn
+
+PROPOSAL_BATCH_SIZE = 2000
+# Share of the installment a payment may be off by and still count as "the installment"
+AMOUNT_TOLERANCE = 0.02
+
+# Loan references as customers type them: LOAN123, LN-123, L 123, #0123, LOAN/123
+ACCOUNT_REF = re.compile(r"^(?:LOAN|LN|L|#)[\s\-_#/.:]*0*(\d{1,9})$")
+
+CONFIDENCE_ORDER = {"low": 0, "medium": 1, "high": 2}
+
+Incoming = models.MpesaIncomingTransaction
+
+
+def parse_loan_ref(bill_ref: str):
+    """(loan_id, rule) read from an account reference, or (None, None)."""
+    ref = (bill_ref or "").strip().upper()
+    if ref.isdigit() and len(ref) <= 9:
+        return int(ref), "bill_ref_loan_id"
+    match = ACCOUNT_REF.match(ref)
+    if match:
+        return int(match.group(1)), "account_ref"
+    return None, None
+
+
+def _amount_fits(amount: float, installment: float, amount_due: float) -> Optional[str]:
+    """Why this payment looks meant for this loan, judged by amount alone."""
+    if not amount:
+        return None
+    if amount_due and abs(amount - amount_due) <= amount_due * AMOUNT_TOLERANCE:
+        return "amount equals arrears"
+    if installment:
+        multiple = round(amount / installment)
+        if multiple >= 1 and abs(amount - multiple * installment) <= installment * AMOUNT_TOLERANCE:
+            return "amount equals installment" if multiple == 1 else f"amount equals {multiple} installments"
+    return None
+
+
+def _lookups(db: Session, txns: list) -> tuple:
+    """
+    Everything one chunk of transactions can match against, in a handful of IN
+    queries. The keys (loan references, normalized phones) are parsed in
+    Python from free-text fields, so they cannot be joined on in SQL.
+    """
+    ref_loan_ids, msisdns, id_numbers = set(), set(), set()
+    for t in txns:
+        loan_id, _ = parse_loan_ref(t.bill_ref)
+        if loan_id:
+            ref_loan_ids.add(loan_id)
+        for value in (t.phone, t.bill_ref):
+            msisdn = normalize_msisdn(value)
+            if msisdn:
+                msisdns.add(msisdn)
+        if t.bill_ref:
+            id_numbers.add(t.bill_ref.strip().upper())
+
+    ref_loans = dict(db.query(models.Loan.id, models.Loan.client_id).filter(
+        models.Loan.id.in_(ref_loan_ids), models.Loan.status == "active"
+    )) if ref_loan_ids else {}
+
+    by_msisdn, by_id_number = {}, {}
+    if msisdns or id_numbers:
+        rows = db.query(
+            models.Client.id, models.Client.phone_msisdn, models.Client.mpesa_msisdn, models.Client.id_number
+        ).filter(or_(
+            models.Client.phone_msisdn.in_(msisdns), models.Client.mpesa_msisdn.in_(msisdns),
+            models.Client.id_number.in_(id_numbers)
+        )).order_by(models.Client.id.desc())
+        for client_id, phone_msisdn, mpesa_msisdn, id_number in rows:
+            for msisdn in (mpesa_msisdn, phone_msisdn):
+                if msisdn:
+                    by_msisdn[msisdn] = client_id  # Lowest id wins, as the callback matcher does
+            if id_number:
+                by_id_number[id_number.strip().upper()] = client_id
+
+    client_ids = set(by_msisdn.values()) | set(by_id_number.values())
+    active_loans = defaultdict(list)
+    if client_ids:
+        due = models.LoanDueStatus
+        rows = db.query(models.Loan.id, models.Loan.client_id, due.installment_amount, due.amount_due)\
+            .outerjoin(due, due.loan_id == models.Loan.id)\
+            .filter(models.Loan.client_id.in_(client_ids), models.Loan.status == "active")\
+            .order_by(models.Loan.id)
+        for loan_id, client_id, installment, amount_due in rows:
+            active_loans[client_id].append((loan_id, installment or 0, amount_due or 0))
+
+    return ref_loans, by_msisdn, by_id_number, active_loans
+
+
+def _propose(t, ref_loans, by_msisdn, by_id_number, active_loans) -> Optional[dict]:
+    phone_client = by_msisdn.get(normalize_msisdn(t.phone))
+    ref = (t.bill_ref or "").strip().upper()
+    ref_client = by_msisdn.get(normalize_msisdn(ref)) or by_id_number.get(ref)
+    reasons = []
+
+    # 1. The reference names an active loan
+    loan_id, rule = parse_loan_ref(ref)
+    if loan_id in ref_loans:
+        client_id = ref_loans[loan_id]
+        reasons.append(f"reference {t.bill_ref} is loan #{loan_id}")
+        if client_id in (phone_client, ref_client):
+            reasons.append("payer phone or reference identifies the same borrower")
+            confidence = "high"
+        else:
+            confidence = "medium"
+        return _proposal(t, loan_id, client_id, rule, confidence, reasons)
+
+    # 2. The reference or the payer phone identifies the client
+    if ref_client:
+        client_id, rule = ref_client, "bill_ref_client"
+        reasons.append(f"reference {t.bill_ref} is the client's phone or ID number")
+    elif phone_client:
+        client_id, rule = phone_client, "phone"
+        reasons.append("payer phone belongs to the client")
+    else:
+        return None
+    agree = ref_client and phone_client == ref_client
+
+    loans = active_loans.get(client_id)
+    if not loans:
+        return None
+    fits = [(loan, _amount_fits(t.amount, loan[1], loan[2])) for loan in loans]
+    fitting = [(loan, why) for loan, why in fits if why]
+
+    if len(loans) == 1:
+        (loan_id, _, _), why = fits[0]
+        if why:
+            reasons.append(why)
+        confidence = "high" if agree or why else "medium"
+    elif len(fitting) == 1:
+        (loan_id, _, _), why = fitting[0]
+        rule += "+amount"
+        reasons.append(f"{why}, the only one of {len(loans)} active loans")
+        confidence = "medium"
+    else:
+        # Several candidates: the loan furthest behind is the likeliest target
+        loan_id = max(loans, key=lambda loan: loan[2])[0]
+        reasons.append(f"client has {len(loans)} active loans; chose the one with the most arrears")
+        confidence = "low"
+    return _proposal(t, loan_id, client_id, rule, confidence, reasons)
+
+
+def _proposal(t, loan_id, client_id, rule, confidence, reasons) -> dict:
+    return {
+        "id": t.id,
+        "transaction_id": t.transaction_id,
+        "amount": t.amount,
+        "phone": t.phone,
+        "bill_ref": t.bill_ref,
+        "created_at": t.created_at,
+        "loan_id": loan_id,
+        "client_id": client_id,
+        "rule": rule,
+        "confidence": confidence,
+        "reasons": reasons,
+    }
+
+
+def propose_matches(db: Session, after: int = 0, limit: int = 500, min_confidence: str = "low") -> dict:
+    """
+    Runs the matching rules over unmatched transactions, oldest first, and
+    returns up to `limit` proposals for review. Nothing is written.
+    `next_after` resumes the scan where this page stopped.
+    """
+    floor = CONFIDENCE_ORDER[min_confidence]
+    proposals, scanned, last_id = [], 0, after
+    while len(proposals) < limit:
+        txns = db.query(Incoming).filter(Incoming.status == "unmatched", Incoming.id > last_id)\
+            .order_by(Incoming.id).limit(PROPOSAL_BATCH_SIZE).all()
+        if not txns:
+            last_id = None
+            break
+        lookups = _lookups(db, txns)
+        for t in txns:
+            last_id = t.id
+            scanned += 1
+            proposal = _propose(t, *lookups)
+            if proposal and CONFIDENCE_ORDER[proposal["confidence"]] >= floor:
+                proposals.append(proposal)
+                if len(proposals) >= limit:
+                    break
+
+    names = {
+        client_id: f"{first_name or ''} {last_name or ''}".strip()
+        for client_id, first_name, last_name in db.query(
+            models.Client.id, models.Client.first_name, models.Client.last_name
+        ).filter(models.Client.id.in_({p["client_id"] for p in proposals}))
+    } if proposals else {}
+    for p in proposals:
+        p["client_name"] = names.get(p["client_id"])
+    return {"items": proposals, "scanned": scanned, "next_after": last_id}
+
+
+def accept_matches(db: Session, matches: list) -> list:
+    """
+    Applies reviewed (transaction id, loan id) pairs in the caller's
+    transaction: one repayment per payment, dated the day it was received.
+    Every pair is checked first and nothing is written unless all are valid;
+    raises ValueError with the problems otherwise.
+    """
+    txn_ids = [m[0] for m in matches]
+    txns = {t.id: t for t in db.query(Incoming).filter(Incoming.id.in_(txn_ids)).with_for_update()}
+    loans = {l.id: l for l in db.query(models.Loan).filter(models.Loan.id.in_({m[1] for m in matches}))}
+
+    problems = []
+    if len(set(txn_ids)) != len(txn_ids):
+        problems.append("a transaction appears more than once")
+    for txn_id, loan_id in matches:
+        t, loan = txns.get(txn_id), loans.get(loan_id)
+        if t is None:
+            problems.append(f"transaction {txn_id} not found")
+        elif t.status != "unmatched":
+            problems.append(f"transaction {t.transaction_id} is already {t.status}")
+        if loan is None:
+            problems.append(f"loan {loan_id} not found")
+        elif loan.status != "active":
+            problems.append(f"loan {loan_id} is {loan.status}")
+    if problems:
+        raise ValueError(problems)
+
+    pairs = []
+    for txn_id, loan_id in matches:
+        t = txns[txn_id]
+        repayment = models.Repayment(
+            loan_id=loan_id,
+            amount=t.amount,
+            payment_date=(t.created_at or datetime.now()).date(),
+            notes=f"Bulk reconciled M-Pesa {t.transaction_id}",
+            mpesa_transaction_id=t.transaction_id,
+            payment_method="mpesa"
+        )
+        db.add(repayment)
+        pairs.append((t, loans[loan_id], repayment))
+    db.flush()
+
+    for t, loan, repayment in pairs:
+        t.status = "matched"
+        t.loan_id = loan.id
+        t.client_id = loan.client_id
+        t.repayment_id = repayment.id
+    return [repayment for _, _, repayment in pairs]
@@ -1,19 +1,296 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from requests.auth import HTTPBasicAuth
 from datetime import datetime
+import asyncio
 import base64
-from typing import Optional, Dict, Any
+import hashlib
+import os
+import random
+import threading
+import time
+import weakref
+from itertools import chain
+from typing import Optional, Dict, Any, Callable, Tuple
 import json
 
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from database import TENANT_KEY
+
+# Daraja transport: pooled keep-alive connections, bounded waits and retries
+MPESA_CONNECT_TIMEOUT_SECONDS = float(os.getenv("MPESA_CONNECT_TIMEOUT_SECONDS", 5))
+MPESA_READ_TIMEOUT_SECONDS = float(os.getenv("MPESA_READ_TIMEOUT_SECONDS", 30))
+MPESA_MAX_RETRIES = int(os.getenv("MPESA_MAX_RETRIES", 3))
+MPESA_RETRY_BACKOFF_SECONDS = float(os.getenv("MPESA_RETRY_BACKOFF_SECONDS", 0.5))
+MPESA_POOL_SIZE = int(os.getenv("MPESA_POOL_SIZE", 10))
+
+# Points every tenant of this process at another Daraja, e.g. daraja_simulator.py for load tests
+MPESA_BASE_URL = os.getenv("MPESA_BASE_URL", "").rstrip("/")
+
+# Safety net for other API processes of this tenant; local writes invalidate at once
+MPESA_SERVICE_CACHE_TTL_SECONDS = int(os.getenv("MPESA_SERVICE_CACHE_TTL_SECONDS", 300))
+
+# Responses worth retrying when the call is safe to repeat
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Tokens are refreshed this long before Daraja's expires_in, so a cached token
+# never expires between being handed out and reaching Safaricom
+TOKEN_EXPIRY_MARGIN_SECONDS = int(os.getenv("MPESA_TOKEN_EXPIRY_MARGIN_SECONDS", 60))
+
+
+class AccessTokenCache:
+    """
+    Process-wide OAuth token cache keyed by API host and consumer key.
+    A missing or expiring token is fetched by one caller at a time per key;
+    concurrent callers wait for that fetch instead of issuing their own.
+    """
+
+    def __init__(self, margin: int = TOKEN_EXPIRY_MARGIN_SECONDS):
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._tokens: Dict[tuple, Tuple[str, float]] = {}
+        self._refresh_locks: Dict[tuple, threading.Lock] = {}
+        self._async_refresh_locks = weakref.WeakKeyDictionary()  # event loop -> {key: asyncio.Lock}
+        self._stats = {"hits": 0, "refreshes": 0, "failures": 0, "invalidations": 0,
+                       "refresh_seconds_total": 0.0, "refresh_seconds_max": 0.0, "refresh_seconds_last": None}
+
+    def get(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry and time.time() < entry[1]:
+                self._stats["hits"] += 1
+                return entry[0]
+        return None
+
+    def get_or_refresh(self, key: tuple, fetch: Callable[[], Tuple[str, int]]) -> str:
+        token = self.get(key)
+        if token:
+            return token
+        with self._lock:
+            refresh_lock = self._refresh_locks.setdefault(key, threading.Lock())
+        with refresh_lock:
+            # Another caller may have refreshed while we waited
+            token = self.get(key)
+            if token:
+                return token
+            started = time.perf_counter()
+            try:
+                token, expires_in = fetch()
+            except Exception:
+                with self._lock:
+                    self._stats["failures"] += 1
+                raise
+            self.store(key, token, expires_in, time.perf_counter() - started)
+            return token
+
+    async def get_or_refresh_async(self, key: tuple, fetch) -> str:
+        """
+        Async counterpart of get_or_refresh; tasks on one event loop share a
+        refresh. A thread and a task may still both refresh at the same moment,
+        which costs one extra token request, never a wrong token.
+        """
+        token = self.get(key)
+        if token:
+            return token
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            locks = self._async_refresh_locks.setdefault(loop, {})
+            refresh_lock = locks.setdefault(key, asyncio.Lock())
+        async with refresh_lock:
+            token = self.get(key)
+            if token:
+                return token
+            started = time.perf_counter()
+            try:
+                token, expires_in = await fetch()
+            except Exception:
+                with self._lock:
+                    self._stats["failures"] += 1
+                raise
+            self.store(key, token, expires_in, time.perf_counter() - started)
+            return token
+
+    def store(self, key: tuple, token: str, expires_in: int, refresh_seconds: float):
+        with self._lock:
+            self._tokens[key] = (token, time.time() + max(int(expires_in) - self.margin, 0))
+            self._stats["refreshes"] += 1
+            self._stats["refresh_seconds_total"] += refresh_seconds
+            self._stats["refresh_seconds_last"] = refresh_seconds
+            self._stats["refresh_seconds_max"] = max(self._stats["refresh_seconds_max"], refresh_seconds)
+
+    def invalidate(self, key: tuple, token: Optional[str] = None):
+        """Drops the cached token, unless it has already been replaced by a newer one."""
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry and (token is None or entry[0] == token):
+                del self._tokens[key]
+                self._stats["invalidations"] += 1
+
+    def metrics(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        last = stats["refresh_seconds_last"]
+        return {
+            "hits": stats["hits"],
+            "refreshes": stats["refreshes"],
+            "failures": stats["failures"],
+            "invalidations": stats["invalidations"],
+            "refresh_ms_last": round(last * 1000, 1) if last is not None else None,
+            "refresh_ms_avg": round(stats["refresh_seconds_total"] / stats["refreshes"] * 1000, 1) if stats["refreshes"] else None,
+            "refresh_ms_max": round(stats["refresh_seconds_max"] * 1000, 1),
+        }
+
+
+token_cache = AccessTokenCache()
+
+
+class ServiceCache:
+    """
+    Holds this tenant's configured MpesaService between requests, so settings
+    are read and the initiator credential encrypted once rather than per call.
+    Dropped when a committed write touches the payment settings (see the
+    session hooks below); the TTL bounds how long another API process keeps
+    serving a configuration changed elsewhere.
+    """
+
+    def __init__(self, ttl: int = MPESA_SERVICE_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._services: Dict[str, Tuple[Any, float, int]] = {}
+        self._generation = 0
+
+    def get_or_build(self, build: Callable[[], Any]):
+        with self._lock:
+            entry = self._services.get(TENANT_KEY)
+            if entry and time.time() - entry[1] < self.ttl:
+                return entry[0]
+            generation = self._generation
+        service = build()
+        with self._lock:
+            # Not stored if the settings changed while it was being built
+            if self._generation == generation:
+                self._services[TENANT_KEY] = (service, time.time(), generation)
+        return service
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._services.pop(TENANT_KEY, None)
+
+
+service_cache = ServiceCache()
+
+
+def is_payment_setting(setting) -> bool:
+    if (setting.setting_key or "").startswith("mpesa_"):
+        return True
+    history = inspect(setting).attrs.category.history
+    return "payment" in chain([setting.category], history.deleted or ())
+
+
+def _record_settings_writes(session: Session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if getattr(obj, "__tablename__", None) == "system_settings" and is_payment_setting(obj):
+            session.info["mpesa_settings_changed"] = True
+            return
+
+
+def _invalidate_on_commit(session: Session):
+    if session.info.pop("mpesa_settings_changed", False):
+        service_cache.invalidate()
+
+
+def _discard_on_rollback(session: Session):
+    session.info.pop("mpesa_settings_changed", None)
+
+
+# Covers /mpesa/settings, /settings and any script that edits payment settings
+event.listen(Session, "after_flush", _record_settings_writes)
+event.listen(Session, "after_commit", _invalidate_on_commit)
+event.listen(Session, "after_rollback", _discard_on_rollback)
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Process-wide requests session, so Daraja calls reuse pooled TLS connections."""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=MPESA_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
+
+
+# httpx clients are bound to the event loop they were first used on
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client():
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(MPESA_READ_TIMEOUT_SECONDS, connect=MPESA_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=MPESA_POOL_SIZE, max_keepalive_connections=MPESA_POOL_SIZE),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def close_http_session():
+    """Closes the pooled requests connections; the next call opens a new session."""
+    global _http_session
+    with _http_session_lock:
+        session, _http_session = _http_session, None
+    if session is not None:
+        session.close()
+
+
+async def close_async_http_client():
+    """
+    Closes the httpx client of the running event loop: on API shutdown, and at
+    the end of scripts that run an event loop per pass (b2c_status_sweeper.py).
+    """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _never_sent(error: requests.exceptions.ConnectionError) -> bool:
+    """True when the connection failed before any bytes of the request went out."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _backoff(attempt: int) -> float:
+    return MPESA_RETRY_BACKOFF_SECONDS * (2 ** attempt) * (0.5 + random.random() / 2)
+
+
 class MpesaService:
-    def __init__(self, consumer_key: str, consumer_secret: str, shortcode: str, passkey: str, env: str = "sandbox", initiator_name: str = "testapi", initiator_password: str = None):
+    def __init__(self, consumer_key: str, consumer_secret: str, shortcode: str, passkey: str, env: str = "sandbox", initiator_name: str = "testapi", initiator_password: str = None, certificate: str = None):
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
         self.shortcode = shortcode
         self.passkey = passkey
         self.initiator_name = initiator_name
         self.initiator_password = initiator_password
-        self.base_url = "https://sandbox.safaricom.co.ke" if env == "sandbox" else "https://api.safaricom.co.ke"
+        self.certificate = certificate
+        self._security_credential = None
+        self.base_url = MPESA_BASE_URL or ("https://sandbox.safaricom.co.ke" if env == "sandbox" else "https://api.safaricom.co.ke")
 
     def generate_security_credential(self, certificate_data: str = None) -> str:
         """
@@ -31,6 +308,7 @@ class MpesaService:
         try:
             # If certificate_data is provided (PEM format), use it. 
             # Otherwise, use a default if available (NOT RECOMMENDED for production)
+            certificate_data = certificate_data or self.certificate
             if not certificate_data:
                 return self.initiator_password # Fallback for simple cases if allowed
                 
@@ -45,24 +323,95 @@ class MpesaService:
             print(f"Error generating security credential: {e}")
             return self.initiator_password
 
-    def get_access_token(self) -> str:
-        url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
-        response = requests.get(url, auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret))
+    @property
+    def security_credential(self) -> str:
+        """
+        Encrypted once per instance; Daraja accepts the same ciphertext on every
+        call. The plaintext fallback (no certificate, or encryption failed) is
+        not cached, so encryption is tried again on the next call.
+        """
+        if self._security_credential is not None:
+            return self._security_credential
+        credential = self.generate_security_credential()
+        if self.initiator_password and credential == self.initiator_password:
+            print("M-Pesa security credential is not encrypted; check the certificate in the M-Pesa settings")
+            return credential
+        self._security_credential = credential
+        return credential
+
+    def as_async(self) -> "AsyncMpesaService":
+        """The same configuration (and encrypted credential) as an AsyncMpesaService."""
+        service = AsyncMpesaService.__new__(AsyncMpesaService)
+        service.__dict__.update(self.__dict__)
+        return service
+
+    def _token_key(self) -> tuple:
+        secret = hashlib.sha256((self.consumer_secret or "").encode()).hexdigest()
+        return (self.base_url, self.consumer_key, secret)
+
+    def _token_url(self) -> str:
+        return f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
+
+    @staticmethod
+    def _parse_token(data: dict) -> Tuple[str, int]:
+        return data["access_token"], int(data.get("expires_in") or 3599)
+
+    def _request(self, method: str, url: str, idempotent: bool, **kwargs) -> requests.Response:
+        """
+        Sends one Daraja request on the shared session. Failures to connect are
+        always retried (nothing reached Safaricom). Read timeouts and 429/5xx
+        responses are only retried for idempotent calls: repeating an STK push
+        or B2C payment that may have been accepted could move money twice.
+        """
+        session = get_http_session()
+        timeout = (MPESA_CONNECT_TIMEOUT_SECONDS, MPESA_READ_TIMEOUT_SECONDS)
+        for attempt in range(MPESA_MAX_RETRIES + 1):
+            last_attempt = attempt == MPESA_MAX_RETRIES
+            try:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                if last_attempt or not (idempotent or _never_sent(e)):
+                    raise
+            except requests.exceptions.Timeout:
+                if last_attempt or not idempotent:
+                    raise
+            else:
+                if not (idempotent and response.status_code in RETRY_STATUS_CODES) or last_attempt:
+                    return response
+            time.sleep(_backoff(attempt))
+
+    def _fetch_access_token(self) -> Tuple[str, int]:
+        response = self._request("GET", self._token_url(), idempotent=True,
+                                 auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret))
         response.raise_for_status()
-        return response.json()["access_token"]
+        return self._parse_token(response.json())
 
-    def register_url(self, confirmation_url: str, validation_url: str):
+    def get_access_token(self) -> str:
+        return token_cache.get_or_refresh(self._token_key(), self._fetch_access_token)
+
+    def _post(self, url: str, payload: dict, idempotent: bool = False):
         access_token = self.get_access_token()
+        response = self._request("POST", url, idempotent, json=payload,
+                                 headers={"Authorization": f"Bearer {access_token}"})
+        if response.status_code == 401:
+            # Token revoked or expired early; a rejected call did nothing, so retry once
+            token_cache.invalidate(self._token_key(), access_token)
+            access_token = self.get_access_token()
+            response = self._request("POST", url, idempotent, json=payload,
+                                     headers={"Authorization": f"Bearer {access_token}"})
+        return response.json()
+
+    # --- Request builders, shared by the sync and async clients: (url, payload, idempotent)
+
+    def _register_url_request(self, confirmation_url: str, validation_url: str):
         url = f"{self.base_url}/mpesa/c2b/v1/registerurl"
-        headers = {"Authorization": f"Bearer {access_token}"}
         payload = {
             "ShortCode": self.shortcode,
             "ResponseType": "Completed",
             "ConfirmationURL": confirmation_url,
             "ValidationURL": validation_url
         }
-        response = requests.post(url, json=payload, headers=headers)
-        return response.json()
+        return url, payload, True
 
     def get_stk_push_password(self) -> tuple:
         timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
@@ -70,10 +419,8 @@ class MpesaService:
         password = base64.b64encode(password_str.encode()).decode('utf-8')
         return password, timestamp
 
-    def stk_push(self, phone: str, amount: int, callback_url: str, reference: str, description: str):
-        access_token = self.get_access_token()
+    def _stk_push_request(self, phone: str, amount: int, callback_url: str, reference: str, description: str):
         url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
-        headers = {"Authorization": f"Bearer {access_token}"}
         password, timestamp = self.get_stk_push_password()
         
         payload = {
@@ -89,16 +436,13 @@ class MpesaService:
             "AccountReference": reference,
             "TransactionDesc": description
         }
-        response = requests.post(url, json=payload, headers=headers)
-        return response.json()
+        return url, payload, False
 
-    def initiate_b2c(self, phone: str, amount: int, command_id: str, remarks: str, occasion: str, callback_url: str, security_credential: str = None):
-        access_token = self.get_access_token()
+    def _b2c_request(self, phone: str, amount: int, command_id: str, remarks: str, occasion: str, callback_url: str, security_credential: str = None):
         url = f"{self.base_url}/mpesa/b2c/v1/paymentrequest"
-        headers = {"Authorization": f"Bearer {access_token}"}
         
         if not security_credential:
-            security_credential = self.generate_security_credential()
+            security_credential = self.security_credential
 
         payload = {
             "InitiatorName": self.initiator_name, 
@@ -112,16 +456,13 @@ class MpesaService:
             "ResultURL": callback_url,
             "Occasion": occasion
         }
-        response = requests.post(url, json=payload, headers=headers)
-        return response.json()
+        return url, payload, False
 
-    def get_account_balance(self, callback_url: str, security_credential: str = None):
-        access_token = self.get_access_token()
+    def _account_balance_request(self, callback_url: str, security_credential: str = None):
         url = f"{self.base_url}/mpesa/accountbalance/v1/query"
-        headers = {"Authorization": f"Bearer {access_token}"}
 
         if not security_credential:
-            security_credential = self.generate_security_credential()
+            security_credential = self.security_credential
 
         payload = {
             "Initiator": self.initiator_name,
@@ -133,16 +474,15 @@ class MpesaService:
             "QueueTimeOutURL": callback_url,
             "ResultURL": callback_url
         }
-        response = requests.post(url, json=payload, headers=headers)
-        return response.json()
+        return url, payload, True
 
-    def check_transaction_status(self, transaction_id: str, callback_url: str, security_credential: str = None):
-        access_token = self.get_access_token()
+    def _transaction_status_request(self, transaction_id: str, callback_url: str, security_credential: str = None,
+                                    original_conversation_id: str = None):
+        """By M-Pesa receipt, or by the OriginatorConversationID of a request that never reported back."""
         url = f"{self.base_url}/mpesa/transactionstatus/v1/query"
-        headers = {"Authorization": f"Bearer {access_token}"}
 
         if not security_credential:
-            security_credential = self.generate_security_credential()
+            security_credential = self.security_credential
 
         payload = {
             "Initiator": self.initiator_name,
@@ -156,5 +496,90 @@ class MpesaService:
             "QueueTimeOutURL": callback_url,
             "ResultURL": callback_url
         }
-        response = requests.post(url, json=payload, headers=headers)
+        if original_conversation_id:
+            payload["OriginalConversationID"] = original_conversation_id
+        return url, payload, True
+
+    # --- Public API
+
+    def register_url(self, confirmation_url: str, validation_url: str):
+        return self._post(*self._register_url_request(confirmation_url, validation_url))
+
+    def stk_push(self, phone: str, amount: int, callback_url: str, reference: str, description: str):
+        return self._post(*self._stk_push_request(phone, amount, callback_url, reference, description))
+
+    def initiate_b2c(self, phone: str, amount: int, command_id: str, remarks: str, occasion: str, callback_url: str, security_credential: str = None):
+        return self._post(*self._b2c_request(phone, amount, command_id, remarks, occasion, callback_url, security_credential))
+
+    def get_account_balance(self, callback_url: str, security_credential: str = None):
+        return self._post(*self._account_balance_request(callback_url, security_credential))
+
+    def check_transaction_status(self, transaction_id: str, callback_url: str, security_credential: str = None,
+                                 original_conversation_id: str = None):
+        return self._post(*self._transaction_status_request(transaction_id, callback_url, security_credential,
+                                                            original_conversation_id))
+
+
+class AsyncMpesaService(MpesaService):
+    """
+    Same interface as MpesaService with coroutine methods, on a shared
+    httpx.AsyncClient, for async routes that should not tie up a thread
+    while Daraja responds. Shares the OAuth token cache with the sync client.
+    """
+
+    async def _request(self, method: str, url: str, idempotent: bool, **kwargs):
+        import httpx
+
+        client = get_async_http_client()
+        for attempt in range(MPESA_MAX_RETRIES + 1):
+            last_attempt = attempt == MPESA_MAX_RETRIES
+            try:
+                response = await client.request(method, url, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                # Never reached Safaricom: safe to repeat for any call
+                if last_attempt:
+                    raise
+            except httpx.TransportError:
+                if last_attempt or not idempotent:
+                    raise
+            else:
+                if not (idempotent and response.status_code in RETRY_STATUS_CODES) or last_attempt:
+                    return response
+            await asyncio.sleep(_backoff(attempt))
+
+    async def _fetch_access_token(self) -> Tuple[str, int]:
+        response = await self._request("GET", self._token_url(), idempotent=True,
+                                       auth=(self.consumer_key, self.consumer_secret))
+        response.raise_for_status()
+        return self._parse_token(response.json())
+
+    async def get_access_token(self) -> str:
+        return await token_cache.get_or_refresh_async(self._token_key(), self._fetch_access_token)
+
+    async def _post(self, url: str, payload: dict, idempotent: bool = False):
+        access_token = await self.get_access_token()
+        response = await self._request("POST", url, idempotent, json=payload,
+                                       headers={"Authorization": f"Bearer {access_token}"})
+        if response.status_code == 401:
+            token_cache.invalidate(self._token_key(), access_token)
+            access_token = await self.get_access_token()
+            response = await self._request("POST", url, idempotent, json=payload,
+                                           headers={"Authorization": f"Bearer {access_token}"})
         return response.json()
+
+    async def register_url(self, confirmation_url: str, validation_url: str):
+        return await self._post(*self._register_url_request(confirmation_url, validation_url))
+
+    async def stk_push(self, phone: str, amount: int, callback_url: str, reference: str, description: str):
+        return await self._post(*self._stk_push_request(phone, amount, callback_url, reference, description))
+
+    async def initiate_b2c(self, phone: str, amount: int, command_id: str, remarks: str, occasion: str, callback_url: str, security_credential: str = None):
+        return await self._post(*self._b2c_request(phone, amount, command_id, remarks, occasion, callback_url, security_credential))
+
+    async def get_account_balance(self, callback_url: str, security_credential: str = None):
+        return await self._post(*self._account_balance_request(callback_url, security_credential))
+
+    async def check_transaction_status(self, transaction_id: str, callback_url: str, security_credential: str = None,
+                                       original_conversation_id: str = None):
+        return await self._post(*self._transaction_status_request(transaction_id, callback_url, security_credential,
+                                                                  original_conversation_id))
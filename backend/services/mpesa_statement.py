@@ -0,0 +1,363 @@
+import csv
+import io
+import json
+import os
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Iterator, Optional
+
+from dateutil import parser as date_parser
+from sqlalchemy import and_, insert, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from models import normalize_msisdn
+
+STATEMENT_BATCH_SIZE = int(os.getenv("MPESA_STATEMENT_BATCH_SIZE", 2000))
+# Statement times are East Africa Time; our completed_at columns are UTC
+STATEMENT_UTC_OFFSET_HOURS = int(os.getenv("MPESA_STATEMENT_UTC_OFFSET_HOURS", 3))
+# Lines above the column header (account holder, period, ...) are skipped, up to this many
+MAX_PREAMBLE_LINES = 50
+
+# Statement header (lower-cased, trailing dots dropped) -> field
+COLUMNS = {
+    "receipt no": "receipt",
+    "receipt": "receipt",
+    "completion time": "completed_at",
+    "details": "details",
+    "transaction status": "status",
+    "paid in": "paid_in",
+    "withdrawn": "withdrawn",
+    "reason type": "reason",
+    "other party info": "other_party",
+    "a/c no": "account",
+    "account no": "account",
+}
+REQUIRED = {"receipt", "completed_at", "paid_in", "withdrawn"}
+
+# Reason types, matched as substrings of "Reason Type" (or "Details" when absent)
+C2B_REASONS = ("pay bill", "paybill", "buy goods", "customer payment")
+B2C_REASONS = ("business payment", "salary payment", "promotion payment", "b2c")
+CHARGE_REASONS = ("charge",)
+
+DATE_FORMATS = ("%d-%m-%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M")
+
+Incoming = models.MpesaIncomingTransaction
+Inbox = models.MpesaCallbackInbox
+
+
+# --- Reading
+
+def _header(row) -> Optional[dict]:
+    """Column index per field if this row is the statement's column header."""
+    fields = {}
+    for i, cell in enumerate(row):
+        name = COLUMNS.get(str(cell or "").strip().lower().rstrip("."))
+        if name and name not in fields:
+            fields[name] = i
+    return fields if REQUIRED <= set(fields) else None
+
+
+def _rows(cells: Iterator) -> Iterator[dict]:
+    """Raw rows -> {field: value}, starting after the column header."""
+    fields = None
+    for n, row in enumerate(cells):
+        if fields is None:
+            fields = _header(row)
+            if fields is None and n >= MAX_PREAMBLE_LINES:
+                raise ValueError("No statement header (Receipt No., Completion Time, Paid In, Withdrawn) found")
+            continue
+        if not any(cell not in (None, "") for cell in row):
+            continue
+        yield {name: row[i] if i < len(row) else None for name, i in fields.items()}
+    if fields is None:
+        raise ValueError("No statement header (Receipt No., Completion Time, Paid In, Withdrawn) found")
+
+
+def read_statement(file, filename: str) -> Iterator[dict]:
+    """
+    Streams the lines of a statement downloaded from the M-Pesa portal, CSV
+    or XLSX, one dict at a time. `file` is a binary file object; XLSX needs
+    it seekable (openpyxl's read-only mode reads rows as it goes).
+    """
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(file, read_only=True, data_only=True)
+        try:
+            yield from _rows(workbook.active.iter_rows(values_only=True))
+        finally:
+            workbook.close()
+    else:
+        text = io.TextIOWrapper(file, encoding="utf-8-sig", errors="replace", newline="")
+        yield from _rows(csv.reader(text))
+
+
+# --- Parsing
+
+def _amount(value) -> float:
+    if value in (None, ""):
+        return 0.0
+    if isinstance(value, (int, float)):
+        return abs(float(value))
+    return abs(float(str(value).replace(",", "").strip() or 0))
+
+
+def _timestamp(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    text = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    return date_parser.parse(text, dayfirst=True)
+
+
+def _kind(line: dict, paid_in: float, withdrawn: float) -> str:
+    reason = str(line.get("reason") or line.get("details") or "").lower()
+    if paid_in:
+        if any(r in reason for r in C2B_REASONS) or (not reason and line.get("other_party")):
+            return "c2b"
+        return "other_in"
+    if withdrawn:
+        # Before B2C: "Business Payment Charge" is a charge, not a payment
+        if any(r in reason for r in CHARGE_REASONS):
+            return "charge"
+        if any(r in reason for r in B2C_REASONS):
+            return "b2c"
+        return "other_out"
+    return "other_in"
+
+
+def parse_line(line: dict) -> Optional[dict]:
+    """A statement line reduced to what the import needs, or None if it is not a completed transaction."""
+    status = str(line.get("status") or "completed").strip().lower()
+    receipt = str(line.get("receipt") or "").strip().upper()
+    if status != "completed" or not receipt:
+        return None
+    paid_in, withdrawn = _amount(line.get("paid_in")), _amount(line.get("withdrawn"))
+    party = str(line.get("other_party") or "").split(" - ", 1)[0].strip()
+    return {
+        "receipt": receipt,
+        "completed_at": _timestamp(line["completed_at"]),
+        "kind": _kind(line, paid_in, withdrawn),
+        "amount": paid_in or withdrawn,
+        "phone": (normalize_msisdn(party) or party)[:20],
+        "account": str(line.get("account") or "").strip().upper()[:100],
+        "line": {k: str(v) if v is not None else None for k, v in line.items()},
+    }
+
+
+# --- Import
+
+def _empty_day() -> dict:
+    return {
+        "statement_paid_in": 0.0, "statement_paid_in_count": 0, "imported_count": 0, "unmatched_count": 0,
+        "statement_b2c": 0.0, "statement_b2c_count": 0, "charges": 0.0,
+        "other_paid_in": 0.0, "other_withdrawn": 0.0,
+    }
+
+
+def _import_batch(db: Session, batch: list, days: dict) -> tuple:
+    """Inserts the batch's customer payments not yet recorded; returns (imported, already recorded)."""
+    receipts = {p["receipt"]: p for p in batch if p["kind"] == "c2b"}
+    for attempt in range(2):
+        existing = dict(db.query(Incoming.transaction_id, Incoming.status)
+                        .filter(Incoming.transaction_id.in_(list(receipts)))) if receipts else {}
+        # Callbacks still waiting in the inbox will be recorded (and matched) by the worker
+        existing.update(db.query(Inbox.transaction_id, Inbox.status).filter(
+            Inbox.transaction_id.in_([r for r in receipts if r not in existing]),
+            Inbox.status.in_(("pending", "processing"))
+        ) if receipts else ())
+        missing = [p for receipt, p in receipts.items() if receipt not in existing]
+        if not missing:
+            break
+        try:
+            db.execute(insert(Incoming), [{
+                "transaction_id": p["receipt"],
+                "amount": p["amount"],
+                "phone": p["phone"],
+                "bill_ref": p["account"],
+                "raw_callback_data": json.dumps({"source": "statement", **p["line"]}),
+                "status": "unmatched",
+                "created_at": p["completed_at"] - timedelta(hours=STATEMENT_UTC_OFFSET_HOURS),
+            } for p in missing])
+            db.commit()
+            break
+        except IntegrityError:
+            # A callback for one of these receipts was recorded meanwhile; look again
+            db.rollback()
+            if attempt:
+                raise
+
+    for p in batch:
+        day = days[p["completed_at"].date()]
+        if p["kind"] == "c2b":
+            day["statement_paid_in"] += p["amount"]
+            day["statement_paid_in_count"] += 1
+            if p["receipt"] not in existing:
+                day["imported_count"] += 1
+            if existing.get(p["receipt"], "unmatched") == "unmatched":
+                day["unmatched_count"] += 1
+        elif p["kind"] == "b2c":
+            day["statement_b2c"] += p["amount"]
+            day["statement_b2c_count"] += 1
+        elif p["kind"] == "charge":
+            day["charges"] += p["amount"]
+        elif p["kind"] == "other_in":
+            day["other_paid_in"] += p["amount"]
+        else:
+            day["other_withdrawn"] += p["amount"]
+    return len(missing), len(receipts) - len(missing)
+
+
+def import_statement(db: Session, lines: Iterator[dict], batch_size: int = STATEMENT_BATCH_SIZE) -> dict:
+    """
+    Records the statement's customer payments that have no
+    MpesaIncomingTransaction yet (as 'unmatched', for the reconciliation
+    queue) and totals every line per day. Works through `lines` a batch at
+    a time, committing each; only the set of receipt numbers seen grows
+    with the statement. Receipts repeated in the file are recorded and
+    totalled once.
+    """
+    counts = {"total_lines": 0, "imported": 0, "already_recorded": 0, "skipped": 0}
+    days = defaultdict(_empty_day)
+    batch, seen = [], set()
+
+    def flush():
+        imported, recorded = _import_batch(db, batch, days)
+        counts["imported"] += imported
+        counts["already_recorded"] += recorded
+        batch.clear()
+
+    for line in lines:
+        counts["total_lines"] += 1
+        parsed = parse_line(line)
+        # A payment and its charge share a receipt number, so lines are told apart by kind too
+        key = parsed and f"{parsed['receipt']}:{parsed['kind']}"
+        if parsed is None or key in seen:
+            counts["skipped"] += 1
+            continue
+        seen.add(key)
+        batch.append(parsed)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    counts["reconciliation"] = daily_reconciliation(db, days)
+    return counts
+
+
+# --- Reconciliation
+
+def daily_reconciliation(db: Session, days: dict) -> list:
+    """
+    Statement totals per day against what the books show for that day:
+    M-Pesa repayments posted and B2C disbursements completed. Days are
+    statement (EAT) days; our UTC timestamps are shifted onto them.
+    """
+    if not days:
+        return []
+    start, end = min(days), max(days)
+
+    offset = timedelta(hours=STATEMENT_UTC_OFFSET_HOURS)
+    window_start = datetime.combine(start, datetime.min.time()) - offset
+    window_end = datetime.combine(end + timedelta(days=1), datetime.min.time()) - offset
+
+    # An M-Pesa repayment belongs to the day its payment reached us (the UTC
+    # created_at of its incoming transaction), not to its payment_date, which
+    # is the server's local date when it was matched. Repayments entered with
+    # no incoming transaction keep their payment_date.
+    repayments = defaultdict(float)
+    rows = db.query(Incoming.created_at, models.Repayment.payment_date, models.Repayment.amount)\
+        .outerjoin(Incoming, Incoming.transaction_id == models.Repayment.mpesa_transaction_id)\
+        .filter(models.Repayment.payment_method == "mpesa", or_(
+            and_(Incoming.created_at >= window_start, Incoming.created_at < window_end),
+            and_(Incoming.id.is_(None), models.Repayment.payment_date >= start,
+                 models.Repayment.payment_date <= end)
+        )).yield_per(5000)
+    for received_at, payment_date, amount in rows:
+        repayments[(received_at + offset).date() if received_at else payment_date] += amount or 0
+
+    # completed_at is UTC: bucket by statement-local day, streaming the rows
+    disbursed = defaultdict(float)
+    rows = db.query(models.DisbursementTransaction.completed_at, models.DisbursementTransaction.amount).filter(
+        models.DisbursementTransaction.method == "mpesa",
+        models.DisbursementTransaction.status == "completed",
+        models.DisbursementTransaction.completed_at >= window_start,
+        models.DisbursementTransaction.completed_at < window_end
+    ).yield_per(5000)
+    for completed_at, amount in rows:
+        disbursed[(completed_at + offset).date()] += amount or 0
+
+    report = []
+    for day in sorted(days):
+        totals = days[day]
+        posted = float(repayments.get(day) or 0)
+        paid_out = disbursed.get(day, 0.0)
+        report.append({
+            "date": day.isoformat(),
+            **{k: round(v, 2) if isinstance(v, float) else v for k, v in totals.items()},
+            "repayments_posted": round(posted, 2),
+            "paid_in_difference": round(totals["statement_paid_in"] - posted, 2),
+            "disbursements_completed": round(paid_out, 2),
+            "disbursement_difference": round(totals["statement_b2c"] - paid_out, 2),
+        })
+    return report
+
+
+def run_import(db: Session, record: models.MpesaStatementImport, file, filename: str,
+               batch_size: int = STATEMENT_BATCH_SIZE) -> models.MpesaStatementImport:
+    """Runs an import into its MpesaStatementImport record, marking it completed or failed."""
+    try:
+        result = import_statement(db, read_statement(file, filename), batch_size)
+        report = result.pop("reconciliation")
+        for key, value in result.items():
+            setattr(record, key, value)
+        record.reconciliation = json.dumps(report)
+        record.period_start = date.fromisoformat(report[0]["date"]) if report else None
+        record.period_end = date.fromisoformat(report[-1]["date"]) if report else None
+        record.status = "completed"
+    except Exception as e:
+        db.rollback()
+        record.status = "failed"
+        record.error_message = str(e)
+    record.completed_at = datetime.utcnow()
+    db.commit()
+    return record
+
+
+def import_file(import_id: int, path: str, filename: str):
+    """Background task for an uploaded statement: imports it, then deletes the upload."""
+    db = SessionLocal()
+    try:
+        record = db.get(models.MpesaStatementImport, import_id)
+        with open(path, "rb") as f:
+            run_import(db, record, f, filename)
+        print(f"Statement import #{import_id}: {record.status}, {record.imported} receipt(s) added")
+    finally:
+        db.close()
+        os.remove(path)
+
+
+def statement_summary(record: models.MpesaStatementImport) -> dict:
+    return {
+        "id": record.id,
+        "filename": record.filename,
+        "status": record.status,
+        "total_lines": record.total_lines,
+        "imported": record.imported,
+        "already_recorded": record.already_recorded,
+        "skipped": record.skipped,
+        "period_start": record.period_start,
+        "period_end": record.period_end,
+        "error_message": record.error_message,
+        "created_at": record.created_at,
+        "completed_at": record.completed_at,
+        "reconciliation": json.loads(record.reconciliation) if record.reconciliation else [],
+    }
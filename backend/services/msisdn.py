@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+from itertools import chain
+from typing import Dict, Optional
+
+from sqlalchemy import event, inspect, or_
+from sqlalchemy.orm import Session
+
+import models
+from models import normalize_msisdn
+
+# Clients added or renumbered by another process are found through the index
+# on a miss; the TTL bounds how long a number moved elsewhere keeps its old owner.
+MSISDN_MAP_TTL_SECONDS = int(os.getenv("MSISDN_MAP_TTL_SECONDS", 600))
+
+
+class ClientPhoneMap:
+    """
+    Last 9 digits of every client's phone and M-Pesa number -> client id,
+    held in memory so callback matching needs no clients query at all.
+    Loaded lazily in one pass over the two MSISDN columns; kept in step with
+    local commits by the session hooks below.
+    """
+
+    def __init__(self, ttl: int = MSISDN_MAP_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._by_suffix: Dict[str, int] = {}
+        self._loaded_at = None
+
+    def _load(self, db: Session):
+        by_suffix = {}
+        rows = db.query(models.Client.id, models.Client.phone_msisdn, models.Client.mpesa_msisdn)\
+            .order_by(models.Client.id.desc())
+        for client_id, phone_msisdn, mpesa_msisdn in rows:
+            # Descending ids: the oldest client wins a shared number, as the LIKE match did
+            for msisdn in (mpesa_msisdn, phone_msisdn):
+                if msisdn:
+                    by_suffix[msisdn[-9:]] = client_id
+        with self._lock:
+            self._by_suffix = by_suffix
+            self._loaded_at = time.time()
+
+    def find_client_id(self, db: Session, phone) -> Optional[int]:
+        msisdn = normalize_msisdn(phone)
+        if not msisdn:
+            return None
+        if self._loaded_at is None or time.time() - self._loaded_at >= self.ttl:
+            self._load(db)
+        client_id = self._by_suffix.get(msisdn[-9:])
+        if client_id is None:
+            client_id = find_client_id(db, msisdn)
+            if client_id is not None:
+                with self._lock:
+                    self._by_suffix[msisdn[-9:]] = client_id
+        return client_id
+
+    def update(self, changes):
+        """Applies (client_id, old numbers, new numbers) from committed writes."""
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            for client_id, old, new in changes:
+                for msisdn in old:
+                    if self._by_suffix.get(msisdn[-9:]) == client_id:
+                        del self._by_suffix[msisdn[-9:]]
+                for msisdn in new:
+                    self._by_suffix.setdefault(msisdn[-9:], client_id)
+
+    def clear(self):
+        with self._lock:
+            self._by_suffix = {}
+            self._loaded_at = None
+
+
+client_phone_map = ClientPhoneMap()
+
+
+def find_client_id(db: Session, phone) -> Optional[int]:
+    """Exact lookup on the indexed MSISDN columns."""
+    msisdn = normalize_msisdn(phone)
+    if not msisdn:
+        return None
+    return db.query(models.Client.id).filter(
+        or_(models.Client.phone_msisdn == msisdn, models.Client.mpesa_msisdn == msisdn)
+    ).order_by(models.Client.id).limit(1).scalar()
+
+
+def _numbers(state, attrs, deleted=False):
+    numbers = set()
+    for attr in attrs:
+        history = state.attrs[attr].history
+        values = (history.deleted or ()) if deleted else chain(history.added or (), history.unchanged or ())
+        numbers.update(v for v in values if v)
+    return numbers
+
+
+def _record_client_phones(session: Session, flush_context):
+    changes = session.info.setdefault("msisdn_changes", [])
+    attrs = ("phone_msisdn", "mpesa_msisdn")
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, models.Client):
+            continue
+        state = inspect(obj)
+        if obj in session.deleted:
+            changes.append((obj.id, _numbers(state, attrs) | _numbers(state, attrs, deleted=True), set()))
+        elif any(state.attrs[a].history.has_changes() for a in attrs):
+            changes.append((obj.id, _numbers(state, attrs, deleted=True), _numbers(state, attrs)))
+
+
+def _update_on_commit(session: Session):
+    changes = session.info.pop("msisdn_changes", None)
+    if changes:
+        client_phone_map.update(changes)
+
+
+def _discard_on_rollback(session: Session):
+    session.info.pop("msisdn_changes", None)
+
+
+event.listen(Session, "after_flush", _record_client_phones)
+event.listen(Session, "after_commit", _update_on_commit)
+event.listen(Session, "after_rollback", _discard_on_rollback)
@@ -0,0 +1,255 @@
+import atexit
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import delete, event, func, insert, select
+from sqlalchemy.orm import Session
+
+import models
+from database import TENANT_KEY, engine
+
+REPORT_CACHE_TTL_SECONDS = int(os.getenv("REPORT_CACHE_TTL_SECONDS", 300))
+# How often a process checks report_cache_invalidations for writes committed
+# by other processes (other API workers, mpesa_inbox_worker.py, scripts), and
+# how long it gathers its own writes before logging them in one insert
+REPORT_CACHE_SYNC_SECONDS = float(os.getenv("REPORT_CACHE_SYNC_SECONDS", 5))
+REPORT_CACHE_LOG_RETENTION_HOURS = int(os.getenv("REPORT_CACHE_LOG_RETENTION_HOURS", 24))
+
+# Identifies this process's rows in report_cache_invalidations
+PROCESS_ID = uuid.uuid4().hex[:16]
+
+# Tables whose writes make cached reports stale. Reports read most loan
+# columns (amount, interest_rate, fees, start_date, status), so any column
+# change on a loan counts.
+WATCHED_TABLES = {"repayments", "loans", "expenses", "loan_products"}
+
+
+class _Entry:
+    __slots__ = ("value", "created_at", "tags")
+
+    def __init__(self, value: Any, tags: Tuple[str, ...]):
+        self.value = value
+        self.created_at = time.time()
+        self.tags = tags
+
+
+class _Flight:
+    __slots__ = ("done", "value", "error", "created_at")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.created_at = None
+
+
+class ReportCache:
+    """
+    In-process cache for report results keyed by tenant, endpoint and parameters.
+
+    Entries expire after a TTL and are dropped as soon as a committed write
+    touches one of the tables they were tagged with. Writes committed by other
+    processes are picked up from report_cache_invalidations, at most
+    REPORT_CACHE_SYNC_SECONDS late. Concurrent requests for the same key share
+    a single computation.
+    """
+
+    def __init__(self, ttl: int = REPORT_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[tuple, _Entry] = {}
+        self._inflight: Dict[tuple, _Flight] = {}
+        self._generations: Dict[str, int] = {}
+        self._synced_at = 0.0
+        self._last_remote_id: Optional[int] = None
+        self._unpublished: set = set()
+        self._publish_timer: Optional[threading.Timer] = None
+
+    @staticmethod
+    def make_key(endpoint: str, params: Optional[dict] = None) -> tuple:
+        items = tuple(sorted((k, str(v)) for k, v in (params or {}).items()))
+        return (TENANT_KEY, endpoint, items)
+
+    def _generation(self, tags: Iterable[str]) -> tuple:
+        return tuple(self._generations.get(t, 0) for t in tags)
+
+    def get_or_compute(
+        self,
+        endpoint: str,
+        params: Optional[dict],
+        compute: Callable[[], Any],
+        tags: Iterable[str],
+    ) -> Tuple[Any, float, bool]:
+        """
+        Returns (value, age_seconds, hit). Only one caller computes a missing
+        key; the others wait for and share its result.
+        """
+        tags = tuple(tags)
+        key = self.make_key(endpoint, params)
+        self.sync_remote()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry.created_at < self.ttl:
+                return entry.value, time.time() - entry.created_at, True
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                generation = self._generation(tags)
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, time.time() - flight.created_at, True
+
+        try:
+            flight.value = compute()
+            flight.created_at = time.time()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                # Skip storing if a write invalidated these tags mid-computation
+                if flight.error is None and self._generation(tags) == generation:
+                    self._entries[key] = _Entry(flight.value, tags)
+            flight.done.set()
+
+        return flight.value, 0.0, False
+
+    def invalidate(self, tables: Iterable[str]):
+        tables = set(tables)
+        if not tables:
+            return
+        with self._lock:
+            for t in tables:
+                self._generations[t] = self._generations.get(t, 0) + 1
+            stale = [k for k, e in self._entries.items() if tables.intersection(e.tags)]
+            for k in stale:
+                del self._entries[k]
+
+    def sync_remote(self):
+        """Applies invalidations other processes logged since the last check."""
+        with self._lock:
+            if time.time() - self._synced_at < REPORT_CACHE_SYNC_SECONDS:
+                return
+            self._synced_at = time.time()
+            last_id = self._last_remote_id
+
+        log = models.ReportCacheInvalidation
+        try:
+            with engine.connect() as conn:
+                newest = conn.execute(select(func.max(log.id))).scalar() or 0
+                if last_id is None:
+                    # Nothing is cached yet; start from the current end of the log
+                    self._last_remote_id = newest
+                    return
+                if newest <= last_id:
+                    return
+                tables = conn.execute(
+                    select(log.table_name).distinct()
+                    .where(log.id > last_id, log.id <= newest, log.source != PROCESS_ID)
+                ).scalars().all()
+        except Exception as e:
+            print(f"Report cache sync failed: {e}")
+            return
+
+        self.invalidate(tables)
+        self._last_remote_id = newest
+
+    def publish(self, tables: Iterable[str]):
+        """
+        Queues committed writes for the other processes' caches. Tables queued
+        within REPORT_CACHE_SYNC_SECONDS are logged together by one insert.
+        """
+        with self._lock:
+            self._unpublished.update(tables)
+            if self._publish_timer is not None:
+                return
+            self._publish_timer = threading.Timer(REPORT_CACHE_SYNC_SECONDS, self.flush_published)
+            self._publish_timer.daemon = True
+            self._publish_timer.start()
+
+    def flush_published(self):
+        with self._lock:
+            tables, self._unpublished = self._unpublished, set()
+            self._publish_timer = None
+        if tables:
+            _publish(tables)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+report_cache = ReportCache()
+# Scripts exit before the timer fires; log what they wrote on the way out
+atexit.register(report_cache.flush_published)
+
+
+def _record_writes(session: Session, flush_context):
+    touched = session.info.setdefault("report_cache_touched", set())
+    dirty = session.dirty
+    for obj in chain(session.new, dirty, session.deleted):
+        table = getattr(obj, "__tablename__", None)
+        if table not in WATCHED_TABLES:
+            continue
+        # Dirty also covers loans whose only change was to a relationship
+        if table == "loans" and obj in dirty:
+            if not session.is_modified(obj, include_collections=False):
+                continue
+        touched.add(table)
+
+
+def _publish(tables: Iterable[str]):
+    """Logs committed writes for the other processes' caches (see ReportCache.sync_remote)."""
+    now = datetime.utcnow()
+    try:
+        with engine.begin() as conn:
+            conn.execute(insert(models.ReportCacheInvalidation), [
+                {"table_name": t, "source": PROCESS_ID, "created_at": now} for t in sorted(tables)
+            ])
+    except Exception as e:
+        # Other processes fall back to the TTL for this write
+        print(f"Report cache invalidation not published: {e}")
+
+
+def purge_invalidations(db: Session) -> int:
+    """Drops log rows every process has long since read; run from mpesa_inbox_worker.py."""
+    cutoff = datetime.utcnow() - timedelta(hours=REPORT_CACHE_LOG_RETENTION_HOURS)
+    result = db.execute(delete(models.ReportCacheInvalidation)
+                        .where(models.ReportCacheInvalidation.created_at < cutoff))
+    db.commit()
+    return result.rowcount
+
+
+def _invalidate_on_commit(session: Session):
+    touched = session.info.pop("report_cache_touched", None)
+    if touched:
+        report_cache.invalidate(touched)
+        report_cache.publish(touched)
+
+
+def _discard_on_rollback(session: Session):
+    session.info.pop("report_cache_touched", None)
+
+
+# Registered on the Session class so every session (request handlers, scripts,
+# workers) invalidates cached reports after committing relevant writes.
+event.listen(Session, "after_flush", _record_writes)
+event.listen(Session, "after_commit", _invalidate_on_commit)
+event.listen(Session, "after_rollback", _discard_on_rollback)
+
+
+def set_cache_headers(response, age: float, hit: bool):
+    response.headers["Age"] = str(int(age))
+    response.headers["X-Report-Cache"] = "HIT" if hit else "MISS"
@@ -0,0 +1,248 @@
+import gzip
+import json
+import os
+from datetime import date, datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import models
+from services import report_renderers
+from utils import tenant_data_dir
+
+REPORT_JOB_STATEMENT_TIMEOUT_SECONDS = int(os.getenv("REPORT_JOB_STATEMENT_TIMEOUT_SECONDS", 300))
+REPORT_JOB_RETENTION_HOURS = int(os.getenv("REPORT_JOB_RETENTION_HOURS", 72))
+# A job still 'running' this long after it started belongs to a worker that died
+REPORT_JOB_STALE_SECONDS = int(os.getenv("REPORT_JOB_STALE_SECONDS", 3600))
+STALE_JOB_MESSAGE = "Report worker stopped while running this job"
+
+
+def _parse_date(value):
+    if value in (None, ""):
+        return None
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value))
+
+
+def _run_profit_loss(db: Session, params: dict):
+    from routers.reports import compute_profit_loss
+    end_date = params.get("end_date") or date.today()
+    start_date = params.get("start_date") or end_date - timedelta(days=30)
+    return compute_profit_loss(db, start_date, end_date)
+
+
+def _run_portfolio_at_risk(db: Session, params: dict):
+    from routers.reports import compute_portfolio_at_risk
+    return compute_portfolio_at_risk(db)
+
+
+def _run_portfolio_health(db: Session, params: dict):
+    from routers.reports import compute_portfolio_health
+    return compute_portfolio_health(db)
+
+
+# report_type -> accepted params, JSON runner, XLSX/PDF sheet builder
+REPORT_TYPES = {
+    "profit-loss": {
+        "params": {"start_date", "end_date"},
+        "json": _run_profit_loss,
+        "sheets": report_renderers.profit_loss_sheets,
+    },
+    "portfolio-at-risk": {
+        "params": set(),
+        "json": _run_portfolio_at_risk,
+        "sheets": report_renderers.portfolio_at_risk_sheets,
+    },
+    "portfolio-health": {
+        "params": set(),
+        "json": _run_portfolio_health,
+        "sheets": None,
+    },
+    "disbursement-history": {
+        "params": {"start_date", "end_date", "status"},
+        "json": None,
+        "sheets": report_renderers.disbursement_history_sheets,
+    },
+}
+
+REPORT_FORMATS = {"json", "xlsx", "pdf"}
+
+
+def validate_job_params(report_type: str, params: dict, format: str = "json") -> dict:
+    """
+    Raises ValueError for unknown report types or formats, unknown params or bad dates.
+    """
+    if report_type not in REPORT_TYPES:
+        raise ValueError(f"Unknown report type '{report_type}'")
+    if format not in REPORT_FORMATS:
+        raise ValueError(f"Unknown format '{format}'")
+    spec = REPORT_TYPES[report_type]
+    if spec["json" if format == "json" else "sheets"] is None:
+        raise ValueError(f"{report_type} is not available as {format}")
+    unknown = set(params) - spec["params"]
+    if unknown:
+        raise ValueError(f"Unsupported parameters for {report_type}: {', '.join(sorted(unknown))}")
+    for key, value in params.items():
+        if key.endswith("_date"):
+            _parse_date(value)
+    return params
+
+
+def _parse_params(raw: str) -> dict:
+    params = json.loads(raw) if raw else {}
+    return {k: (_parse_date(v) if k.endswith("_date") else v) for k, v in params.items()}
+
+
+def _set_statement_timeout(db: Session, seconds: int):
+    # MariaDB counts in seconds, MySQL in milliseconds; other backends have no equivalent
+    if db.bind.dialect.name != "mysql":
+        return
+    try:
+        db.execute(text(f"SET SESSION max_statement_time = {int(seconds)}"))
+    except Exception:
+        db.rollback()
+        db.execute(text(f"SET SESSION max_execution_time = {int(seconds) * 1000}"))
+
+
+def _reset_statement_timeout(db: Session):
+    try:
+        _set_statement_timeout(db, 0)
+    except Exception as e:
+        db.rollback()
+        print(f"Could not reset the statement timeout: {e}")
+
+
+RESULT_EXTENSIONS = {"json": "json.gz", "xlsx": "xlsx", "pdf": "pdf"}
+
+
+def result_path(job_id: int, format: str = "json") -> str:
+    return os.path.join(tenant_data_dir("report_jobs"), f"report_{job_id}.{RESULT_EXTENSIONS[format]}")
+
+
+def requeue_stale_jobs(db: Session) -> int:
+    """
+    Puts jobs left 'running' by a worker that died back in the queue. A job
+    that goes stale a second time is failed instead, as it may be what kills
+    the worker.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=REPORT_JOB_STALE_SECONDS)
+    stale = models.ReportJob.status == "running", models.ReportJob.started_at < cutoff
+    now = datetime.utcnow()
+    failed = db.query(models.ReportJob).filter(*stale, models.ReportJob.error_message == STALE_JOB_MESSAGE)\
+        .update({"status": "failed", "completed_at": now,
+                 "expires_at": now + timedelta(hours=REPORT_JOB_RETENTION_HOURS)}, synchronize_session=False)
+    requeued = db.query(models.ReportJob).filter(*stale)\
+        .update({"status": "queued", "started_at": None, "error_message": STALE_JOB_MESSAGE},
+                synchronize_session=False)
+    db.commit()
+    if failed or requeued:
+        print(f"Report jobs: requeued {requeued} and failed {failed} stale running job(s)")
+    return requeued
+
+
+def claim_next_job(db: Session):
+    """
+    Atomically moves the oldest queued job to 'running' and returns it, so
+    several workers can poll the same table without running a job twice.
+    Jobs abandoned by a dead worker are re-queued first.
+    """
+    requeue_stale_jobs(db)
+    candidates = db.query(models.ReportJob.id).filter(
+        models.ReportJob.status == "queued"
+    ).order_by(models.ReportJob.id).limit(5).all()
+
+    for (job_id,) in candidates:
+        claimed = db.query(models.ReportJob).filter(
+            models.ReportJob.id == job_id,
+            models.ReportJob.status == "queued"
+        ).update({"status": "running", "started_at": datetime.utcnow()}, synchronize_session=False)
+        db.commit()
+        if claimed:
+            return db.query(models.ReportJob).filter(models.ReportJob.id == job_id).first()
+    return None
+
+
+def _render(db: Session, job: models.ReportJob, path: str):
+    spec = REPORT_TYPES.get(job.report_type)
+    if spec is None:
+        raise ValueError(f"Unknown report type '{job.report_type}'")
+    format = job.format or "json"
+    params = _parse_params(job.params)
+
+    if format == "json":
+        result = spec["json"](db, params)
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump(jsonable_encoder(result), f)
+        return
+
+    sheets = spec["sheets"](db, params)
+    if format == "xlsx":
+        report_renderers.write_xlsx(path, sheets)
+    else:
+        title = job.report_type.replace("-", " ").title()
+        report_renderers.write_pdf(path, title, sheets)
+
+
+def run_job(db: Session, job: models.ReportJob):
+    tmp_path = None
+    try:
+        path = result_path(job.id, job.format or "json")
+        tmp_path = path + ".tmp"
+
+        _set_statement_timeout(db, REPORT_JOB_STATEMENT_TIMEOUT_SECONDS)
+        try:
+            _render(db, job, tmp_path)
+        except Exception:
+            # Leave the failed transaction first, or resetting the timeout
+            # fails as well and hides the render's error
+            db.rollback()
+            _reset_statement_timeout(db)
+            raise
+        _reset_statement_timeout(db)
+        os.replace(tmp_path, path)
+
+        job.status = "completed"
+        job.result_path = path
+        job.result_size = os.path.getsize(path)
+        job.error_message = None
+    except Exception as e:
+        db.rollback()
+        # Don't leave a partial result behind for nothing to clean up
+        if tmp_path and os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError as remove_error:
+                print(f"Failed to remove partial report result {tmp_path}: {remove_error}")
+        job.status = "failed"
+        job.error_message = str(getattr(e, "detail", None) or e)
+
+    job.completed_at = datetime.utcnow()
+    job.expires_at = job.completed_at + timedelta(hours=REPORT_JOB_RETENTION_HOURS)
+    db.commit()
+    return job
+
+
+def expire_jobs(db: Session) -> int:
+    """
+    Deletes result files past their retention window and marks the jobs expired.
+    """
+    now = datetime.utcnow()
+    jobs = db.query(models.ReportJob).filter(
+        models.ReportJob.status.in_(["completed", "failed"]),
+        models.ReportJob.expires_at <= now
+    ).all()
+
+    for job in jobs:
+        if job.result_path and os.path.exists(job.result_path):
+            try:
+                os.remove(job.result_path)
+            except OSError as e:
+                print(f"Failed to remove report result {job.result_path}: {e}")
+                continue
+        job.status = "expired"
+        job.result_path = None
+
+    db.commit()
+    return len(jobs)
@@ -0,0 +1,241 @@
+import os
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import models
+
+# Detail rows are pulled from the database in batches and written straight to
+# the output file, so neither renderer holds a whole report in memory.
+RENDER_BATCH_SIZE = int(os.getenv("RENDER_BATCH_SIZE", 2000))
+
+# A PDF with hundreds of thousands of rows is unreadable; past this many rows per
+# section the PDF notes the cut-off and the XLSX carries the full detail.
+PDF_MAX_SECTION_ROWS = int(os.getenv("PDF_MAX_SECTION_ROWS", 5000))
+
+
+def stream_rows(db: Session, stmt, batch_size: int = RENDER_BATCH_SIZE):
+    """Yields rows of a select in batches; closes the cursor even if the consumer stops early."""
+    result = db.execute(stmt.execution_options(yield_per=batch_size))
+    try:
+        for batch in result.partitions():
+            yield from batch
+    finally:
+        result.close()
+
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return round(value, 2)
+    return value
+
+
+# --- Report sheet builders: each returns [(title, headers, rows_iterable), ...] ---
+
+def _date_range(params: dict, default_days: int = 30):
+    end_date = params.get("end_date") or date.today()
+    start_date = params.get("start_date") or end_date - timedelta(days=default_days)
+    return start_date, end_date
+
+
+def profit_loss_sheets(db: Session, params: dict):
+    from routers.reports import profit_loss_totals
+    start_date, end_date = _date_range(params)
+    summary = profit_loss_totals(db, start_date, end_date)
+
+    summary_rows = [
+        ("Period", f"{start_date} to {end_date}"),
+        ("Fee Income", summary["fee_income"]),
+        ("Interest Income", summary["interest_income"]),
+        ("Total Income", summary["total_income"]),
+        ("Total Expenses", summary["total_expenses"]),
+        ("Net Profit", summary["net_profit"]),
+    ]
+
+    def expense_rows():
+        stmt = select(
+            models.Expense.date, models.Expense.category, models.Expense.description, models.Expense.amount
+        ).where(
+            models.Expense.date >= start_date,
+            models.Expense.date <= end_date
+        ).order_by(models.Expense.date, models.Expense.id)
+        for r in stream_rows(db, stmt):
+            yield (r[0], r[1] or "Other", r[2], r[3])
+
+    def repayment_rows():
+        stmt = select(
+            models.Repayment.id, models.Repayment.payment_date, models.Repayment.loan_id,
+            models.Repayment.amount, models.Loan.amount, models.Loan.interest_rate
+        ).join(models.Loan, models.Loan.id == models.Repayment.loan_id).where(
+            models.Repayment.payment_date >= start_date,
+            models.Repayment.payment_date <= end_date
+        ).order_by(models.Repayment.id)
+        for rep_id, paid_on, loan_id, amount, loan_amount, rate in stream_rows(db, stmt):
+            rate = rate or 0
+            interest = 0.0
+            if loan_amount and loan_amount > 0:
+                interest = (amount or 0) * (loan_amount * rate / 100) / (loan_amount * (1 + rate / 100))
+            yield (rep_id, paid_on, loan_id, amount, interest)
+
+    return [
+        ("Summary", ["Metric", "Value"], summary_rows),
+        ("Expenses", ["Date", "Category", "Description", "Amount"], expense_rows()),
+        ("Repayments", ["Repayment ID", "Date", "Loan ID", "Amount", "Interest Portion"], repayment_rows()),
+    ]
+
+
+def portfolio_at_risk_sheets(db: Session, params: dict):
+    from routers.reports import compute_portfolio_at_risk, iter_active_loan_arrears
+    par = compute_portfolio_at_risk(db)
+    summary_rows = [
+        (bucket, amount, par["par_ratios"][bucket])
+        for bucket, amount in par["par_distribution"].items()
+    ]
+    summary_rows.append(("total", par["total_active_portfolio"], 100 if par["total_active_portfolio"] else 0))
+
+    def loan_rows():
+        for l in iter_active_loan_arrears(db, par["as_of_date"], RENDER_BATCH_SIZE):
+            yield (l["loan_id"], l["client_name"], l["phone"], l["amount"], l["total_paid"],
+                   l["amount_overdue"], l["days_overdue"], l["bucket"])
+
+    return [
+        ("Summary", ["Bucket", "Principal", "Ratio %"], summary_rows),
+        ("Loans", ["Loan ID", "Client", "Phone", "Principal", "Total Paid",
+                   "Amount Overdue", "Days Overdue", "Bucket"], loan_rows()),
+    ]
+
+
+def disbursement_history_sheets(db: Session, params: dict):
+    t = models.DisbursementTransaction
+    filters = []
+    if params.get("start_date"):
+        filters.append(t.initiated_at >= datetime.combine(params["start_date"], datetime.min.time()))
+    if params.get("end_date"):
+        filters.append(t.initiated_at < datetime.combine(params["end_date"] + timedelta(days=1), datetime.min.time()))
+    if params.get("status"):
+        filters.append(t.status == params["status"])
+
+    summary_rows = [
+        (status, method, count, float(total or 0))
+        for status, method, count, total in db.query(
+            t.status, t.method, func.count(t.id), func.sum(t.amount)
+        ).filter(*filters).group_by(t.status, t.method).order_by(t.status, t.method).all()
+    ]
+
+    def detail_rows():
+        stmt = select(
+            t.id, t.initiated_at, t.loan_id, models.Client.first_name, models.Client.last_name,
+            t.amount, t.method, t.mpesa_phone, t.status, t.mpesa_transaction_id,
+            t.bank_reference, t.completed_at
+        ).outerjoin(models.Client, models.Client.id == t.client_id)\
+         .where(*filters).order_by(t.id)
+        for r in stream_rows(db, stmt):
+            yield (r[0], r[1], r[2], f"{r[3] or ''} {r[4] or ''}".strip(), r[5], r[6], r[7], r[8], r[9], r[10], r[11])
+
+    return [
+        ("Summary", ["Status", "Method", "Count", "Amount"], summary_rows),
+        ("Disbursements", ["ID", "Initiated At", "Loan ID", "Client", "Amount", "Method", "Phone",
+                           "Status", "M-Pesa Ref", "Bank Ref", "Completed At"], detail_rows()),
+    ]
+
+
+# --- Renderers ---
+
+def write_xlsx(path: str, sheets):
+    """Writes each (title, headers, rows) as a worksheet using openpyxl's write-only mode."""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+    wb = Workbook(write_only=True)
+    bold = Font(bold=True)
+    for title, headers, rows in sheets:
+        ws = wb.create_sheet(title=title[:31])
+        header_cells = []
+        for h in headers:
+            cell = WriteOnlyCell(ws, value=h)
+            cell.font = bold
+            header_cells.append(cell)
+        ws.append(header_cells)
+        for row in rows:
+            ws.append([_cell(v) for v in row])
+    wb.save(path)
+
+
+def write_pdf(path: str, title: str, sheets):
+    """
+    Draws each (title, headers, rows) as a table section, page by page, on a
+    reportlab canvas. Rows are consumed one at a time as they are drawn.
+    """
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    from reportlab.pdfgen import canvas
+
+    page_width, page_height = landscape(A4)
+    margin = 30
+    row_height = 12
+    font, font_bold, font_size = "Helvetica", "Helvetica-Bold", 7
+    c = canvas.Canvas(path, pagesize=(page_width, page_height), pageCompression=1)
+    state = {"page": 1, "y": page_height - margin}
+
+    def fit(text, width):
+        text = str(text)
+        while text and stringWidth(text, font, font_size) > width - 4:
+            text = text[:-1]
+        return text
+
+    def footer():
+        c.setFont(font, 6)
+        c.drawRightString(page_width - margin, margin / 2, f"{title} - page {state['page']}")
+
+    def new_page():
+        footer()
+        c.showPage()
+        state["page"] += 1
+        state["y"] = page_height - margin
+
+    def draw_row(values, widths, bold=False):
+        c.setFont(font_bold if bold else font, font_size)
+        x = margin
+        for value, width in zip(values, widths):
+            c.drawString(x + 2, state["y"], fit(_cell(value), width))
+            x += width
+        state["y"] -= row_height
+
+    c.setTitle(title)
+    c.setFont(font_bold, 14)
+    c.drawString(margin, state["y"], title)
+    c.setFont(font, 8)
+    c.drawRightString(page_width - margin, state["y"], f"Generated {datetime.utcnow():%Y-%m-%d %H:%M} UTC")
+    state["y"] -= 24
+
+    for section_title, headers, rows in sheets:
+        if state["y"] < margin + row_height * 4:
+            new_page()
+        widths = [(page_width - 2 * margin) / len(headers)] * len(headers)
+        c.setFont(font_bold, 10)
+        c.drawString(margin, state["y"], section_title)
+        state["y"] -= 14
+        draw_row(headers, widths, bold=True)
+
+        drawn = 0
+        for row in rows:
+            if drawn >= PDF_MAX_SECTION_ROWS:
+                c.setFont(font, font_size)
+                c.drawString(margin, state["y"], f"Truncated after {PDF_MAX_SECTION_ROWS} rows - download the XLSX for the full detail.")
+                state["y"] -= row_height
+                if hasattr(rows, "close"):
+                    rows.close()
+                break
+            if state["y"] < margin + row_height:
+                new_page()
+                draw_row(headers, widths, bold=True)
+            draw_row(row, widths)
+            drawn += 1
+        state["y"] -= row_height
+
+    footer()
+    c.save()
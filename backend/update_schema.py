@@ -17,5 +17,39 @@ def update_schema():
             else:
                 print(f"Error adding column: {e}")
 
+        # updated_at lets the analytics export pick up edited rows; existing
+        # rows are filled from the closest timestamp they already have
+        for table, source in (("clients", "created_at"), ("loans", "COALESCE(approved_at, start_date)")):
+            try:
+                print(f"Attempting to add 'updated_at' column to '{table}' table...")
+                connection.execute(text(f"ALTER TABLE {table} ADD COLUMN updated_at DATETIME DEFAULT NULL"))
+                connection.execute(text(f"UPDATE {table} SET updated_at = {source} WHERE updated_at IS NULL"))
+                print("Successfully added 'updated_at' column.")
+                connection.commit()
+            except Exception as e:
+                if "Duplicate column name" in str(e):
+                    print(f"Column '{table}.updated_at' already exists.")
+                else:
+                    print(f"Error adding column: {e}")
+            try:
+                print(f"Attempting to create index 'ix_{table}_updated_at'...")
+                connection.execute(text(f"CREATE INDEX ix_{table}_updated_at ON {table} (updated_at)"))
+                print("Successfully created index.")
+                connection.commit()
+            except Exception as e:
+                if "Duplicate key name" in str(e):
+                    print(f"Index 'ix_{table}_updated_at' already exists.")
+                else:
+                    print(f"Error creating index: {e}")
+
+        try:
+            # Float rounding made the arrears cursor skip loans tied on the boundary amount
+            print("Converting 'loan_due_status.amount_due' to DECIMAL(14,2)...")
+            connection.execute(text("ALTER TABLE loan_due_status MODIFY COLUMN amount_due DECIMAL(14,2) DEFAULT 0"))
+            print("Successfully converted 'amount_due'.")
+            connection.commit()
+        except Exception as e:
+            print(f"Error converting column: {e}")
+
 if __name__ == "__main__":
     update_schema()
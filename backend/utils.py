@@ -1,7 +1,13 @@
 from sqlalchemy.orm import Session
 import models
+from database import TENANT_KEY
 from datetime import datetime
 import json
+import os
+import re
+
+# Local working data (report results, analytics store, ...), one folder per tenant
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
 
 def log_activity(db: Session, user_id: int, action: str, resource: str, resource_id: str = None, details: dict = None, ip_address: str = None):
     """
@@ -41,3 +47,12 @@ def create_notification(db: Session, user_id: int, title: str, message: str, typ
     except Exception as e:
         print(f"Failed to create notification: {e}")
         db.rollback()
+
+def tenant_data_dir(*parts: str) -> str:
+    """
+    Returns (and creates) a directory under DATA_DIR scoped to the current tenant.
+    """
+    tenant = re.sub(r"[^A-Za-z0-9_.-]", "_", os.path.basename(str(TENANT_KEY)))
+    path = os.path.join(DATA_DIR, tenant, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -1,9 +1,12 @@
 import React, { useState, useRef, useEffect } from 'react';
 import { Download, FileText, FileSpreadsheet, Table } from 'lucide-react';
 import { exportToCSV, exportToExcel, exportToPDF } from '../utils/exportUtils';
+import { api } from '../services/api';
 import { motion, AnimatePresence } from 'framer-motion';
 
-const ExportMenu = ({ data, columns, filename, title }) => {
+// csvExport: optional { resource, params } to stream the CSV from the server
+// instead of building it from the rows already loaded in the browser.
+const ExportMenu = ({ data, columns, filename, title, csvExport }) => {
   const [isOpen, setIsOpen] = useState(false);
   const menuRef = useRef(null);
 
@@ -23,7 +26,11 @@ const ExportMenu = ({ data, columns, filename, title }) => {
 
     switch (format) {
       case 'csv':
-        exportToCSV(data, fullFilename);
+        if (csvExport) {
+          api.exports.downloadCsv(csvExport.resource, csvExport.params, fullFilename);
+        } else {
+          exportToCSV(data, fullFilename);
+        }
         break;
       case 'excel':
         exportToExcel(data, fullFilename);
@@ -22,7 +22,13 @@ const Layout = () => {
 
   // Fetch notifications
   React.useEffect(() => {
-    fetchNotifications();
+    // First load comes with the dashboard bootstrap request
+    api.dashboard.bootstrap()
+      .then((data) => {
+        setNotifications(data.notifications);
+        setUnreadCount(data.notifications.filter(n => !n.is_read).length);
+      })
+      .catch(fetchNotifications);
     
     // Poll every minute
     const interval = setInterval(fetchNotifications, 60000);
@@ -133,6 +133,7 @@ const Clients = () => {
                 columns={pdfColumns} 
                 filename="Clients_List" 
                 title="Client Directory" 
+                csvExport={{ resource: 'clients' }}
             />
             <AnimatedButton
               onClick={handleAddClient}
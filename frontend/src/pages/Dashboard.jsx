@@ -38,12 +38,9 @@ const Dashboard = () => {
   useEffect(() => {
     const fetchData = async () => {
       try {
-        const [statsData, trendsData] = await Promise.all([
-            api.dashboard.getStats(),
-            api.dashboard.getTrends()
-        ]);
-        setStats(statsData);
-        setTrends(trendsData);
+        const data = await api.dashboard.bootstrap();
+        setStats(data.stats);
+        setTrends(data.trends);
       } catch (error) {
         console.error('Error fetching dashboard data:', error);
       } finally {
@@ -53,6 +50,26 @@ const Dashboard = () => {
     fetchData();
   }, []);
 
+  // Live updates: the server pushes only the figures that changed
+  useEffect(() => {
+    const stop = api.dashboard.stream((name, data) => {
+      if (name === 'snapshot' || name === 'delta') {
+        if (data.stats) setStats((prev) => ({ ...prev, ...data.stats }));
+        if (data.current_month) {
+          setTrends((prev) => {
+            if (!prev.length) return prev;
+            const last = prev[prev.length - 1];
+            if (data.current_month.month && data.current_month.month !== last.month) {
+              return [...prev.slice(1), { ...last, ...data.current_month }];
+            }
+            return [...prev.slice(0, -1), { ...last, ...data.current_month }];
+          });
+        }
+      }
+    });
+    return stop;
+  }, []);
+
   // Delay chart rendering until after GlassCard animations complete
   useEffect(() => {
     if (!loading) {
@@ -15,6 +15,8 @@ const MpesaManagement = () => {
   const [activeTab, setActiveTab] = useState('transactions');
   const [loading, setLoading] = useState(true);
   const [unmatched, setUnmatched] = useState([]);
+  const [unmatchedTotal, setUnmatchedTotal] = useState(0);
+  const [nextAfter, setNextAfter] = useState(null);
   const [loans, setLoans] = useState([]);
   const [reconcilingId, setReconcilingId] = useState(null);
   const [selectedLoanId, setSelectedLoanId] = useState('');
@@ -37,7 +39,9 @@ const MpesaManagement = () => {
     try {
       if (activeTab === 'transactions') {
         const data = await api.mpesa.getUnmatched();
-        setUnmatched(data);
+        setUnmatched(data.items);
+        setUnmatchedTotal(data.total_count);
+        setNextAfter(data.next_after);
         const loansData = await api.loans.list();
         setLoans(loansData.filter(l => l.status === 'active'));
       }
@@ -48,6 +52,16 @@ const MpesaManagement = () => {
     }
   };
 
+  const loadMoreUnmatched = async () => {
+    try {
+      const data = await api.mpesa.getUnmatched({ after: nextAfter });
+      setUnmatched(prev => [...prev, ...data.items]);
+      setNextAfter(data.next_after);
+    } catch (error) {
+      toast.error("Failed to load more transactions");
+    }
+  };
+
   const handleReconcile = async (transId) => {
     if (!selectedLoanId) {
       toast.error("Target loan not selected");
@@ -134,7 +148,7 @@ const MpesaManagement = () => {
                 </div>
                 <div>
                   <h4 className="text-[10px] font-black text-gray-400 dark:text-gray-500 uppercase tracking-widest mb-1">Unreconciled Transactions</h4>
-                  <p className="text-4xl font-black text-gray-900 dark:text-white tracking-tighter">{unmatched.length}</p>
+                  <p className="text-4xl font-black text-gray-900 dark:text-white tracking-tighter">{unmatchedTotal}</p>
                 </div>
               </GlassCard>
 
@@ -245,6 +259,16 @@ const MpesaManagement = () => {
                       )}
                     </tbody>
                   </table>
+                  {!loading && nextAfter && (
+                    <div className="p-6 flex justify-center border-t border-gray-100 dark:border-white/5">
+                      <button
+                        onClick={loadMoreUnmatched}
+                        className="px-6 py-2.5 bg-white dark:bg-white/5 border border-gray-200 dark:border-white/10 text-[9px] font-black uppercase tracking-[0.2em] text-tytaj-600 dark:text-tytaj-400 hover:bg-tytaj-600 hover:text-white rounded-xl transition-all active:scale-95"
+                      >
+                        Load More
+                      </button>
+                    </div>
+                  )}
                 </div>
             </div>
           </motion.div>
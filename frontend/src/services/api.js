@@ -35,6 +35,8 @@ apiClient.interceptors.response.use(
   }
 );
 
+let bootstrapRequest = null;
+
 // API Service Object
 export const api = {
   // Expose the raw client if needed
@@ -120,7 +122,7 @@ export const api = {
   },
 
   mpesa: {
-    getUnmatched: async () => (await apiClient.get('/api/mpesa/transactions/unmatched')).data,
+    getUnmatched: async (params) => (await apiClient.get('/api/mpesa/transactions/unmatched', { params })).data,
     reconcile: async (id, loanId) => (await apiClient.post(`/api/mpesa/transactions/${id}/reconcile?loan_id=${loanId}`)).data,
     disburse: async (loanId) => (await apiClient.post(`/api/mpesa/b2c/disburse/${loanId}`)).data,
     stkPush: async (loanId, amount) => (await apiClient.post(`/api/mpesa/stk/push/${loanId}`, null, { params: { amount } })).data,
@@ -141,9 +143,89 @@ export const api = {
     markAllAsRead: async () => (await apiClient.put('/api/notifications/read-all')).data,
   },
 
+  exports: {
+    // Server-side streaming CSV (clients, loans, repayments, mpesa-transactions)
+    downloadCsv: async (resource, params, filename) => {
+      const res = await apiClient.get(`/api/exports/${resource}.csv`, { params, responseType: 'blob' });
+      const url = window.URL.createObjectURL(res.data);
+      const link = document.createElement('a');
+      link.href = url;
+      link.download = `${filename || resource}.csv`;
+      document.body.appendChild(link);
+      link.click();
+      link.remove();
+      window.URL.revokeObjectURL(url);
+    },
+  },
+
   dashboard: {
+    // One request for the first screen. Concurrent callers (dashboard, layout)
+    // share it; the browser revalidates with If-None-Match and reuses the
+    // cached body on 304.
+    bootstrap: () => {
+      if (!bootstrapRequest) {
+        bootstrapRequest = apiClient.get('/api/dashboard/bootstrap').then((res) => res.data);
+        bootstrapRequest.finally(() => setTimeout(() => { bootstrapRequest = null; }, 2000)).catch(() => {});
+      }
+      return bootstrapRequest;
+    },
     getStats: async () => (await apiClient.get('/api/dashboard/stats')).data,
     getTrends: async () => (await apiClient.get('/api/dashboard/trends')).data,
+    // Server-sent events over fetch (EventSource cannot send the Authorization header).
+    // Calls onEvent(name, data) for 'snapshot' and 'delta' events, reconnects with
+    // Last-Event-ID after a dropped connection, and returns a function that stops it.
+    stream: (onEvent) => {
+      const controller = new AbortController();
+      let lastEventId = null;
+      let retryMs = 5000;
+
+      const connect = async () => {
+        while (!controller.signal.aborted) {
+          try {
+            const headers = { Accept: 'text/event-stream' };
+            const token = localStorage.getItem('token');
+            if (token) headers.Authorization = `Bearer ${token}`;
+            if (lastEventId) headers['Last-Event-ID'] = lastEventId;
+
+            const res = await fetch(`${apiClient.defaults.baseURL}/api/dashboard/stream`, {
+              headers, signal: controller.signal,
+            });
+            if (res.status === 401) return;
+            if (!res.ok || !res.body) throw new Error(`Dashboard stream failed: ${res.status}`);
+
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            for (;;) {
+              const { done, value } = await reader.read();
+              if (done) break;
+              buffer += decoder.decode(value, { stream: true });
+              let boundary;
+              while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let name = 'message';
+                let data = '';
+                for (const line of block.split('\n')) {
+                  if (line.startsWith('id:')) lastEventId = line.slice(3).trim();
+                  else if (line.startsWith('event:')) name = line.slice(6).trim();
+                  else if (line.startsWith('data:')) data += line.slice(5).trim();
+                  else if (line.startsWith('retry:')) retryMs = parseInt(line.slice(6), 10) || retryMs;
+                }
+                if (data) onEvent(name, JSON.parse(data));
+              }
+            }
+          } catch (error) {
+            if (controller.signal.aborted) return;
+            logger.debug(`Dashboard stream dropped: ${error.message}`);
+          }
+          await new Promise((resolve) => setTimeout(resolve, retryMs));
+        }
+      };
+
+      connect();
+      return () => controller.abort();
+    },
   },
 
   // File Upload